@@ -1,33 +1,97 @@
 import asyncio
 import logging
 import math
+import time
 import reactivex
 import pickle
 import bokeh.palettes as bp
 import colorcet as cc
 
-from bokeh.events import RangesUpdate, Reset
+from bokeh.events import DocumentReady, RangesUpdate, Reset
 from bokeh.plotting import figure
-from bokeh.models import DataRange1d, LinearColorMapper, ColumnDataSource, MultiPolygons, TableColumn, DataTable
+from bokeh.models import DataRange1d, LinearColorMapper, ColumnDataSource, MultiPolygons, TableColumn, DataTable, \
+    Button, CustomJS, DatetimeTickFormatter, Div, Select, Slider, Toggle
 from shapely.geometry import Point
-from tornado.websocket import websocket_connect
+from tornado.websocket import WebSocketClosedError, websocket_connect
 from bokeh.layouts import row, column
 
-import mason_dixon.municipal_data_utility as mun_util
 from mason_dixon import coordinate_utility
+from mason_dixon.city_table import CityTablePager
 from mason_dixon.data_provider import DataProvider
-from mason_dixon.map_data_creator import render_full_map
+from mason_dixon.rate_history import HistoricalCityRates, RateHistory
+from mason_dixon.session_city_store import SessionCityStore
+from mason_dixon.session_snapshot import SessionSnapshot, SessionSnapshotStore
+from mason_dixon.topology import TOPOLOGY_COLUMNS, TOPOLOGY_DECODER_JS, decode_topologies, empty_topology, \
+    encode_topology, is_topology
 from client_side_utility import request_city_data_from_server
+from render_queue import RenderQueue, RenderSuperseded
+
+
+def empty_map_data():
+    return dict(x=[], y=[], name=[], rate=[])
+
+
+# The data of a map glyph. With topology encoding, the frames arrive topology-encoded (see mason_dixon/topology.py),
+# one payload per row of topology_source, and only the browser decodes them into source (which stays empty here).
+# A frame is either map data or a list of payloads; one of the other format (e.g. from a snapshot) is converted.
+class MapSource:
+    def __init__(self, topology=False):
+        self.topology = topology
+        self.source = ColumnDataSource(empty_map_data())
+        self.topology_source = None
+        self._refreshes = 0
+        if topology:
+            self.topology_source = ColumnDataSource(empty_topology())
+            for attr, mode in (('data', 'replace'), ('tags', 'replace'), ('streaming', 'append')):
+                self.topology_source.js_on_change(attr, CustomJS(args=dict(target=self.source, mode=mode),
+                                                                 code=TOPOLOGY_DECODER_JS))
+
+    def set(self, data):
+        self.set_frame([data] if is_topology(data) else data)
+
+    def set_frame(self, frame):
+        if isinstance(frame, list):
+            if self.topology:
+                self.topology_source.data = {column: [payload[column] for payload in frame]
+                                             for column in TOPOLOGY_COLUMNS}
+                return
+            frame = decode_topologies(frame)
+        elif self.topology:
+            self.set_frame([encode_topology(frame)])
+            return
+        self.source.data = frame
+
+    def stream(self, data):
+        if self.topology:
+            self.topology_source.stream({column: [data[column]] for column in TOPOLOGY_COLUMNS})
+        else:
+            self.source.stream(data)
+
+    def clear(self):
+        self.set_frame([] if self.topology else empty_map_data())
 
+    def get_frame(self):
+        if self.topology:
+            data = self.topology_source.data
+            return [{column: data[column][row] for column in TOPOLOGY_COLUMNS} for row in range(len(data['name']))]
+        return {field: list(values) for field, values in self.source.data.items()}
 
-def bokeh_app(doc, cfg, data_provider: DataProvider):
+    # A browser that pulls the document gets the payloads, but no change to decode them on. This is one.
+    def refresh(self):
+        if self.topology:
+            self._refreshes += 1
+            self.topology_source.tags = [self._refreshes]
+
+
+def bokeh_app(doc, cfg, data_provider: DataProvider, render_queue: RenderQueue,
+              snapshot_store: SessionSnapshotStore = None, rate_history: RateHistory = None):
 
     needs_update = True
     ready_for_rerender = reactivex.subject.Subject()
 
-    ws_conn_url = "ws://localhost:8888/ws"
+    ws_conn_url = cfg["poll_websocket_url"]
     ws_conn = None
-    ws_conn_city_update_url = "ws://localhost:8888/get_cities"
+    ws_conn_city_update_url = cfg["city_update_websocket_url"]
     ws_conn_city_update = None
 
     # TODO: Clean this up (the values are overwritten on the initial server call anyway)
@@ -37,12 +101,26 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
     box_factor = cfg["box_factor"]
     city_box_proportion = cfg["city_box_proportion"]
 
-    city_array = data_provider.cities_dataframe_mercator.copy(deep=True)
-    region_array = data_provider.region_dataframe.copy(deep=True)
+    # The geometry is shared by all of the sessions (and never modified). A session only holds its own rates.
+    city_store = SessionCityStore(data_provider.city_store)
 
     request_counter = 0
+    # The latest render of the session. The data of an older one that reaches the document afterwards is dropped.
+    render_generation = 0
     last_response_received = 0
     server_session_guid = doc.session_context.request.arguments['guid'][0].decode('ascii')
+    # 'tessellation', or a grid engine ('hex' or 'square'), chosen per session by BaseHandler
+    engine_argument = doc.session_context.request.arguments.get('engine')
+    engine = engine_argument[0].decode('ascii') if engine_argument else cfg.get("render_engine", "tessellation")
+    # The browser's snapshot key (see session_snapshot.py). A new browser's key is the guid of its first session.
+    snapshot_argument = doc.session_context.request.arguments.get('snapshot')
+    snapshot_key = snapshot_argument[0].decode('ascii') if snapshot_argument else server_session_guid
+    # The last rendered frame that is not in the snapshot yet: (upper_left_merc, lower_right_merc, rect_data, table_data)
+    unsaved_frame = None
+    # With the time slider on, the map shows the rates at this time (see rate_history.py), instead of the latest ones
+    history_time = None
+
+    snapshot_callback_id = None
 
     rerender_callback_id = None
     polling_callback_id = None
@@ -51,35 +129,51 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
     session_closed = False
 
     def check_if_needs_update(message):
-        nonlocal needs_update, session_closed
+        nonlocal needs_update
         if session_closed:
             return
 
         deserialized = pickle.loads(message)
         logging.debug("MESSAGE RECEIVED --> " + str(deserialized))
         if ('session_open' in deserialized) and (not deserialized['session_open']):
-            ws_conn.close()
-            ws_conn_city_update.close()
             doc.remove_periodic_callback(polling_callback_id)
             doc.remove_periodic_callback(rerender_callback_id)
-            session_closed = True
+            if snapshot_callback_id is not None:
+                doc.remove_periodic_callback(snapshot_callback_id)
+            close_session()
         elif 'needs_update' in deserialized:
             needs_update = deserialized['needs_update']
 
-    def update_cities_table(message):
-        def new_value(city):
-            logging.debug("New municipal data received" + str(city))
-            if city['update_counter'] <= city_array.loc[city['index'], 'updates']:
-                # Update is stale. Return the current rate
-                return city_array.loc[city['index'], 'rate']
+    def close_session():
+        nonlocal session_closed
+        save_snapshot()
+        # The Tornado server deletes the session's state once the Bokeh session no longer needs it
+        if ws_conn is not None:
+            try:
+                ws_conn.write_message(pickle.dumps({'session_guid': server_session_guid, 'session_closed': True}),
+                                      binary=True)
+            except WebSocketClosedError:
+                pass
+        for conn in (ws_conn, ws_conn_city_update):
+            if conn is not None:
+                conn.close()
+        render_queue.forget(server_session_guid)
+        session_closed = True
+
+    # A session that ends without /exit (e.g. a crashed tab, or a lost beacon) is destroyed by Bokeh once its websocket
+    # has been gone for a while, and its periodic callbacks with it
+    def session_destroyed_callback(session_context):
+        if not session_closed:
+            close_session()
+
+    doc.on_session_destroyed(session_destroyed_callback)
 
-            return city['rate']
-
-        mapper = {d['index']: new_value(d) for d in message.city_list}
-        city_array['rate'] = city_array['index'].map(mapper).fillna(city_array['rate'])
-
-        mapper2 = {d['index']: max(d['update_counter'], city_array.loc[d['index'], 'updates']) for d in message.city_list}
-        city_array['updates'] = city_array['index'].map(mapper2).fillna(city_array['updates'])
+    def update_cities_table(message):
+        # Stale updates are ignored by the store
+        changed = city_store.apply_updates(message.indices, message.rates, message.versions)
+        if rate_history is not None:
+            rate_history.record(message.indices, message.rates, message.versions)
+        logging.debug("New municipal data received for " + str(changed) + " of " + str(len(message.indices)) + " cities")
 
     def city_update_callback(message):
         nonlocal last_response_received
@@ -111,6 +205,22 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
         logging.debug("rerender() - Rerender required")
         ready_for_rerender.on_next('Rerendering request sent')
 
+    # Saves the last rendered frame (if it is not saved yet), with the session's rates, off the IO loop
+    def save_snapshot():
+        nonlocal unsaved_frame
+        if snapshot_store is None or unsaved_frame is None:
+            return
+
+        snapshot = SessionSnapshot(*unsaved_frame[:2], *city_store.snapshot(), *unsaved_frame[2:])
+        unsaved_frame = None
+        asyncio.get_running_loop().run_in_executor(None, snapshot_store.save, snapshot_key, snapshot)
+
+    # What the renders take their rates from
+    def get_render_rates():
+        if history_time is None:
+            return city_store
+        return HistoricalCityRates(rate_history, city_store, history_time)
+
     def poll_for_updates():
         if session_closed:
             return
@@ -120,17 +230,24 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
         payload['session_guid'] = server_session_guid
         ws_conn.write_message(pickle.dumps(payload), binary=True)
 
-    async def produce_map(lon_wgs, lat_wgs, aspect_ratio, zoom, box_factor, city_box_proportion, palette):
+    # With a snapshot, the map starts from the snapshot's frame instead of rendering one
+    async def produce_map(lon_wgs, lat_wgs, aspect_ratio, zoom, box_factor, city_box_proportion, palette, snapshot=None):
         nonlocal request_counter, upper_left_merc, lower_right_merc
-        frame_size = (zoom, zoom / aspect_ratio)
-        upper_left_wgs = (lon_wgs, lat_wgs)
-        lower_right_wgs = (upper_left_wgs[0] + frame_size[0], upper_left_wgs[1] - frame_size[1])
-
-        upper_left_merc = coordinate_utility.point_to_mercator(Point(upper_left_wgs[0], upper_left_wgs[1]))
-        lower_right_merc = coordinate_utility.point_to_mercator(Point(lower_right_wgs[0], lower_right_wgs[1]))
-
-        # Difference from the prototype... full city_array needs to be passed here, instead of filtered.
-        rect_data, table_data = render_full_map(upper_left_merc, lower_right_merc, box_factor, city_array, region_array, mun_util.rate_rule, city_box_proportion, True)
+        if snapshot is not None:
+            upper_left_merc, lower_right_merc = snapshot.upper_left_merc, snapshot.lower_right_merc
+            rect_data, table_data = snapshot.rect_data, snapshot.table_data
+        else:
+            frame_size = (zoom, zoom / aspect_ratio)
+            upper_left_wgs = (lon_wgs, lat_wgs)
+            lower_right_wgs = (upper_left_wgs[0] + frame_size[0], upper_left_wgs[1] - frame_size[1])
+
+            upper_left_merc = coordinate_utility.point_to_mercator(Point(upper_left_wgs[0], upper_left_wgs[1]))
+            lower_right_merc = coordinate_utility.point_to_mercator(Point(lower_right_wgs[0], lower_right_wgs[1]))
+
+            # Difference from the prototype... full city_array needs to be passed here, instead of filtered.
+            # Rendering runs on the render queue's executor, so the IO loop stays free for the other sessions.
+            # (The initial frame is what any new session gets, so it is not worth a snapshot)
+            rect_data, table_data = await render_queue.render(server_session_guid, city_store, upper_left_merc, lower_right_merc, box_factor, city_box_proportion, True, engine)
 
         # Maybe factor this into a helper function
         x_range = (upper_left_merc.x, lower_right_merc.x)
@@ -159,43 +276,179 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
 
         color_mapper = LinearColorMapper(palette=palette)
 
-        source = ColumnDataSource(rect_data)
+        # With progressive rendering, the regions of a new view are drawn from coarse_source (under the cells) until
+        # all of their cells have been streamed into source
+        topology = render_queue.topology_quantization > 0
+        coarse_source = MapSource(topology)
+        coarse_ptch = MultiPolygons(xs="x", ys="y", line_width=0.5, fill_alpha=0.7, line_color="white",
+                                    fill_color=dict(field='rate', transform=color_mapper))
+        p.add_glyph(coarse_source.source, coarse_ptch)
+
+        source = MapSource(topology)
+        source.set(rect_data)
         ptch = MultiPolygons(xs="x", ys="y", line_width=0.5, fill_alpha=0.7, line_color="white",
                              fill_color=dict(field='rate', transform=color_mapper))
-        p.add_glyph(source, ptch)
+        p.add_glyph(source.source, ptch)
+
+        # Nothing refers to the topology-encoded sources (their callbacks refer to the glyphs' sources instead), so they
+        # are roots of their own, to be in the document that the browser gets. This runs in a task, outside of the
+        # document's lock, so the roots are added in a next tick callback (which holds it), like the layout's below.
+        if topology:
+            for topology_source in (coarse_source.topology_source, source.topology_source):
+                doc.add_next_tick_callback(lambda topology_source=topology_source: doc.add_root(topology_source))
+
+        def document_ready_callback(event):
+            coarse_source.refresh()
+            source.refresh()
+
+        doc.on_event(DocumentReady, document_ready_callback)
         #ptch = p.multi_polygons(xs="x", ys="y", source=rect_data, line_width=0.5, fill_alpha=0.7, line_color="white",
         #                     fill_color=dict(field='rate', transform=color_mapper))
 
-        table_source = ColumnDataSource(table_data)
+        # Only the current page of the frame's cities is in table_source. The sorting and the paging are done here,
+        # so the table's own sorting is disabled.
+        pager = CityTablePager(cfg.get("table_page_size", 100))
+        pager.set_cities(table_data)
+        table_source = ColumnDataSource(pager.get_page())
 
         columns = [
             TableColumn(field='display_string', title='City', width=200),
             TableColumn(field='formatted', title='Value', width=50),
         ]
 
-        table = DataTable(source=table_source, columns=columns, index_position=None, height=initial_height, width=250)
+        table = DataTable(source=table_source, columns=columns, index_position=None, sortable=False,
+                          height=initial_height - 70, width=250)
+        sort_select = Select(value=pager.sort_order, width=250,
+                             options=[('rate_desc', "Highest value"), ('rate_asc', "Lowest value"),
+                                      ('population_desc', "Largest population"),
+                                      ('population_asc', "Smallest population")])
+        previous_button = Button(label="<", width=40)
+        next_button = Button(label=">", width=40)
+        page_div = Div(text=pager.describe(), width=150)
+
+        def show_page():
+            table_source.data = pager.get_page()
+            page_div.text = pager.describe()
+
+        def set_table_cities(table_data):
+            pager.set_cities(table_data)
+            show_page()
+
+        def sort_callback(attr, old, new):
+            pager.set_sort_order(new)
+            show_page()
+
+        def turn_page(pages):
+            if pager.turn(pages):
+                show_page()
+
+        sort_select.on_change('value', sort_callback)
+        previous_button.on_click(lambda: turn_page(-1))
+        next_button.on_click(lambda: turn_page(1))
+        table_panel = column(sort_select, table, row(previous_button, page_div, next_button))
+
+        # The time slider spans the rate history, up to when it is switched on
+        if rate_history is not None:
+            time_format = '%Y-%m-%d %H:%M:%S'
+            history_toggle = Toggle(label="Rate history", width=250)
+            history_slider = Slider(start=0, end=1000, value=1000, step=1000, title="Rates at", width=250,
+                                    visible=False, format=DatetimeTickFormatter(
+                                        **{resolution: time_format for resolution in
+                                           ('milliseconds', 'seconds', 'minsec', 'minutes', 'hourmin', 'hours',
+                                            'days', 'months', 'years')}))
+
+            def history_toggle_callback(attr, old, new):
+                nonlocal history_time
+                history_slider.visible = new
+                if new:
+                    end = time.time()
+                    start = min(rate_history.start_time(), end - 1)
+                    history_slider.update(start=1000 * start, end=1000 * end, value=1000 * end)
+                    history_time = end
+                else:
+                    history_time = None
+                regeneration_callback("Rate history " + ("on" if new else "off"))
+
+            def history_slider_callback(attr, old, new):
+                nonlocal history_time
+                if history_time is None:
+                    return
+                history_time = new / 1000
+                regeneration_callback("Showing the rates at " + str(history_time))
+
+            history_toggle.on_change('active', history_toggle_callback)
+            history_slider.on_change('value_throttled', history_slider_callback)
+            table_panel = column(table_panel, history_toggle, history_slider)
 
         async def get_data_from_server_and_update(merc_upper_left, merc_lower_right):
-            nonlocal request_counter
+            nonlocal request_counter, render_generation
             wgs_upper_left = coordinate_utility.point_to_wgs84(merc_upper_left)
             wgs_lower_right = coordinate_utility.point_to_wgs84(merc_lower_right)
             new_zoom = abs(wgs_lower_right.x - wgs_upper_left.x)
             zoom_lat = abs(wgs_lower_right.y - wgs_upper_left.y)
-            new_aspect_ratio = zoom / zoom_lat
+            new_aspect_ratio = new_zoom / zoom_lat
             new_lon_wgs = wgs_upper_left.x
             new_lat_wgs = wgs_lower_right.y
             request_counter = request_counter + 1
             new_request_id = request_counter
-            request_city_data_from_server(city_array, new_lon_wgs, new_lat_wgs, new_aspect_ratio, new_zoom, new_request_id, server_session_guid, ws_conn_city_update)
+            request_city_data_from_server(city_store.city_store, new_lon_wgs, new_lat_wgs, new_aspect_ratio, new_zoom, new_request_id, server_session_guid, ws_conn_city_update, city_store.updates)
             await wait_for_counter(new_request_id)
             logging.debug("get_data_from_server_and_update: New data received")
+            # A frame of past rates is not saved in the snapshot, which holds the latest ones
+            rates_source = get_render_rates()
+            historical = rates_source is not city_store
+            render_generation += 1
+            generation = render_generation
 
             def apply_cb(rect_data, table_data):
+                nonlocal unsaved_frame
+                if generation != render_generation:
+                    return
                 #ptch.data_source.data = data
-                source.data = rect_data
-                table_source.data = table_data
+                source.set(rect_data)
+                set_table_cities(table_data)
+                if not historical:
+                    unsaved_frame = (merc_upper_left, merc_lower_right, source.get_frame(), table_data)
                 logging.debug("get_data_from_server_and_update: New data applied")
-            new_rect_data, new_table_data = render_full_map(merc_upper_left, merc_lower_right, box_factor, city_array, region_array, mun_util.rate_rule, city_box_proportion, False)
+
+            def apply_coarse_cb(coarse_data):
+                if generation != render_generation:
+                    return
+                coarse_source.set(coarse_data)
+                source.clear()
+
+            def apply_final_cb(table_data):
+                nonlocal unsaved_frame
+                if generation != render_generation:
+                    return
+                coarse_source.clear()
+                set_table_cities(table_data)
+                # The cells were streamed in, so the frame is what source holds now
+                if not historical:
+                    unsaved_frame = (merc_upper_left, merc_lower_right, source.get_frame(), table_data)
+                logging.debug("get_data_from_server_and_update: All cells applied")
+
+            def apply_cells_cb(cells_data):
+                if generation != render_generation:
+                    return
+                source.stream(cells_data)
+
+            # Called on the IO loop, while the render is running
+            def progressive_cb(kind, data):
+                if kind == 'coarse':
+                    doc.add_next_tick_callback(lambda: apply_coarse_cb(data))
+                else:
+                    doc.add_next_tick_callback(lambda: apply_cells_cb(data))
+
+            try:
+                if render_queue.progressive and engine == 'tessellation':
+                    new_table_data = await render_queue.render_progressively(server_session_guid, rates_source, merc_upper_left, merc_lower_right, box_factor, city_box_proportion, progressive_cb)
+                    doc.add_next_tick_callback(lambda: apply_final_cb(new_table_data))
+                    return
+                new_rect_data, new_table_data = await render_queue.render(server_session_guid, rates_source, merc_upper_left, merc_lower_right, box_factor, city_box_proportion, engine=engine)
+            except RenderSuperseded:
+                # A newer view of this session is already queued
+                return
             # Some issues with locking, so put this in a next_tick_callback
             doc.add_next_tick_callback(lambda: apply_cb(new_rect_data, new_table_data))
 
@@ -223,12 +476,20 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
         p.on_event(Reset, client_side_callback)
         ready_for_rerender.subscribe(regeneration_callback)
 
-        return p, table
+        return p, table_panel
 
     async def create_initial_figure():
-        nonlocal rerender_callback_id, polling_callback_id
+        nonlocal rerender_callback_id, polling_callback_id, snapshot_callback_id
         await initialize()
 
+        # A reconnecting browser gets its last frame back right away, then an update for the rates that changed since
+        snapshot = None
+        if snapshot_store is not None:
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, snapshot_store.load, snapshot_key)
+        if snapshot is not None:
+            snapshot.restore_rates(city_store)
+            logging.info("Session " + server_session_guid + " restored from snapshot " + snapshot_key)
+
         lon = cfg["initial_lon_wgs"]
         lat = cfg["initial_lat_wgs"]
         aspect_ratio = cfg["aspect_ratio"]
@@ -237,12 +498,18 @@ def bokeh_app(doc, cfg, data_provider: DataProvider):
         # Good palettes are bp.Viridis11, cc.fire, cc.CET_L5, and cc.CET_L16
         palette = eval(f"{cfg['palette']}")
 
-        p, table = await produce_map(lon, lat, aspect_ratio, zoom, box_factor, city_box_proportion, palette)
-        r = row(p, table)
+        p, table_panel = await produce_map(lon, lat, aspect_ratio, zoom, box_factor, city_box_proportion, palette,
+                                           snapshot)
+        r = row(p, table_panel)
         #doc.add_next_tick_callback(lambda: doc.add_root(p))
         doc.add_next_tick_callback(lambda: doc.add_root(r))
         rerender_callback_id = doc.add_periodic_callback(rerender, 1000)
         polling_callback_id = doc.add_periodic_callback(poll_for_updates, 1000)
+        if snapshot_store is not None:
+            snapshot_callback_id = doc.add_periodic_callback(save_snapshot,
+                                                             cfg.get("session_snapshot_interval", 5) * 1000)
+        if snapshot is not None:
+            ready_for_rerender.on_next('Refreshing the frame restored from a snapshot')
 
     loop = asyncio.get_running_loop()
     loop.create_task(create_initial_figure())
@@ -0,0 +1,116 @@
+# coding=utf-8
+import argparse
+import logging
+import os
+import numpy as np
+from datetime import datetime
+import yaml
+
+from startup_timing import StartupTimer
+
+# A Bokeh rendering worker: one Bokeh server process, serving the map for the sessions that BaseHandler places
+# on it. main.py starts one of these for each entry of 'bokeh_server_paths' (if 'spawn_bokeh_workers' is set),
+# but they can also be started by hand, on this host or another one:
+#     python bokeh_worker.py --port 5007
+
+
+def get_port(server_path):
+    return int(server_path.rsplit(':', 1)[1])
+
+
+def run_bokeh_worker(port, cfg, parent_pid=None):
+    startup_timer = StartupTimer()
+
+    log_filename = 'MasonDixon-bokeh-' + str(port) + '-' + datetime.utcnow().strftime('%Y%m%d%H%M%S') + '.log'
+    log_filepath = os.path.join('logs', log_filename)
+    logging.basicConfig(filename=log_filepath, encoding='utf-8', level=logging.INFO)
+
+    import tornado.ioloop
+    from bokeh.server.server import Server
+    from bokeh_app import bokeh_app
+    from mason_dixon.data_provider import load_data_provider
+    from mason_dixon.rate_history import create_rate_history
+    from mason_dixon.session_snapshot import SessionSnapshotStore
+    from render_queue import create_render_queue
+    from sampling_profiler import ProfileHandler
+    from warmup import create_warmup_job, viewport_to_mercator
+    from server_stats import LoopLagMonitor, StatsHandler, get_process_stats
+    startup_timer.mark("imports")
+
+    # Starting with random values
+    data_prov = load_data_provider(lambda coords: np.random.uniform(500, 2000),
+                                   cfg.get("startup_snapshot", False), startup_timer.mark)
+
+    render_queue = create_render_queue(cfg, data_prov)
+    startup_timer.mark("render queue")
+
+    snapshot_store = None
+    if cfg.get("session_snapshot_dir"):
+        snapshot_store = SessionSnapshotStore(cfg["session_snapshot_dir"],
+                                              cfg.get("session_snapshot_max_mb", 256) * 1024 * 1024)
+
+    # Shared by the sessions of the worker
+    rate_history = create_rate_history(cfg)
+
+    # The tiles of the hot viewports (see warmup.py)
+    async def warm_tiles(viewports):
+        return await render_queue.warm_up([viewport_to_mercator(viewport) for viewport in viewports],
+                                          cfg["box_factor"], cfg["city_box_proportion"], cfg.get("warmup_budget", 30))
+
+    warmup_job = create_warmup_job(cfg, warm_tiles)
+
+    loop_lag_monitor = LoopLagMonitor()
+
+    def get_stats():
+        stats = get_process_stats(loop_lag_monitor)
+        stats['bokeh_sessions'] = len(bokeh_server.get_sessions('/bokeh_app'))
+        stats['render_queue'] = render_queue.stats()
+        if snapshot_store is not None:
+            stats['session_snapshots'] = snapshot_store.stats()
+        if rate_history is not None:
+            stats['rate_history'] = rate_history.stats()
+        if warmup_job is not None:
+            stats['warmup'] = warmup_job.stats()
+        return stats
+
+    bokeh_server = Server({'/bokeh_app': lambda doc: bokeh_app(doc, cfg, data_prov, render_queue, snapshot_store,
+                                                                  rate_history)},
+                          port=port,
+                          allow_websocket_origin=cfg["websocket_origins"],
+                          check_unused_sessions_milliseconds=1000,
+                          unused_lifetime_milliseconds=1000,
+                          extra_patterns=[(r"/stats", StatsHandler, dict(get_stats=get_stats)),
+                                          (r"/profile", ProfileHandler, dict(cfg=cfg))]
+                          )
+    bokeh_server.start()
+    loop_lag_monitor.start()
+    if snapshot_store is not None:
+        tornado.ioloop.PeriodicCallback(snapshot_store.evict, 60000).start()
+    if warmup_job is not None:
+        warmup_job.start()
+    startup_timer.mark("bokeh server")
+    startup_timer.log_report()
+    logging.info("Bokeh worker listening on port " + str(port))
+
+    # A worker started by main.py shuts down with it
+    if parent_pid is not None:
+        def check_parent():
+            if os.getppid() != parent_pid:
+                logging.info("Parent process is gone, stopping Bokeh worker")
+                bokeh_server.io_loop.stop()
+
+        tornado.ioloop.PeriodicCallback(check_parent, 1000).start()
+
+    bokeh_server.io_loop.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a MasonDixon Bokeh rendering worker")
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--config', default='config.yml')
+    args = parser.parse_args()
+
+    with open(args.config, "r") as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+
+    run_bokeh_worker(args.port, cfg)
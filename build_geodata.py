@@ -0,0 +1,30 @@
+# coding=utf-8
+import argparse
+import logging
+import time
+
+from mason_dixon.geodata_processing_utility import build_regions, build_cities
+
+# Builds (or incrementally refreshes) the GeoJSON caches in geographic_data/cache from the Natural Earth zips.
+# Run this once after checking out the repository, and again whenever the raw data or special_regions changes.
+# Stages whose inputs have not changed are loaded from geographic_data/cache/stages instead of being recomputed.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the MasonDixon GeoJSON caches")
+    parser.add_argument('--force', action='store_true', help="recompute every stage, even if it is up to date")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes used to dissolve the region groups (default: one per core)")
+    parser.add_argument('--only', choices=['regions', 'cities'], default=None, help="only build one of the caches")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.only in (None, 'regions'):
+        start = time.perf_counter()
+        rebuilt = build_regions(force=args.force, workers=args.workers)
+        logging.info(f"Regions {'rebuilt' if rebuilt else 'unchanged'} in {time.perf_counter() - start:.1f}s")
+
+    if args.only in (None, 'cities'):
+        start = time.perf_counter()
+        rebuilt = build_cities(force=args.force)
+        logging.info(f"Cities {'rebuilt' if rebuilt else 'unchanged'} in {time.perf_counter() - start:.1f}s")
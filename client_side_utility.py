@@ -1,13 +1,22 @@
 import logging
 import pickle
 
-from shapely.geometry import Polygon, Point
+from shapely.geometry import Point
 from mason_dixon import municipal_data_utility as mun_util, coordinate_utility
 
 # The functions in this file are all stateless, and aid in either creating the map data
 
-def request_city_data_from_server(city_array, lon_wgs, lat_wgs, aspect_ratio, zoom, request_id, session_guid, ws_conn):
-    # city_array and region_array have their geometry values in WGS84 coordinates to use the Travel APIs
+def request_city_data_from_server(city_store, lon_wgs, lat_wgs, aspect_ratio, zoom, request_id, session_guid, ws_conn,
+                                  known_versions=None):
+    payload = get_city_request(city_store, lon_wgs, lat_wgs, aspect_ratio, zoom, request_id, session_guid,
+                               known_versions)
+    ws_conn.write_message(pickle.dumps(payload), binary=True)
+
+
+# The request for the cities of a frame, as sent to the Tornado server's /get_cities websocket. known_versions (the
+# rate version of every city, by position) lets the server skip the cities whose rates are already up to date.
+def get_city_request(city_store, lon_wgs, lat_wgs, aspect_ratio, zoom, request_id, session_guid, known_versions=None):
+    # The frame is looked up in Web Mercator coordinates, like the renderers do
     # zoom needs to determine the critical population values
 
     frame_size = (zoom, zoom / aspect_ratio)
@@ -17,21 +26,16 @@ def request_city_data_from_server(city_array, lon_wgs, lat_wgs, aspect_ratio, zo
     upper_left_merc = coordinate_utility.point_to_mercator(Point(upper_left_wgs[0], upper_left_wgs[1]))
     lower_right_merc = coordinate_utility.point_to_mercator(Point(lower_right_wgs[0], lower_right_wgs[1]))
 
-    lon_point_list = [upper_left_merc.x, lower_right_merc.x, lower_right_merc.x, upper_left_merc.x]
-    lat_point_list = [upper_left_merc.y, upper_left_merc.y, lower_right_merc.y, lower_right_merc.y]
-
-    logging.debug("Requesting municipal data (client side). Corners of the map:")
-    for elt in zip(lon_point_list, lat_point_list):
-        logging.debug(str(elt))
-
-    frame_geometry = Polygon(zip(lon_point_list, lat_point_list))
+    logging.debug("Requesting municipal data (client side). Corners of the map: " + str(upper_left_merc) + ", " +
+                  str(lower_right_merc))
 
     # little_population is needed server side.
     little_population, big_population = mun_util.map_zoom_to_population(zoom)
 
     # In the prototype, there is a lambda that maps a City (Point) geometry to a number, i.e. the average cost to visit.
     # Unlike prototype, this needs to be broken apart into get_cities_within_geometry, then a ws call.
-    filtered_cities = mun_util.get_cities_within_geometry(frame_geometry, city_array, little_population, [])
+    indices = mun_util.get_cities_in_frame(city_store, (upper_left_merc.x, upper_left_merc.y),
+                                           (lower_right_merc.x, lower_right_merc.y), little_population, mercator=True)
 
     payload = dict()
     payload['upper_left_wgs'] = upper_left_wgs
@@ -39,7 +43,9 @@ def request_city_data_from_server(city_array, lon_wgs, lat_wgs, aspect_ratio, zo
     payload['min_population'] = little_population
     payload['method'] = 'average'
     payload['request_id'] = request_id
-    payload['indices'] = filtered_cities['index']
+    payload['indices'] = indices
     payload['session_guid'] = session_guid
-    ws_conn.write_message(pickle.dumps(payload), binary=True)
+    if known_versions is not None:
+        payload['versions'] = known_versions[indices]
+    return payload
 
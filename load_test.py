@@ -0,0 +1,544 @@
+# coding=utf-8
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pickle
+import re
+import time
+import urllib.parse
+import numpy as np
+from datetime import datetime
+import yaml
+
+from bokeh.core.serialization import Serializable
+from bokeh.document import Document
+from bokeh.document.events import ColumnDataChangedEvent, ColumnsStreamedEvent, MessageSentEvent, ModelChangedEvent
+from bokeh.events import RangesUpdate
+from bokeh.models import DataTable, Plot
+from bokeh.protocol import Protocol
+from bokeh.protocol.receiver import Receiver
+from bokeh.util.token import generate_jwt_token
+from shapely.geometry import Point
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+
+from client_side_utility import get_city_request
+from mason_dixon import coordinate_utility
+from mason_dixon.data_provider import load_data_provider
+from server_stats import LoopLagMonitor
+
+# A load generator for a running server (main.py, with its Bokeh workers). Each simulated session is bootstrapped
+# through BaseHandler (GET /), then, until the end of the test, pans and zooms along a random trace and clicks
+# "Update Data" from time to time:
+#   - by default, it plays the part of the session's Bokeh document: it polls /ws and requests the cities of each new
+#     view on /get_cities, the way bokeh_app.py does
+#   - with --bokeh-clients, that many of the sessions connect to their Bokeh session instead (like a browser would),
+#     and send it each new view, so the whole path down to the rendered map is measured
+# The rate API is the stub in main.py; set stub_rate_latency in config.yml to give it a realistic latency.
+#
+# The latencies (p50/p95/p99), throughput, event loop lag (of the servers, from their /stats endpoints, and of the
+# generator itself) and memory per session are printed, and saved to load_test_results/ for comparison across runs:
+#     python load_test.py --sessions 50 --duration 120 --label baseline
+#     python load_test.py --compare load_test_results/<first>.json load_test_results/<second>.json
+
+UUID_PATTERN = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+# As bokeh.client's, since the pulled document holds the whole map
+BOKEH_MAX_MESSAGE_SIZE = 20 * 2 ** 20
+
+
+# Latencies (in seconds) by kind of request
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = dict()
+        self.errors = dict()
+
+    def record(self, kind, latency):
+        self.latencies.setdefault(kind, []).append(latency)
+
+    def record_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self, duration):
+        summary = dict()
+        for kind in sorted(set(self.latencies) | set(self.errors)):
+            latencies = np.array(self.latencies.get(kind, []))
+            entry = {'count': len(latencies), 'errors': self.errors.get(kind, 0),
+                     'throughput': len(latencies) / duration}
+            if len(latencies) > 0:
+                entry.update({
+                    'mean': float(latencies.mean()),
+                    'p50': float(np.percentile(latencies, 50)),
+                    'p95': float(np.percentile(latencies, 95)),
+                    'p99': float(np.percentile(latencies, 99)),
+                    'max': float(latencies.max())
+                })
+            summary[kind] = entry
+        return summary
+
+
+# A random walk of the view (in WGS84, as in config.yml): mostly pans of up to half of the frame, sometimes a zoom in
+# or out by a wheel step
+class ViewportTrace:
+    def __init__(self, rng, lon_wgs, lat_wgs, aspect_ratio, zoom):
+        self.rng = rng
+        self.lon_wgs = lon_wgs
+        self.lat_wgs = lat_wgs
+        self.aspect_ratio = aspect_ratio
+        self.zoom = zoom
+
+    def step(self):
+        if self.rng.random() < 0.7:
+            self.lon_wgs += self.rng.uniform(-0.5, 0.5) * self.zoom
+            self.lat_wgs += self.rng.uniform(-0.5, 0.5) * self.zoom / self.aspect_ratio
+        else:
+            factor = 2 ** self.rng.choice([-0.5, 0.5])
+            new_zoom = min(120.0, max(0.5, self.zoom * factor))
+            # Zoom about the center of the frame
+            self.lon_wgs += 0.5 * (self.zoom - new_zoom)
+            self.lat_wgs -= 0.5 * (self.zoom - new_zoom) / self.aspect_ratio
+            self.zoom = new_zoom
+
+        self.lon_wgs = min(180.0 - self.zoom, max(-180.0, self.lon_wgs))
+        self.lat_wgs = min(80.0, max(-60.0 + self.zoom / self.aspect_ratio, self.lat_wgs))
+
+    # The upper left and lower right corners in WebMercator
+    def get_frame_merc(self):
+        upper_left = coordinate_utility.point_to_mercator(Point(self.lon_wgs, self.lat_wgs))
+        lower_right = coordinate_utility.point_to_mercator(
+            Point(self.lon_wgs + self.zoom, self.lat_wgs - self.zoom / self.aspect_ratio))
+        return upper_left, lower_right
+
+
+def parse_bootstrap_page(html):
+    guid = re.search(r'sessionStorage\.setItem\("session-guid", "(' + UUID_PATTERN + ')"\)', html).group(1)
+    bokeh_session_id = re.search(r'"Bokeh-Session-Id", "([^"]+)"', html).group(1)
+    bokeh_url = re.search(r'(http://[^/"]+/bokeh_app)/autoload', html).group(1)
+    return guid, bokeh_session_id, bokeh_url
+
+
+# Each session has its own generator, so that its trace does not depend on how the sessions interleave
+def jittered(rng, interval):
+    return interval * rng.uniform(0.5, 1.5)
+
+
+def get_ws_url(url, path):
+    return re.sub(r'^http', 'ws', url) + path
+
+
+# A UI event (e.g. bokeh.events.RangesUpdate), serialized as BokehJS sends it. Bokeh's Event classes can only be
+# decoded, since the Python side never sends them.
+class UIEventMessage(Serializable):
+    def __init__(self, event):
+        self.event = event
+
+    def to_serializable(self, serializer):
+        return {'type': 'event', 'name': self.event.event_name, 'values': serializer.encode(vars(self.event))}
+
+
+class LoadTest:
+    def __init__(self, args, cfg, city_store):
+        self.args = args
+        self.cfg = cfg
+        self.city_store = city_store
+        self.recorder = LatencyRecorder()
+        self.http_client = AsyncHTTPClient(max_clients=max(10, 2 * args.sessions))
+        self.rng = np.random.default_rng(args.seed)
+        self.stats_urls = {args.url: True}
+        self.server_samples = dict()
+        self.end_time = None
+
+    async def timed_fetch(self, kind, request):
+        start = time.perf_counter()
+        try:
+            response = await self.http_client.fetch(request)
+        except Exception as e:
+            logging.warning(kind + " failed: " + str(e))
+            self.recorder.record_error(kind)
+            return None
+        self.recorder.record(kind, time.perf_counter() - start)
+        return response
+
+    async def bootstrap(self):
+        response = await self.timed_fetch('bootstrap', HTTPRequest(self.args.url + "/", request_timeout=120))
+        if response is None:
+            return None
+        guid, bokeh_session_id, bokeh_url = parse_bootstrap_page(response.body.decode())
+        self.stats_urls[bokeh_url.rsplit('/', 1)[0]] = True
+        return guid, bokeh_session_id, bokeh_url
+
+    async def click(self, guid):
+        body = urllib.parse.urlencode({'session-uid': guid})
+        await self.timed_fetch('click', HTTPRequest(self.args.url + "/click", method='POST', body=body,
+                                                    headers={'Origin': self.args.url}))
+
+    async def exit(self, guid):
+        body = urllib.parse.urlencode({'session-uid': guid})
+        await self.timed_fetch('exit', HTTPRequest(self.args.url + "/exit", method='POST', body=body,
+                                                   headers={'Origin': self.args.url}))
+
+    async def sleep_until(self, deadline):
+        await asyncio.sleep(max(0.0, min(deadline, self.end_time) - time.perf_counter()))
+
+    # Plays the part of the session's Bokeh document (see bokeh_app.py)
+    async def run_simulated_session(self, trace):
+        bootstrapped = await self.bootstrap()
+        if bootstrapped is None:
+            return
+        guid = bootstrapped[0]
+
+        poll_conn = await websocket_connect(get_ws_url(self.args.url, "/ws"))
+        city_conn = await websocket_connect(get_ws_url(self.args.url, "/get_cities"))
+
+        async def poll():
+            while time.perf_counter() < self.end_time:
+                start = time.perf_counter()
+                await poll_conn.write_message(pickle.dumps({'session_guid': guid}), binary=True)
+                message = await poll_conn.read_message()
+                if message is None:
+                    self.recorder.record_error('poll')
+                    return
+                self.recorder.record('poll', time.perf_counter() - start)
+                await self.sleep_until(start + self.args.poll_interval)
+
+        # The rate versions that the session has, as a Bokeh session keeps them
+        known_versions = np.zeros(len(self.city_store), dtype=np.int64)
+
+        async def pan():
+            request_id = 0
+            while time.perf_counter() < self.end_time:
+                start = time.perf_counter()
+                request_id += 1
+                request = get_city_request(self.city_store, trace.lon_wgs, trace.lat_wgs, trace.aspect_ratio,
+                                           trace.zoom, request_id, guid, known_versions)
+                await city_conn.write_message(pickle.dumps(request), binary=True)
+
+                # The cities come in chunks (only the ones with a newer rate version than the session's), and at
+                # least one message is sent
+                received = 0
+                while True:
+                    message = await city_conn.read_message()
+                    if message is None:
+                        self.recorder.record_error('cities_complete')
+                        return
+                    update = pickle.loads(message)
+                    if received == 0:
+                        self.recorder.record('cities_first_chunk', time.perf_counter() - start)
+                    received += 1
+                    known_versions[update.indices] = np.maximum(known_versions[update.indices], update.versions)
+                    if update.remaining == 0:
+                        break
+                self.recorder.record('cities_complete', time.perf_counter() - start)
+
+                await self.sleep_until(start + jittered(trace.rng, self.args.pan_interval))
+                trace.step()
+
+        await asyncio.gather(poll(), pan(), self.click_until_end(guid, trace.rng))
+        poll_conn.close()
+        city_conn.close()
+        await self.exit(guid)
+
+    # Connects to the session's Bokeh document like a browser would, and drives it with pan/zoom views
+    async def run_bokeh_session(self, trace):
+        bootstrapped = await self.bootstrap()
+        if bootstrapped is None:
+            return
+        guid, bokeh_session_id, bokeh_url = bootstrapped
+
+        clicks = asyncio.get_running_loop().create_task(
+            self.click_until_end(guid, np.random.default_rng(trace.rng.integers(2 ** 32))))
+        await self.run_bokeh_client(trace, bokeh_session_id, bokeh_url)
+        await clicks
+        await self.exit(guid)
+
+    # The client speaks Bokeh's protocol (bokeh.protocol) on the generator's event loop: it pulls the document, applies
+    # the server's patches to it, and pans like BokehJS does, with a patch of the plot's new ranges and a RangesUpdate
+    # event. bokeh.client is not used, since it only receives patches while it blocks a thread in its own loop, and
+    # can't send UI events.
+    async def run_bokeh_client(self, trace, bokeh_session_id, bokeh_url):
+        recorder = self.recorder
+        protocol = Protocol()
+        receiver = Receiver(protocol)
+        start = time.perf_counter()
+        try:
+            connection = await websocket_connect(HTTPRequest(get_ws_url(bokeh_url, "/ws")),
+                                                 subprotocols=["bokeh", generate_jwt_token(bokeh_session_id)],
+                                                 max_message_size=BOKEH_MAX_MESSAGE_SIZE)
+        except Exception as e:
+            logging.warning("Bokeh session " + bokeh_session_id + " failed: " + str(e))
+            recorder.record_error('bokeh_connect')
+            return
+
+        # A message comes in several fragments (header, metadata, content and buffers)
+        async def receive():
+            while True:
+                fragment = await connection.read_message()
+                if fragment is None:
+                    return None
+                message = await receiver.consume(fragment)
+                if message is not None:
+                    return message
+
+        # The messages sent have no buffers
+        async def send(message):
+            for fragment in (message.header_json, message.metadata_json, message.content_json):
+                await connection.write_message(fragment)
+
+        doc = Document()
+        message = await receive()
+        if message is not None and message.msgtype == 'ACK':
+            request = protocol.create('PULL-DOC-REQ')
+            await send(request)
+            while message is not None and not (message.msgtype == 'PULL-DOC-REPLY' and
+                                               message.header.get('reqid') == request.header['msgid']):
+                message = await receive()
+        if message is None or message.msgtype != 'PULL-DOC-REPLY':
+            logging.warning("Bokeh session " + bokeh_session_id + " closed before its document was pulled")
+            recorder.record_error('bokeh_connect')
+            connection.close()
+            return
+        message.push_to_document(doc)
+        recorder.record('bokeh_connect', time.perf_counter() - start)
+
+        async def apply_patches():
+            while True:
+                patch = await receive()
+                if patch is None:
+                    return
+                if patch.msgtype == 'PATCH-DOC':
+                    patch.apply_to_document(doc, connection)
+
+        patches = asyncio.get_running_loop().create_task(apply_patches())
+
+        view = {'start': None, 'painted': False, 'complete': None}
+        table_source = None
+        changes = []
+
+        # The client's own changes are sent to the server. Of the server's, the map's sources are painted first
+        # (coarse, or streamed cells), and the table's source is set once the render is complete.
+        def on_change(event):
+            if event.setter is None:
+                changes.append(event)
+            elif view['start'] is None:
+                return
+            elif not isinstance(event, (ModelChangedEvent, ColumnDataChangedEvent, ColumnsStreamedEvent)):
+                return
+            elif isinstance(event, ColumnsStreamedEvent) or event.attr == 'data':
+                if event.model is table_source:
+                    recorder.record('render_complete', time.perf_counter() - view['start'])
+                    view['start'] = None
+                    view['complete'].set()
+                elif not view['painted']:
+                    recorder.record('render_first_paint', time.perf_counter() - view['start'])
+                    view['painted'] = True
+
+        # The document's roots are added once the session's map is ready
+        while (doc.select_one({'type': DataTable}) is None and not patches.done() and
+               time.perf_counter() < self.end_time):
+            await asyncio.sleep(0.1)
+        if doc.select_one({'type': DataTable}) is None:
+            recorder.record_error('bokeh_connect')
+        else:
+            plot = doc.select_one({'type': Plot})
+            table_source = doc.select_one({'type': DataTable}).source
+            doc.on_change(on_change)
+
+            while time.perf_counter() < self.end_time and not patches.done():
+                trace.step()
+                upper_left_merc, lower_right_merc = trace.get_frame_merc()
+                view.update(start=time.perf_counter(), painted=False, complete=asyncio.Event())
+                interval_end = view['start'] + jittered(trace.rng, self.args.pan_interval)
+                plot.x_range.update(start=upper_left_merc.x, end=lower_right_merc.x)
+                plot.y_range.update(start=upper_left_merc.y, end=lower_right_merc.y)
+                changes.append(MessageSentEvent(doc, 'bokeh_event', UIEventMessage(RangesUpdate(
+                    plot, x0=upper_left_merc.x, x1=lower_right_merc.x, y0=upper_left_merc.y, y1=lower_right_merc.y))))
+                await send(protocol.create('PATCH-DOC', changes))
+                changes.clear()
+                try:
+                    await asyncio.wait_for(view['complete'].wait(), timeout=max(0.0, self.end_time - view['start']))
+                except asyncio.TimeoutError:
+                    recorder.record_error('render_complete')
+                await self.sleep_until(interval_end)
+
+        connection.close()
+        await patches
+
+    async def click_until_end(self, guid, rng):
+        while True:
+            await self.sleep_until(time.perf_counter() + jittered(rng, self.args.click_interval))
+            if time.perf_counter() >= self.end_time:
+                return
+            await self.click(guid)
+
+    async def sample_servers(self):
+        while True:
+            for url in list(self.stats_urls):
+                try:
+                    response = await self.http_client.fetch(url + "/stats", request_timeout=10)
+                except Exception as e:
+                    logging.warning("No stats from " + url + ": " + str(e))
+                    continue
+                self.server_samples.setdefault(url, []).append(json.loads(response.body))
+            await asyncio.sleep(self.args.stats_interval)
+
+    def summarize_servers(self, baseline):
+        servers = dict()
+        for url, samples in self.server_samples.items():
+            rss = [sample['rss_bytes'] for sample in samples]
+            lag_p99 = [sample['loop_lag']['p99'] for sample in samples if sample['loop_lag']['samples'] > 0]
+            lag_max = [sample['loop_lag']['max'] for sample in samples if sample['loop_lag']['samples'] > 0]
+            servers[url] = {
+                'rss_baseline': baseline.get(url, rss[0]),
+                'rss_peak': max(rss),
+                'loop_lag_p99': max(lag_p99, default=None),
+                'loop_lag_max': max(lag_max, default=None),
+                'last': samples[-1]
+            }
+        return servers
+
+    async def run(self):
+        generator_lag = LoopLagMonitor(window=100000)
+        generator_lag.start()
+
+        # The Bokeh workers' /stats are only known once a session has been placed on them
+        for url in self.args.worker_url:
+            self.stats_urls[url] = True
+        baseline = dict()
+        for url in list(self.stats_urls):
+            try:
+                response = await self.http_client.fetch(url + "/stats", request_timeout=10)
+                baseline[url] = json.loads(response.body)['rss_bytes']
+            except Exception as e:
+                logging.warning("No stats from " + url + ": " + str(e))
+
+        cfg = self.cfg
+        start = time.perf_counter()
+        self.end_time = start + self.args.ramp_up + self.args.duration
+        sampler = asyncio.get_running_loop().create_task(self.sample_servers())
+
+        sessions = []
+        for i in range(self.args.sessions):
+            await asyncio.sleep(max(0.0, start + i * self.args.ramp_up / self.args.sessions - time.perf_counter()))
+            trace = ViewportTrace(np.random.default_rng(self.rng.integers(2 ** 32)), cfg["initial_lon_wgs"],
+                                  cfg["initial_lat_wgs"], cfg["aspect_ratio"], cfg["zoom"])
+            if i < self.args.bokeh_clients:
+                sessions.append(self.run_bokeh_session(trace))
+            else:
+                sessions.append(self.run_simulated_session(trace))
+            sessions[-1] = asyncio.get_running_loop().create_task(sessions[-1])
+
+        results = await asyncio.gather(*sessions, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.warning("Session failed: " + repr(result))
+        elapsed = time.perf_counter() - start
+
+        sampler.cancel()
+        servers = self.summarize_servers(baseline)
+        rss_growth = sum(max(0, server['rss_peak'] - server['rss_baseline']) for server in servers.values())
+
+        return {
+            'label': self.args.label,
+            'started': datetime.utcnow().isoformat(),
+            'parameters': {key: value for key, value in vars(self.args).items() if key not in ('compare', 'output')},
+            'elapsed': elapsed,
+            'failed_sessions': sum(isinstance(result, Exception) for result in results),
+            'latency': self.recorder.summary(elapsed),
+            'generator_loop_lag': generator_lag.summary(),
+            'servers': servers,
+            'memory_per_session': rss_growth / max(1, self.args.sessions)
+        }
+
+
+def print_summary(results):
+    print("Load test '" + str(results['label']) + "': " + str(results['parameters']['sessions']) + " sessions, " +
+          format(results['elapsed'], '.1f') + "s")
+    print(format('request', '<20') + ''.join(format(column, '>10') for column in
+                                             ('count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')))
+    for kind, entry in results['latency'].items():
+        row = [str(entry['count']), str(entry['errors']), format(entry['throughput'], '.2f')]
+        row += [format(1000 * entry[key], '.1f') if key in entry else '-' for key in ('p50', 'p95', 'p99')]
+        print(format(kind, '<20') + ''.join(format(value, '>10') for value in row))
+
+    lag = results['generator_loop_lag']
+    if lag['samples'] > 0:
+        print("Generator loop lag: p99 " + format(1000 * lag['p99'], '.1f') + " ms, max " +
+              format(1000 * lag['max'], '.1f') + " ms")
+    for url, server in results['servers'].items():
+        lag_p99 = '-' if server['loop_lag_p99'] is None else format(1000 * server['loop_lag_p99'], '.1f')
+        lag_max = '-' if server['loop_lag_max'] is None else format(1000 * server['loop_lag_max'], '.1f')
+        print(url + ": loop lag p99 " + lag_p99 + " ms, max " + lag_max + " ms, RSS " +
+              format(server['rss_baseline'] / 2 ** 20, '.0f') + " -> " + format(server['rss_peak'] / 2 ** 20, '.0f') +
+              " MiB")
+    print("Memory per session: " + format(results['memory_per_session'] / 2 ** 20, '.2f') + " MiB")
+
+
+def compare_results(first_path, second_path):
+    with open(first_path) as first_file, open(second_path) as second_file:
+        first = json.load(first_file)
+        second = json.load(second_file)
+
+    print("Comparing '" + str(first['label']) + "' (" + first_path + ") with '" + str(second['label']) + "' (" +
+          second_path + ")")
+    print(format('request', '<20') + ''.join(format(column, '>26') for column in ('p50 ms', 'p95 ms', 'p99 ms')))
+    for kind in sorted(set(first['latency']) | set(second['latency'])):
+        row = []
+        for key in ('p50', 'p95', 'p99'):
+            before = first['latency'].get(kind, {}).get(key)
+            after = second['latency'].get(kind, {}).get(key)
+            if before is None or after is None:
+                row.append('-')
+            else:
+                change = '' if before == 0 else ' (' + format(100 * (after - before) / before, '+.0f') + '%)'
+                row.append(format(1000 * before, '.1f') + ' -> ' + format(1000 * after, '.1f') + change)
+        print(format(kind, '<20') + ''.join(format(value, '>26') for value in row))
+    print("Memory per session: " + format(first['memory_per_session'] / 2 ** 20, '.2f') + " -> " +
+          format(second['memory_per_session'] / 2 ** 20, '.2f') + " MiB")
+
+
+def save_results(results, output):
+    os.makedirs(output, exist_ok=True)
+    filename = datetime.utcnow().strftime('%Y%m%d%H%M%S') + '-' + re.sub(r'[^\w.-]', '_', results['label']) + '.json'
+    path = os.path.join(output, filename)
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test a running MasonDixon server")
+    parser.add_argument('--url', default='http://localhost:8888', help="the Tornado server")
+    parser.add_argument('--worker-url', action='append', default=[],
+                        help="a Bokeh worker (http://host:port) to sample from the start, not only once a session is "
+                             "placed on it (repeatable)")
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--bokeh-clients', type=int, default=0,
+                        help="how many of the sessions connect to their Bokeh session")
+    parser.add_argument('--duration', type=float, default=60, help="seconds, after the ramp-up")
+    parser.add_argument('--ramp-up', type=float, default=10, help="seconds over which the sessions are started")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--pan-interval', type=float, default=3.0, help="mean seconds between pans/zooms")
+    parser.add_argument('--click-interval', type=float, default=20.0, help="mean seconds between clicks")
+    parser.add_argument('--stats-interval', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--label', default='run')
+    parser.add_argument('--output', default='load_test_results')
+    parser.add_argument('--compare', nargs=2, metavar=('FIRST', 'SECOND'), help="compare two saved results")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        with open(args.config, "r") as ymlfile:
+            cfg = yaml.safe_load(ymlfile)
+
+        # The requests are computed from the same city table as the Bokeh sessions use
+        data_prov = load_data_provider(lambda coords: np.random.uniform(500, 2000), cfg.get("startup_snapshot", False))
+        load_test = LoadTest(args, cfg, data_prov.city_store)
+        results = asyncio.run(load_test.run())
+        print_summary(results)
+        print("Saved to " + save_results(results, args.output))
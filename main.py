@@ -1,117 +1,248 @@
 # coding=utf-8
+from startup_timing import StartupTimer
+startup_timer = StartupTimer()
+
 import logging
-import math
+import multiprocessing
 import os.path
 import pickle
+import time
 import uuid
+import zlib
 import asyncio
-import nest_asyncio
 import numpy as np
 from datetime import datetime
 import yaml
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.websocket
 import tornado.web
 import tornado.options
 
-from bokeh.client import pull_session
-from bokeh.server.server import Server
-from bokeh.embed import server_session
-
-from mason_dixon.data_provider import DataProvider
-from mason_dixon.geodata_processing_utility import load_regions_into_json, load_cities_into_json
-from bokeh_app import bokeh_app
-from server_side_utility import get_cached_indices_for_frame, get_city_info, get_new_city_cache_wgs, request_city_data_from_database
+from mason_dixon.data_provider import load_data_provider
+from mason_dixon.grid_binning import GRID_ENGINES
+from mason_dixon.session_snapshot import is_valid_key
+from server_stats import LoopLagMonitor, StatsHandler, get_process_stats
+from server_side_utility import AdaptiveChunkSize, CityUpdateMessage, get_cached_indices_for_frame, \
+    prioritize_city_indices, request_city_data_from_database
+from rate_feed import RateChangeFeed
+from sampling_profiler import ProfileHandler, profiler
+from warmup import create_warmup_job, format_viewport_log
+from session_pool import BokehSessionKeeper, BokehSessionPool, create_bokeh_session
+from session_store import create_session_store
+
+# Bokeh is only imported when the first session is created (the Bokeh app itself runs in bokeh_worker.py), and
+# the GeoJSON build only when there is no usable DataProvider snapshot.
+startup_timer.mark("imports")
 
 tornado.options.define("port", default=8888, help="run on the given port", type=int)
 
-data_prov = None
-city_array = None
+city_store = None
+
+# Holds the state of every session (see session_store.py), so that with several Tornado workers any of them can
+# serve any session's traffic:
+#   plotting state - to be serialized and sent to bokeh server for synchronization
+#   city rates - to optimize some API calls
+session_store = None
+
+RENDER_ENGINES = ('tessellation',) + GRID_ENGINES
 
-# There are three caches
-plotting_caches = dict()  # to be serialized and sent to bokeh server for synchronization
-city_caches = dict()  # to optimize some API calls
-local_caches = dict()  # to optimize some geospatial functions
+# Names the browser's session snapshot (see session_snapshot.py)
+SNAPSHOT_COOKIE = 'mason_dixon_snapshot'
+
+# The versions of the city rates (see rate_feed.py, kept in the session store so that every Tornado worker has the
+# same ones), and the stubbed rate API's current values
+rate_feed = None
+upstream_rates = None
+
+# The sessions that are ready for new visitors (see session_pool.py), if session_pool_size is set
+session_pool = None
+# Fetches the rates of the hot viewports (see warmup.py), if there are any
+warmup_job = None
+
+stub_rate_latency = 0
+loop_lag_monitor = LoopLagMonitor()
 
 # Static Functions
 
 
-# This would be replaced with an API call if this is actually deployed. Now, it just pulls from the cache and adds noise
+# This would be replaced with an API call if this is actually deployed. Now, it just pulls from the stub's values
 # It returns a future (even though nothing is async about it) because it is a placeholder for a function or
 # lambda expression containing an API call
+# With a stub_rate_latency (for load tests), each call also waits for an exponentially distributed time with that mean,
+# like a remote API would.
 async def rate_function(city):
+    if stub_rate_latency > 0:
+        await asyncio.sleep(np.random.exponential(stub_rate_latency))
     future = asyncio.Future()
-    base_rate = city_array.loc[city['index'], 'rate']
-    noise = np.random.uniform(-200, 700)
-    future.set_result(base_rate + noise)
+    future.set_result(upstream_rates[city['index']])
     return await future
 
 
+def get_stub_rates(indices):
+    return city_store.rate[indices] + np.random.uniform(-200, 700, len(indices))
+
+
+# Stands in for the rate source's change feed: the rates of a random stub_rate_change_fraction of the cities change,
+# and the feed is told which ones. The new rates go through the feed, so that the stub of every worker has them.
+def publish_stub_rate_changes():
+    count = int(round(cfg.get("stub_rate_change_fraction", 0.05) * len(upstream_rates)))
+    changed = np.random.choice(len(upstream_rates), count, replace=False)
+    rate_feed.publish(changed, get_stub_rates(changed))
+
+
+def apply_stub_rate_changes(indices, rates):
+    upstream_rates[indices] = rates
+
+
 def mark_session_for_updates(session_uid):
     logging.debug("Updating on the next cycle.")
-    plotting_caches[session_uid]['update_counter'] += 1
-    plotting_caches[session_uid]['needs_update'] = True
+    try:
+        session_store.mark_for_updates(session_uid)
+    except KeyError:
+        logging.debug("Session " + session_uid + " is closed")
 
 
 def mark_session_for_closure(session_uid):
     logging.info("Closing session for " + session_uid)
-    plotting_caches[session_uid]['session_open'] = False
-
+    session_store.update_plotting_state(session_uid, {'session_open': False})
 
-# Helper classes
 
-class CityUpdateMessage:
-    def __init__(self, indices, city_cache, request_id, update_counter):
-        cities = [city_cache[i] for i in indices]
-        logging.debug('Request_id = ' + str(request_id) + ', Update_counter = ' + str(update_counter))
-        city_info = [get_city_info(city) for city in cities]
-        self.city_list = city_info
-        self.request_id = request_id
+# The Bokeh session sees the closure on its next poll, and then has the session deleted (see BokehWebSocketHandler).
+# If there is no Bokeh session to do that (e.g. its worker is gone), the session is deleted after session_close_seconds.
+def close_session(session_uid):
+    try:
+        mark_session_for_closure(session_uid)
+    except KeyError:
+        return
+    tornado.ioloop.IOLoop.current().call_later(cfg.get("session_close_seconds", 60), session_store.delete_session,
+                                               session_uid)
+
+
+# Sessions are spread over the Bokeh workers by a hash of their uid, so every Tornado worker makes the same choice
+def place_session(session_uid):
+    paths = cfg["bokeh_server_paths"]
+    return paths[zlib.crc32(session_uid.encode('ascii')) % len(paths)]
+
+
+def get_stats():
+    stats = get_process_stats(loop_lag_monitor)
+    stats['tornado_worker'] = tornado.process.task_id()
+    stats['rate_feed'] = rate_feed.stats()
+    if session_pool is not None:
+        stats['session_pool'] = session_pool.stats()
+    if warmup_job is not None:
+        stats['warmup'] = warmup_job.stats()
+    return stats
+
+
+# Fetches the rates of the cities of the hot viewports (and around them, like a session does), a chunk at a time, so
+# that the sessions' requests are not held up. Returns the number of cities whose rates were fetched.
+async def warm_rates(viewports):
+    warmed = 0
+    for upper_left_wgs, lower_right_wgs in viewports:
+        zoom = abs(lower_right_wgs[0] - upper_left_wgs[0])
+        aspect_ratio = zoom / max(abs(upper_left_wgs[1] - lower_right_wgs[1]), 1e-9)
+        indices = np.asarray(get_cached_indices_for_frame(city_store, upper_left_wgs[0], upper_left_wgs[1],
+                                                          aspect_ratio, zoom), dtype=np.int64)
+        stale = indices[rate_feed.cached_versions[indices] < rate_feed.get_versions(indices)]
+        for start in range(0, len(stale), chunk_size):
+            await rate_feed.get_rates(stale[start:start + chunk_size], rate_function)
+            await asyncio.sleep(0.01)
+        warmed += len(stale)
+    return warmed
+
+
+# The Bokeh workers that render a session, or all of them (for the admin profiler)
+def get_render_worker_paths(session_uid=None):
+    if session_uid is None:
+        return list(cfg["bokeh_server_paths"])
+    if not session_store.has_session(session_uid):
+        return []
+    path = session_store.get_plotting_state(session_uid).get('bokeh_server_path')
+    return [] if path is None else [path]
 
 
 # Tornado handlers
 
+# Creates a session at the default viewport: its state here, and its Bokeh document on its worker. Returns its uid,
+# Bokeh worker path and Bokeh session id. With a snapshot_key, the Bokeh session starts from that snapshot (if its
+# worker has it); the session is placed by the key, so that a browser keeps coming back to the same worker.
+async def create_session(engine=None, snapshot_key=None):
+    uid = str(uuid.uuid4())
+    logging.info('Session = ' + uid)
+
+    lon_wgs = cfg["initial_lon_wgs"]
+    lat_wgs = cfg["initial_lat_wgs"]
+    aspect_ratio = cfg["aspect_ratio"]
+    zoom = cfg["zoom"]
+
+    plotting_state = {
+        'needs_update': False,
+        'update_counter': 1,
+        'session_open': True
+    }
+    session_store.create_session(uid, plotting_state)
+
+    indices = get_cached_indices_for_frame(city_store, lon_wgs, lat_wgs, aspect_ratio, zoom)
+    tornado.ioloop.IOLoop.current().spawn_callback(
+        request_city_data_from_database, session_store, uid, city_store, indices, rate_feed, rate_function)
+
+    bokeh_server_path = place_session(snapshot_key or uid)
+    logging.debug("Bokeh worker for session " + uid + ": " + bokeh_server_path)
+
+    args = {'guid': uid}
+    if engine is not None:
+        args['engine'] = engine
+    if snapshot_key is not None:
+        args['snapshot'] = snapshot_key
+    try:
+        bokeh_session_id = await create_bokeh_session(bokeh_server_path, args)
+    except Exception:
+        close_session(uid)
+        raise
+    logging.debug("New Bokeh session id: " + bokeh_session_id)
+    session_store.update_plotting_state(uid, {'bokeh_session_id': bokeh_session_id,
+                                              'bokeh_server_path': bokeh_server_path})
+    return uid, bokeh_server_path, bokeh_session_id
+
+
 class BaseHandler(tornado.web.RequestHandler):
     def data_received(self, chunk):
         pass
 
-    def get(self):
-        uid = str(uuid.uuid4())
-        logging.info('Session = ' + uid)
-        plotting_caches[uid] = {
-            'needs_update': False,
-            'update_counter': 1,
-            'session_open': True
-        }
-        city_caches[uid] = get_new_city_cache_wgs(city_array)
-
-        lon_wgs = cfg["initial_lon_wgs"]
-        lat_wgs = cfg["initial_lat_wgs"]
-        aspect_ratio = cfg["aspect_ratio"]
-        zoom = cfg["zoom"]
-
-        indices = get_cached_indices_for_frame(city_caches[uid], lon_wgs, lat_wgs, aspect_ratio, zoom)
-        request_city_data_from_database(
-            city_caches[uid], indices, rate_function, plotting_caches[uid]['update_counter'])
-
-        local_caches[uid] = {
-            'upper_left_lon': lon_wgs,
-            'upper_left_lat': lat_wgs,
-            'aspect_ratio': aspect_ratio,
-            'zoom': zoom
-        }
+    async def get(self):
+        # The rendering engine can be chosen per session (e.g. /?engine=hex), see render_engine in config.yml
+        engine = self.get_argument("engine", None)
+        if engine is not None and engine not in RENDER_ENGINES:
+            raise tornado.web.HTTPError(400, "Unknown rendering engine: " + engine)
+
+        # A browser that has been here before resumes from its snapshot. Otherwise, the uid of its first session
+        # becomes its snapshot key. The pooled sessions use the default engine, and have no snapshot.
+        snapshot_key = self.get_cookie(SNAPSHOT_COOKIE)
+        if not is_valid_key(snapshot_key):
+            snapshot_key = None
+        pooled = None
+        if session_pool is not None and engine is None and snapshot_key is None:
+            pooled = session_pool.claim()
+        if pooled is not None:
+            uid, bokeh_server_path, bokeh_session_id = pooled.uid, pooled.bokeh_server_path, pooled.bokeh_session_id
+        else:
+            uid, bokeh_server_path, bokeh_session_id = await create_session(engine, snapshot_key)
+            keeper = BokehSessionKeeper(bokeh_server_path, bokeh_session_id)
+            await keeper.connect()
+            keeper.close_later(cfg.get("session_handoff_seconds", 30))
         logging.debug("GUID/Cookie = " + uid)
+        if snapshot_key is None:
+            self.set_cookie(SNAPSHOT_COOKIE, uid, expires_days=cfg.get("session_snapshot_days", 30), httponly=True)
 
-        ioloop = tornado.ioloop.IOLoop.current()
+        from bokeh.embed import server_session
 
-        args = {'guid': uid}
-        with pull_session(url=f"http://{cfg['bokeh_server_path']}/bokeh_app", io_loop=ioloop, arguments=args) as mysession:
-            logging.debug("New Bokeh session id: " + mysession.id)
-            plotting_caches[uid]['bokeh_session_id'] = mysession.id
-            script = server_session(session_id=mysession.id, url=f"http://{cfg['bokeh_server_path']}/bokeh_app")
-            self.render("bootstrap_page.html", scr=script, guid=uid, username='', api_call_successful=False, api_call_data=None, distance=None, airport_code=None)
+        script = server_session(session_id=bokeh_session_id, url=f"http://{bokeh_server_path}/bokeh_app")
+        self.render("bootstrap_page.html", scr=script, guid=uid, username='', api_call_successful=False, api_call_data=None, distance=None, airport_code=None)
 
 
 class ExitHandler(tornado.web.RequestHandler):
@@ -130,7 +261,7 @@ class ExitHandler(tornado.web.RequestHandler):
     # Set flag so that the Bokeh server sees the closure on the next poll for data, and can properly clean up.
     def post(self):
         session_uid = self.get_argument("session-uid")
-        mark_session_for_closure(session_uid)
+        close_session(session_uid)
 
 
 class ButtonHandler(tornado.web.RequestHandler):
@@ -144,15 +275,21 @@ class ButtonHandler(tornado.web.RequestHandler):
         self.set_header("Access-Control-Allow-Headers", "X-Requested-With,_xsrf,Content-Type,Authorization")
         self.set_header("Access-Control-Allow-Methods", "PUT,GET,POST,OPTIONS")
 
+    # In the demo, "Update Data" changes some of the rates upstream. The session then only refetches those.
+    # This only stands in for the rate source's change feed: any visitor's click changes the rates of a fraction of
+    # all of the cities (stub_rate_change_fraction), for every session. With a real rate API, the changes come from its
+    # feed, and a click only marks the session for updates.
     def get(self):
         # TODO: Fail gracefully
         session_uid = self.get_argument("session-uid")
+        publish_stub_rate_changes()
         mark_session_for_updates(session_uid)
 
     def post(self):
         logging.debug("Updating on the next cycle.")
         session_uid = self.get_argument("session-uid")
-        print(session_uid)
+        logging.debug("Update requested by session " + session_uid)
+        publish_stub_rate_changes()
         mark_session_for_updates(session_uid)
 
 
@@ -165,15 +302,24 @@ class BokehWebSocketHandler(tornado.websocket.WebSocketHandler):
 
     def on_message(self, message):
         decoded = pickle.loads(message)
-        current_state = plotting_caches[decoded['session_guid']]
+        uid = decoded['session_guid']
+        # The Bokeh session has closed, so nothing polls for (or fetches the rates of) the session anymore
+        if decoded.get('session_closed'):
+            logging.info("Deleting session " + uid)
+            session_store.delete_session(uid)
+            return
+
+        try:
+            current_state = session_store.consume_plotting_state(uid)
+        except KeyError:
+            # Deleted after session_close_seconds, before the Bokeh session saw the closure
+            current_state = {'needs_update': False, 'session_open': False}
         self.write_message(pickle.dumps(current_state), binary=True)
         if current_state['needs_update']:
             logging.debug('Turning off updates')
         else:
             logging.debug('No update required')
 
-        plotting_caches[decoded['session_guid']]['needs_update'] = False
-
     def on_close(self):
         logging.info("WebSocket closed")
 
@@ -182,59 +328,96 @@ class CityUpdateWebSocketHandler(tornado.websocket.WebSocketHandler):
     def data_received(self, chunk):
         pass
 
+    # One connection per Bokeh session. Its requests are answered one at a time (a newer request supersedes the
+    # rest of an older one), and each chunk is only sent once the previous one has been flushed. A request can carry
+    # the rate versions that the Bokeh session already has, and then only the cities with a newer version are sent.
     def open(self):
         logging.info("WebSocket opened")
+        self.latest_request_id = 0
+        self.send_lock = asyncio.Lock()
+        self.chunk_size = AdaptiveChunkSize(chunk_size, cfg.get("chunk_size_min", 10),
+                                            cfg.get("chunk_size_max", 400), cfg.get("chunk_target_latency", 0.05))
 
     def on_message(self, city_update_request):
         message_decoded = pickle.loads(city_update_request)
-        number_of_chunks = math.ceil(len(message_decoded['indices']) / chunk_size)
-        logging.debug("Number of chunks = " + str(number_of_chunks))
-        indices = list(message_decoded['indices'])
-        uid = message_decoded['session_guid']
-        update_counter = plotting_caches[uid]['update_counter']
-
-        city_cache = city_caches[uid]
-
-        chunks = [range(i * chunk_size, min((i + 1) * chunk_size, len(indices))) for i in range(number_of_chunks)]
+        request_id = message_decoded['request_id']
+        self.latest_request_id = max(self.latest_request_id, request_id)
 
-        async def retrieve(chunk):
-            ran = [indices[x] for x in chunk]
-            await request_city_data_from_database(city_cache, ran, rate_function, update_counter)
-            retrieved_city_data = CityUpdateMessage(ran, city_cache, message_decoded['request_id'], plotting_caches[uid]['update_counter'])
-            await self.write_message(pickle.dumps(retrieved_city_data), binary=True)
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.send_city_updates(message_decoded, request_id))
 
-        async def pull_data_and_update_rates():
-            tasks = [retrieve(chunk) for chunk in chunks]
-            await asyncio.gather(*tasks)
+    # The whole request is followed by the sampling profiler if a profile of the session's city updates is running
+    async def send_city_updates(self, message_decoded, request_id):
+        token = profiler.begin('city_updates', message_decoded['session_guid'])
+        try:
+            await self._send_city_updates(message_decoded, request_id)
+        finally:
+            profiler.end(token)
 
-        loop = asyncio.get_running_loop()
-        loop.create_task(pull_data_and_update_rates())
+    async def _send_city_updates(self, message_decoded, request_id):
+        uid = message_decoded['session_guid']
+        # Read back by the warm-up job after a restart
+        if message_decoded.get('upper_left_wgs') is not None:
+            logging.info(format_viewport_log(message_decoded['upper_left_wgs'], message_decoded['lower_right_wgs']))
+        async with self.send_lock:
+            indices = np.asarray(message_decoded['indices'], dtype=np.int64)
+            if message_decoded.get('versions') is not None:
+                indices = indices[rate_feed.get_versions(indices) > np.asarray(message_decoded['versions'])]
+            indices = prioritize_city_indices(city_store, indices, message_decoded.get('upper_left_wgs'),
+                                              message_decoded.get('lower_right_wgs'))
+
+            sent = 0
+            # At least one message is sent (even for no cities), since the Bokeh session waits for it
+            while sent < len(indices) or sent == 0:
+                if request_id < self.latest_request_id:
+                    logging.debug("Dropping the rest of superseded request " + str(request_id))
+                    return
+
+                start = time.perf_counter()
+                ran = indices[sent:sent + self.chunk_size.size]
+                try:
+                    city_rates = await request_city_data_from_database(session_store, uid, city_store, ran, rate_feed,
+                                                                       rate_function)
+                except KeyError:
+                    logging.debug("Session " + uid + " is closed")
+                    return
+                retrieved_city_data = CityUpdateMessage(ran, city_rates, request_id,
+                                                        max(0, len(indices) - sent - len(ran)))
+                try:
+                    await self.write_message(pickle.dumps(retrieved_city_data), binary=True)
+                except tornado.websocket.WebSocketClosedError:
+                    return
+
+                self.chunk_size.record(len(ran), time.perf_counter() - start)
+                sent += max(1, len(ran))
 
     def on_close(self):
         logging.info("WebSocket closed")
 
 
 class TornadoApplication(tornado.web.Application):
-    def __init__(self):
+    def __init__(self, debug=True):
         handlers = [
             (r"/", BaseHandler),
             (r"/exit", ExitHandler),
             (r"/click", ButtonHandler),
             (r"/ws", BokehWebSocketHandler),
-            (r"/get_cities", CityUpdateWebSocketHandler)
+            (r"/get_cities", CityUpdateWebSocketHandler),
+            (r"/stats", StatsHandler, dict(get_stats=get_stats)),
+            (r"/admin/profile", ProfileHandler, dict(cfg=cfg, get_remote_paths=get_render_worker_paths,
+                                                     remote_kinds=('render',)))
         ]
         settings = dict(
                 template_path=os.path.join(os.path.dirname(__file__), "templates"),
                 static_path=os.path.join(os.path.dirname(__file__), "static"),
                 #xsrf_cookies=True,
                 #cookie_secret="YOUR SECRET HERE",
-                debug=True
+                debug=debug
         )
         super().__init__(handlers, **settings)
 
 
 if __name__ == '__main__':
-    nest_asyncio.apply()
     log_filename = 'MasonDixon-' + datetime.utcnow().strftime('%Y%m%d%H%M%S') + '.log'
     log_filepath = os.path.join('logs', log_filename)
     logging.basicConfig(filename=log_filepath, encoding='utf-8', level=logging.INFO)
@@ -245,35 +428,73 @@ if __name__ == '__main__':
 
     # Updates with a large number of cities are broken up into blocks
     chunk_size = cfg["chunk_size"]
+    stub_rate_latency = cfg.get("stub_rate_latency", 0)
+    startup_timer.mark("configuration")
 
-    logging.info("Creating GeoJSON data")
-    load_regions_into_json(False)
-    load_cities_into_json(False)
-    logging.info("Data loaded into GeoJSONs")
-
-    logging.info("Loading data from GeoJSONs")
     # Starting with random values
-    data_prov = DataProvider(lambda coords: np.random.uniform(500, 2000))
-    logging.info("Data fully loaded")
+    # Only the city store (see mapped_cities.py) is used here. Loading the whole DataProvider also builds its snapshot
+    # and the city store for the Bokeh workers, which are started afterwards.
+    city_store = load_data_provider(lambda coords: np.random.uniform(500, 2000),
+                                    cfg.get("startup_snapshot", False), startup_timer.mark).city_store
 
     # TODO: This should be replaced with an API call
     logging.info("Populating starting values. While testing, only random numbers are being used.")
-    city_array = data_prov.get_cities_wgs()
+    upstream_rates = get_stub_rates(np.arange(len(city_store)))
+    startup_timer.mark("starting values")
+
+    # The Bokeh app runs in separate worker processes, so that rendering never competes with the HTTP and websocket
+    # traffic handled here. They are started before any socket or event loop exists in this process.
+    bokeh_workers = []
+    if cfg.get("spawn_bokeh_workers", True):
+        from bokeh_worker import get_port, run_bokeh_worker
+
+        spawn_context = multiprocessing.get_context('spawn')
+        for bokeh_server_path in cfg["bokeh_server_paths"]:
+            worker = spawn_context.Process(target=run_bokeh_worker, args=(get_port(bokeh_server_path), cfg, os.getpid()))
+            worker.start()
+            bokeh_workers.append(worker)
+        startup_timer.mark("bokeh workers")
+
+    session_store = create_session_store(cfg)
+    # Created before the Tornado workers are forked, so that they share its epoch
+    rate_feed = RateChangeFeed(len(city_store), session_store, apply_stub_rate_changes)
+    startup_timer.mark("session store")
+
+    # In pre-fork mode, the listening socket is bound once and shared by all of the worker processes. The
+    # session state then has to live outside of the workers (a 'shared' or 'redis' session store).
+    workers = cfg.get("tornado_workers", 1)
+    if workers > 1 and cfg.get("session_store", "memory") == "memory":
+        raise ValueError("Running several Tornado workers requires a 'shared' or 'redis' session store")
 
     logging.info("Starting Tornado server.")
-    http_server = tornado.httpserver.HTTPServer(TornadoApplication())
+    sockets = tornado.netutil.bind_sockets(tornado.options.options.port)
+    if workers > 1:
+        tornado.process.fork_processes(workers)
+        session_store.after_fork()
+        logging.info("Tornado worker " + str(tornado.process.task_id()) + " started")
+
+    # This creates the event loop, which must not happen before the workers are forked
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    http_server = tornado.httpserver.HTTPServer(TornadoApplication(debug=(workers == 1)))
     logging.info("Listening on port: " + str(tornado.options.options.port))
-    http_server.listen(tornado.options.options.port)
+    http_server.add_sockets(sockets)
     io_loop = tornado.ioloop.IOLoop.current()
+    loop_lag_monitor.start()
+    startup_timer.mark("tornado server")
 
-    bokeh_server = Server({'/bokeh_app': lambda doc: bokeh_app(doc, cfg, data_prov)},
-                          io_loop=io_loop,
-                          allow_websocket_origin=cfg["websocket_origins"],
-                          check_unused_sessions_milliseconds=1000,
-                          unused_lifetime_milliseconds=1000
-                          )
+    # Each Tornado worker keeps its own pool
+    if cfg.get("session_pool_size", 0) > 0:
+        session_pool = BokehSessionPool(cfg["session_pool_size"], create_session, close_session,
+                                        cfg.get("session_pool_max_age", 300), cfg.get("session_handoff_seconds", 30))
+        session_pool.start()
 
-    print("App initialized.")
+    warmup_job = create_warmup_job(cfg, warm_rates)
+    if warmup_job is not None:
+        warmup_job.start()
 
-    io_loop.start()
+    if tornado.process.task_id() in (None, 0):
+        startup_timer.log_report()
+        print("App initialized.")
 
+    io_loop.start()
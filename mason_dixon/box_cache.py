@@ -0,0 +1,76 @@
+import math
+import threading
+
+from collections import OrderedDict
+from shapely.geometry import Polygon
+from .geometric import wrap_polygon
+
+# The size of a city's box only depends on the extent of the frame, so the boxes are computed per zoom bracket
+# rather than per frame: a bracket covers the extents between two consecutive powers of BRACKET_BASE, and the
+# boxes of a bracket are sized for its largest extent. Panning (and zooming within a bracket) reuses them.
+BRACKET_BASE = 2 ** 0.25
+
+
+def get_bracket(extent):
+    return math.ceil(math.log(extent) / math.log(BRACKET_BASE))
+
+
+def get_bracket_extent(bracket):
+    return BRACKET_BASE ** bracket
+
+
+# Boxes around cities, already clipped to the city's home region (the expensive intersection, since region
+# geometries are detailed), keyed by city, region and bracket. It is filled lazily and shared by all of the sessions
+# of a process, so it is lock-protected (renders run on a thread pool). The least recently used boxes are evicted
+# beyond max_entries.
+class CityBoxCache:
+    def __init__(self, region_geometries, max_entries=100000):
+        self.region_geometries = region_geometries
+        self.max_entries = max_entries
+        self._boxes = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_box(self, city_index, point_geometry, region_index, width_bracket, height_bracket, city_box_proportion):
+        key = (city_index, region_index, width_bracket, height_bracket, city_box_proportion)
+        with self._lock:
+            box = self._boxes.get(key)
+            if box is not None:
+                self._boxes.move_to_end(key)
+                self.hits += 1
+                return box
+
+        # Computed outside of the lock. Two threads may compute the same box, which is harmless.
+        lon_spacing = 0.5 * city_box_proportion * get_bracket_extent(width_bracket)
+        lat_spacing = 0.5 * city_box_proportion * get_bracket_extent(height_bracket)
+        point_lon = point_geometry.x
+        point_lat = point_geometry.y
+
+        init_geom = Polygon([(point_lon - lon_spacing, point_lat + lat_spacing),
+                             (point_lon + lon_spacing, point_lat + lat_spacing),
+                             (point_lon + lon_spacing, point_lat - lat_spacing),
+                             (point_lon - lon_spacing, point_lat - lat_spacing)])
+        box = wrap_polygon(init_geom.intersection(self.region_geometries[region_index]))
+
+        with self._lock:
+            self.misses += 1
+            self._boxes[key] = box
+            while len(self._boxes) > self.max_entries:
+                self._boxes.popitem(last=False)
+        return box
+
+    # The cached box, clipped to the (rectangular) frame. Most boxes lie entirely inside of the frame and are returned
+    # as they are; the others only need an intersection with a rectangle.
+    def get_box_in_frame(self, city_index, point_geometry, region_index, width_bracket, height_bracket,
+                         city_box_proportion, frame_geometry):
+        box = self.get_box(city_index, point_geometry, region_index, width_bracket, height_bracket,
+                           city_box_proportion)
+        min_x, min_y, max_x, max_y = box.bounds
+        frame_min_x, frame_min_y, frame_max_x, frame_max_y = frame_geometry.bounds
+        if frame_min_x <= min_x and frame_min_y <= min_y and max_x <= frame_max_x and max_y <= frame_max_y:
+            return box
+        return wrap_polygon(box.intersection(frame_geometry))
+
+    def __len__(self):
+        return len(self._boxes)
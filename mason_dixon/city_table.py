@@ -0,0 +1,79 @@
+import numpy as np
+
+# The city table of a session. A frame can list thousands of cities, so rather than shipping all of them to the
+# DataTable on every update, the session keeps the frame's listing (as returned by the renderers, see
+# municipal_data_utility.get_city_table) and only sends one page of it, sorted server-side. Only the rows of that
+# page are formatted.
+
+# The orders the table can be sorted in: (column, descending)
+SORT_ORDERS = {
+    'rate_desc': ('rate', True),
+    'rate_asc': ('rate', False),
+    'population_desc': ('pop_max', True),
+    'population_asc': ('pop_max', False),
+}
+
+
+def format_rates(rates):
+    return np.char.mod('%.2f', np.asarray(rates, dtype=float))
+
+
+def empty_table_page():
+    return dict(display_string=[], formatted=[])
+
+
+class CityTablePager:
+    def __init__(self, page_size=100, sort_order='rate_desc'):
+        self.page_size = page_size
+        self.sort_order = sort_order
+        self.page = 0
+        self.names = np.array([], dtype=object)
+        self.rates = np.array([], dtype=float)
+        self.populations = np.array([], dtype=float)
+        self._order = np.array([], dtype=np.int64)
+
+    # Replaces the listing with a new frame's. The page is kept (as far as the new listing reaches).
+    def set_cities(self, city_table):
+        self.names = city_table['display_string'].to_numpy(dtype=object)
+        self.rates = city_table['rate'].to_numpy(dtype=float)
+        self.populations = city_table['pop_max'].to_numpy(dtype=float)
+        self._sort()
+
+    def set_sort_order(self, sort_order):
+        if sort_order not in SORT_ORDERS:
+            raise ValueError("Unknown sort order: " + str(sort_order))
+        self.sort_order = sort_order
+        self.page = 0
+        self._sort()
+
+    def _sort(self):
+        column, descending = SORT_ORDERS[self.sort_order]
+        values = self.rates if column == 'rate' else self.populations
+        # A stable sort, so that cities with equal values keep the listing's order
+        self._order = np.argsort(-values if descending else values, kind='stable')
+        self.page = min(self.page, self.page_count() - 1)
+
+    def row_count(self):
+        return len(self._order)
+
+    def page_count(self):
+        return max(1, -(-self.row_count() // self.page_size))
+
+    # Moves by a number of pages (clamped to the listing), and returns whether the page changed
+    def turn(self, pages):
+        page = min(max(0, self.page + pages), self.page_count() - 1)
+        changed = page != self.page
+        self.page = page
+        return changed
+
+    def get_page(self):
+        rows = self._order[self.page * self.page_size:(self.page + 1) * self.page_size]
+        return dict(display_string=self.names[rows].tolist(), formatted=format_rates(self.rates[rows]).tolist())
+
+    # E.g. "Cities 101-200 of 3421"
+    def describe(self):
+        if self.row_count() == 0:
+            return "No cities"
+        first = self.page * self.page_size + 1
+        last = min(self.row_count(), (self.page + 1) * self.page_size)
+        return "Cities " + str(first) + "-" + str(last) + " of " + str(self.row_count())
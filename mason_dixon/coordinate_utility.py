@@ -1,21 +1,26 @@
-from pyproj import Transformer
+from functools import lru_cache
 from shapely.geometry import Polygon, MultiPolygon, Point
 
-transformer = Transformer.from_crs(4326, 3857, always_xy=True)
-transformer_inv = Transformer.from_crs(3857, 4326, always_xy=True)
+
+# Building a Transformer (and importing pyproj at all) is slow, so it is deferred until the first conversion.
+@lru_cache(maxsize=None)
+def get_transformer(source_crs, target_crs):
+    from pyproj import Transformer
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
 
 
 def point_to_mercator(point):
-    transformed = transformer.transform(point.x, point.y)
+    transformed = get_transformer(4326, 3857).transform(point.x, point.y)
     return Point(*transformed)
 
 
 def point_to_wgs84(point):
-    transformed = transformer_inv.transform(point.x, point.y)
+    transformed = get_transformer(3857, 4326).transform(point.x, point.y)
     return Point(*transformed)
 
 
 def polygon_to_mercator(polygon):
+    transformer = get_transformer(4326, 3857)
     longitudes = polygon.exterior.coords.xy[0]
     latitudes = polygon.exterior.coords.xy[1]
     coords = zip(longitudes, latitudes)
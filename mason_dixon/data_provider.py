@@ -1,12 +1,23 @@
+import logging
 import os
-import geopandas as gpd
+import pickle
 
 from enum import Enum
 from functools import total_ordering
 
 from . import coordinate_utility
-from .coordinate_utility import display_wgs_string
 from .geometric import wrap_polygon
+from .mapped_cities import MappedCityStore, build_city_store
+from .region_index import RegionIndex
+from .region_raster import RegionRaster
+
+region_file_loc = os.path.join('geographic_data', 'cache', 'regions_test.geojson')
+cities_file_loc = os.path.join('geographic_data', 'cache', 'cities_test.geojson')
+snapshot_file_loc = os.path.join('geographic_data', 'cache', 'data_provider.pickle')
+city_store_loc = os.path.join('geographic_data', 'cache', 'cities')
+
+# Bump this whenever the attributes built in DataProvider.__init__ change, so that old snapshots are rebuilt.
+SNAPSHOT_VERSION = 4
 
 
 # A Primary city is defined as either a capital, a world city, part of a megalopolis, or population 10 million.
@@ -63,34 +74,136 @@ def classify_city(population, is_capital, is_global, is_mega):
 class DataProvider:
 
     def __init__(self, rate_fn):
+        # Only needed to build a provider from the GeoJSONs, not to load its snapshot
+        import geopandas as gpd
+        from shapely.validation import make_valid
+
         # We want the server to have WGS coordinates (for the web API calls it must make)
         # and the client to have Web Mercator coordinates (for plotting libraries).
         # The Natural Earth (raw) data is in WGS.
-        self.region_file_loc = os.path.join('geographic_data', 'cache', 'regions_test.geojson')
+        self.region_file_loc = region_file_loc
         self.region_dataframe = gpd.read_file(self.region_file_loc)
+        # A polygon that is valid in WGS can come out of the projection slightly invalid (e.g. near the poles)
         self.region_dataframe['mercator'] = self.region_dataframe.apply(lambda x: wrap_polygon(
-            coordinate_utility.multipolygon_to_mercator(x['geometry'])), axis=1)
-
-        # For convenience (and compatibility with certain library API functions), there are
-        # separate 'cities' frames, with the 'geometry' columns in the different coordinate systems.
-        self.cities_file_loc = os.path.join('geographic_data', 'cache', 'cities_test.geojson')
-        self.cities_dataframe_wgs = gpd.read_file(self.cities_file_loc)
-        self.cities_dataframe_wgs['index'] = self.cities_dataframe_wgs.index
-        self.cities_dataframe_wgs['rate'] = self.cities_dataframe_wgs.apply(lambda city: rate_fn(city['geometry']), axis=1)
-        self.cities_dataframe_wgs['display_string'] = self.cities_dataframe_wgs.apply(lambda x: f"{x['name']} {display_wgs_string(x['geometry'])}", axis=1)
-
-        self.cities_dataframe_mercator = self.cities_dataframe_wgs.copy(True)
-        self.cities_dataframe_mercator['mercator'] = self.cities_dataframe_mercator.apply(
-            lambda city: coordinate_utility.point_to_mercator(city['geometry']), axis=1)
-        self.cities_dataframe_mercator = self.cities_dataframe_mercator.set_geometry('mercator', drop=True)
-        self.cities_dataframe_mercator['updates'] = self.cities_dataframe_mercator.apply(lambda city: 0, axis=1)
+            make_valid(coordinate_utility.multipolygon_to_mercator(x['geometry']))), axis=1)
+
+        # The cities are not part of the snapshot: they are memory-mapped from the city store (see mapped_cities.py)
+        self.cities_file_loc = cities_file_loc
+        self.city_store = load_city_store(rate_fn, self.region_dataframe['mercator'])
+
+        # Unlike the spatial indexes, the raster takes a while to build, so it is part of the snapshot
+        self.region_raster = RegionRaster(self.region_dataframe['mercator'])
+
+        self.build_indexes()
+
+    # Spatial indexes are cheap to build from the frames above, and are not part of a snapshot
+    def build_indexes(self):
+        self.region_index = RegionIndex(self.region_dataframe['mercator'])
+
+    # A snapshot is the fully built state of a DataProvider, tagged with the GeoJSON files it was built from.
+    # Loading one skips parsing the GeoJSON and all of the per-row coordinate conversions above.
+    @staticmethod
+    def source_key():
+        key = [SNAPSHOT_VERSION]
+        for file_loc in (region_file_loc, cities_file_loc):
+            if not os.path.exists(file_loc):
+                return None
+            stat = os.stat(file_loc)
+            key.extend([file_loc, stat.st_size, stat.st_mtime_ns])
+        return tuple(key)
+
+    def save_snapshot(self, file_loc=snapshot_file_loc):
+        attributes = {k: v for k, v in self.__dict__.items() if k not in ('region_index', 'city_store')}
+        state = {'source_key': self.source_key(), 'attributes': attributes}
+        temporary_loc = file_loc + '.tmp'
+        with open(temporary_loc, 'wb') as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_loc, file_loc)
+
+    # Returns None if there is no snapshot, or if it was built from different GeoJSON files.
+    @classmethod
+    def load_snapshot(cls, file_loc=snapshot_file_loc):
+        if not os.path.exists(file_loc):
+            return None
+
+        with open(file_loc, 'rb') as handle:
+            state = pickle.load(handle)
+
+        source_key = cls.source_key()
+        if source_key is None or state['source_key'] != source_key:
+            return None
+
+        # The snapshot was built together with the city store, so the store is only missing if it was deleted
+        city_store = MappedCityStore.open(city_store_loc, city_source_key())
+        if city_store is None:
+            return None
+
+        provider = cls.__new__(cls)
+        provider.__dict__.update(state['attributes'])
+        provider.city_store = city_store
+        provider.build_indexes()
+        return provider
 
     def get_region_data(self):
         return self.region_dataframe.copy(deep=True)
 
-    def get_cities_wgs(self):
-        return self.cities_dataframe_wgs.copy(deep=True)
-
-    def get_cities_mercator(self):
-        return self.cities_dataframe_mercator.copy(deep=True)
 
+# The city store is tagged with the GeoJSONs it was built from (the cities, and the regions that contain them)
+def city_source_key():
+    key = []
+    for file_loc in (cities_file_loc, region_file_loc):
+        if not os.path.exists(file_loc):
+            return None
+        stat = os.stat(file_loc)
+        key.extend([file_loc, stat.st_size, stat.st_mtime_ns])
+    return key
+
+
+# Opens the city store, after (re)building it from the city GeoJSON if it is missing or was built from other
+# GeoJSONs. The starting rates are rate_fn(geometry) for each city, and the regions are region_geometries' (in Web
+# Mercator coordinates, in the order of the RegionIndex).
+def load_city_store(rate_fn, region_geometries):
+    source_key = city_source_key()
+    city_store = MappedCityStore.open(city_store_loc, source_key)
+    if city_store is not None:
+        return city_store
+
+    logging.info("Building the city store")
+    import geopandas as gpd
+    cities = gpd.read_file(cities_file_loc)
+    build_city_store(city_store_loc, cities.geometry.x.to_numpy(), cities.geometry.y.to_numpy(),
+                     cities['pop_max'].to_numpy(), cities['category'].to_numpy(), cities['name'],
+                     [rate_fn(geometry) for geometry in cities.geometry], region_geometries.values, source_key)
+    return MappedCityStore(city_store_loc)
+
+
+# Loads the provider from its snapshot if possible. Otherwise, the GeoJSON caches are brought up to date, the
+# provider is built from them, and (if use_snapshot is set) a new snapshot is saved for the next start.
+# mark(phase_name) is called after each phase, for startup timing.
+def load_data_provider(rate_fn, use_snapshot=True, mark=lambda phase_name: None):
+    if use_snapshot:
+        logging.info("Loading data from snapshot")
+        provider = DataProvider.load_snapshot()
+        mark("snapshot")
+        if provider is not None:
+            return provider
+        logging.info("No usable snapshot, the data will be loaded from the GeoJSONs")
+
+    from .geodata_processing_utility import load_regions_into_json, load_cities_into_json
+
+    logging.info("Creating GeoJSON data")
+    load_regions_into_json(False)
+    load_cities_into_json(False)
+    logging.info("Data loaded into GeoJSONs")
+    mark("geojson")
+
+    logging.info("Loading data from GeoJSONs")
+    provider = DataProvider(rate_fn)
+    logging.info("Data fully loaded")
+    mark("data provider")
+
+    if use_snapshot:
+        provider.save_snapshot()
+        mark("snapshot saved")
+
+    return provider
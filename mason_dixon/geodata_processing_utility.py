@@ -1,60 +1,200 @@
 import geopandas as gpd
+import hashlib
+import json
+import logging
 import os
+import pickle
 
+from concurrent.futures import ProcessPoolExecutor
+from shapely.ops import unary_union
+
+from . import special_regions
 from .special_regions import keep_unit, get_unit_group
 from .geometric import wrap_polygon
-from .data_provider import classify_city
+from .data_provider import classify_city, region_file_loc, cities_file_loc
 
+# The build is split into stages (read -> filter -> group/dissolve -> wrap -> write). Every stage is keyed by a
+# content hash of its input (the raw zip for the first stage, the previous stage's key afterwards) and the
+# parameters it depends on, so only the stages downstream of an actual change are ever recomputed.
+# Bump this whenever the logic of a stage changes, to invalidate everything that was cached before.
+PIPELINE_VERSION = 1
+
+cache_dir = os.path.join('geographic_data', 'cache')
+stage_dir = os.path.join(cache_dir, 'stages')
+manifest_file_loc = os.path.join(cache_dir, 'build_manifest.json')
+
+regions_zip_loc = os.path.join('geographic_data', 'ne_10m_admin_0_map_subunits.zip')
+cities_zip_loc = os.path.join('geographic_data', 'ne_10m_populated_places_simple.zip')
+
+
+def hash_file(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_key(previous_key, stage_name, parameters=None):
+    digest = hashlib.sha256()
+    digest.update(str(PIPELINE_VERSION).encode('utf-8'))
+    digest.update(previous_key.encode('utf-8'))
+    digest.update(stage_name.encode('utf-8'))
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _stage_file(stage_name, key):
+    return os.path.join(stage_dir, f"{stage_name}-{key[:16]}.pickle")
+
+
+# Runs fn(*args) unless a result for this exact key is already on disk (or force is set). Older results of the
+# same stage are removed, so the stage cache never holds more than one generation per stage.
+def run_stage(stage_name, key, force, fn, *args):
+    file_loc = _stage_file(stage_name, key)
+    if not force and os.path.exists(file_loc):
+        logging.info(f"Stage '{stage_name}' is up to date ({key[:16]})")
+        with open(file_loc, 'rb') as handle:
+            return pickle.load(handle)
+
+    logging.info(f"Running stage '{stage_name}' ({key[:16]})")
+    result = fn(*args)
+
+    os.makedirs(stage_dir, exist_ok=True)
+    for old_file in os.listdir(stage_dir):
+        if old_file.startswith(stage_name + '-'):
+            os.remove(os.path.join(stage_dir, old_file))
+    with open(file_loc, 'wb') as handle:
+        pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return result
+
+
+def _read_manifest():
+    if not os.path.exists(manifest_file_loc):
+        return dict()
+    with open(manifest_file_loc, 'r') as handle:
+        return json.load(handle)
+
+
+def _write_manifest(manifest):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(manifest_file_loc, 'w') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+
+
+def output_is_current(output_loc, key):
+    return os.path.exists(output_loc) and _read_manifest().get(output_loc) == key
 
-# TODO: This currently has some paths hard-coded, and requires the Natural Earth datasets It needs to be made dynamic.
-def load_regions_into_json(still_run_if_cached):
-    region_file_loc = os.path.join('geographic_data', 'cache', 'regions_test.geojson')
 
-    if still_run_if_cached and os.path.exists(region_file_loc):
-        os.remove(region_file_loc)
+def write_output(frame, output_loc, key):
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(output_loc):
+        os.remove(output_loc)
+    frame.to_file(output_loc, driver='GeoJSON', encoding='utf-8')
 
-    if os.path.exists(region_file_loc):
-        return
+    manifest = _read_manifest()
+    manifest[output_loc] = key
+    _write_manifest(manifest)
 
-    zipfile = "zip://./geographic_data/ne_10m_admin_0_map_subunits.zip"
-    subunits = gpd.read_file(zipfile)
+
+# Region stages
+
+def read_subunits(zip_loc):
+    subunits = gpd.read_file(f"zip://./{zip_loc}")
     subunits = subunits.sort_values('SOVEREIGNT')
-    subunits = subunits[['GEOUNIT', 'SOVEREIGNT', 'geometry']]
+    return subunits[['GEOUNIT', 'SOVEREIGNT', 'geometry']]
+
 
+def filter_subunits(subunits):
     # Remove uninhabited regions
-    subunits.loc[:, 'keep'] = subunits.apply(lambda x: keep_unit(x['GEOUNIT']), axis=1)
-    subunits = subunits.loc[subunits['keep'], subunits.columns != 'keep']
+    keep = subunits['GEOUNIT'].map(keep_unit).astype(bool)
+    return subunits.loc[keep].copy()
+
+
+def _dissolve_group(geometries):
+    return unary_union(geometries)
+
 
+# Equivalent to subunits.dissolve(by='group') (the non-geometry columns take the first value of each group),
+# except that the unions of the individual groups are computed in parallel.
+def dissolve_subunits(subunits, workers=None):
     # Group certain subunits (for example, Belgium is encoded as Walloon and Flemish regions)
-    subunits['group'] = subunits.apply(lambda x: get_unit_group(x['GEOUNIT']), axis=1)
+    subunits = subunits.assign(group=subunits['GEOUNIT'].map(get_unit_group))
+    grouped = subunits.groupby('group', sort=True)
 
-    aggregated = subunits.dissolve(by='group').reset_index()
+    first_rows = grouped[['GEOUNIT', 'SOVEREIGNT']].first()
+    geometry_lists = [list(group['geometry']) for _, group in grouped]
+
+    if workers == 1:
+        unions = [_dissolve_group(geometries) for geometries in geometry_lists]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            unions = list(executor.map(_dissolve_group, geometry_lists))
+
+    aggregated = gpd.GeoDataFrame(first_rows, geometry=unions, crs=subunits.crs).reset_index()
     aggregated.rename(columns={'group': 'UNIT'}, inplace=True)
-    aggregated['wrapped'] = aggregated.apply(lambda x: wrap_polygon(x['geometry']), axis=1)
+    return aggregated
+
 
+def wrap_regions(aggregated):
+    aggregated = aggregated.copy()
+    aggregated['wrapped'] = aggregated['geometry'].map(wrap_polygon)
     aggregated = aggregated.loc[:, aggregated.columns != 'geometry']
     aggregated.set_geometry('wrapped', inplace=True)
+    return aggregated
 
-    aggregated.to_file(region_file_loc, driver='GeoJSON', encoding='utf-8')
 
+def build_regions(force=False, workers=None):
+    read_key = stage_key(hash_file(regions_zip_loc), 'read')
+    filter_key = stage_key(read_key, 'filter', sorted(special_regions.units_of_interest))
+    dissolve_key = stage_key(filter_key, 'dissolve', special_regions.units_by_country)
+    wrap_key = stage_key(dissolve_key, 'wrap')
 
-def load_cities_into_json(still_run_if_cached):
-    cities_file_loc = os.path.join('geographic_data', 'cache', 'cities_test.geojson')
+    if not force and output_is_current(region_file_loc, wrap_key):
+        logging.info("Region GeoJSON is up to date")
+        return False
+
+    subunits = run_stage('regions_read', read_key, force, read_subunits, regions_zip_loc)
+    subunits = run_stage('regions_filter', filter_key, force, filter_subunits, subunits)
+    aggregated = run_stage('regions_dissolve', dissolve_key, force, dissolve_subunits, subunits, workers)
+    wrapped = run_stage('regions_wrap', wrap_key, force, wrap_regions, aggregated)
 
-    if still_run_if_cached and os.path.exists(cities_file_loc):
-        os.remove(cities_file_loc)
+    write_output(wrapped, region_file_loc, wrap_key)
+    return True
 
-    if os.path.exists(cities_file_loc):
-        return
 
-    zipfile = "zip://./geographic_data/ne_10m_populated_places_simple.zip"
-    cities = gpd.read_file(zipfile)
+# City stages
 
+def read_cities(zip_loc):
+    return gpd.read_file(f"zip://./{zip_loc}")
+
+
+def classify_cities(cities):
     cities = cities.sort_values(['pop_max'], ascending=[False])
     cities['category'] = cities.apply(lambda x: classify_city(x.pop_max, x.adm0cap, x.worldcity, x.megacity).value, axis=1)
+    return cities
+
+
+def build_cities(force=False):
+    read_key = stage_key(hash_file(cities_zip_loc), 'read')
+    classify_key = stage_key(read_key, 'classify')
+
+    if not force and output_is_current(cities_file_loc, classify_key):
+        logging.info("City GeoJSON is up to date")
+        return False
+
+    cities = run_stage('cities_read', read_key, force, read_cities, cities_zip_loc)
+    cities = run_stage('cities_classify', classify_key, force, classify_cities, cities)
 
-    cities.to_file(cities_file_loc, driver='GeoJSON', encoding='utf-8')
+    write_output(cities, cities_file_loc, classify_key)
+    return True
 
 
-load_regions_into_json(True)
-load_cities_into_json(True)
+# TODO: This currently has some paths hard-coded, and requires the Natural Earth datasets It needs to be made dynamic.
+def load_regions_into_json(still_run_if_cached):
+    return build_regions(force=still_run_if_cached)
+
+
+def load_cities_into_json(still_run_if_cached):
+    return build_cities(force=still_run_if_cached)
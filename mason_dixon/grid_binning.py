@@ -0,0 +1,169 @@
+import math
+import numpy as np
+import shapely
+
+from shapely.geometry import Point
+from .box_cache import get_bracket, get_bracket_extent
+from . import municipal_data_utility as mun_util
+
+# A fast alternative to the tessellation: the frame is covered by a uniform grid of hexagons or squares, in
+# WebMercator, and each cell is coloured by the mean rate of the cities binned into it (or, without any, of its
+# region). Everything is done on arrays (binning with floor/round, aggregation with bincount), so a frame takes
+# milliseconds however many regions it crosses. Cells are masked to land with the DataProvider's region raster (or,
+# for cells smaller than its pixels, with the region index), and named after the region that they are in.
+#
+# The grid is anchored at the origin, with a cell size that only changes between zoom brackets (see box_cache.py),
+# so a cell keeps its place and its rate when the view pans. Unlike a tessellation cell, a grid cell is not clipped
+# to the frame, and it counts all of its cities, not only the ones inside of the frame.
+
+GRID_ENGINES = ('hex', 'square')
+
+# The directions of the corners of a (pointy-topped) hexagon
+HEX_CORNER_ANGLES = np.radians(np.arange(6) * 60 + 30)
+
+
+class GridBinner:
+    def __init__(self, region_dataframe, city_store, region_index, region_raster, cells_across=40):
+        self.region_names = region_dataframe['SOVEREIGNT'].to_numpy()[
+            [region_dataframe.index.get_loc(label) for label in region_raster.labels]]
+        self.region_index = region_index
+        self.region_raster = region_raster
+        self.cells_across = cells_across
+
+        # The cities are read from a MappedCityStore (see mapped_cities.py)
+        self.city_store = city_store
+        self.city_x = city_store.x
+        self.city_y = city_store.y
+
+    # Renders a frame for one session's rates with a 'hex' or 'square' grid, in the format of render_full_map
+    def render_frame(self, engine, rates, upper_left_merc, lower_right_merc):
+        min_x, max_x = sorted((upper_left_merc.x, lower_right_merc.x))
+        min_y, max_y = sorted((upper_left_merc.y, lower_right_merc.y))
+        little_population, big_population = mun_util.map_mercator_window_to_population(Point(min_x, max_y),
+                                                                                         Point(max_x, min_y))
+        cell_width = get_bracket_extent(get_bracket(max_x - min_x)) / self.cells_across
+
+        if engine == 'hex':
+            cells = self.get_hex_cells(cell_width, min_x, min_y, max_x, max_y)
+        elif engine == 'square':
+            cells = self.get_square_cells(cell_width, min_x, min_y, max_x, max_y)
+        else:
+            raise ValueError("Unknown grid engine: " + str(engine))
+        centers_x, centers_y, corners_x, corners_y, bin_cities = cells
+        cell_count = len(centers_x)
+
+        # The cells reach past the frame, so the cities are looked up within the cells' bounds
+        rated = np.zeros(0, dtype=np.int64)
+        if cell_count > 0:
+            rated = self.city_store.query((corners_x.min(), corners_y.min(), corners_x.max(), corners_y.max()),
+                                          little_population, mercator=True)
+        city_cells = bin_cities(self.city_x[rated], self.city_y[rated])
+        binned = city_cells >= 0
+        rated = rated[binned]
+        city_cells = city_cells[binned]
+        city_regions = self.region_raster.lookup(self.city_x[rated], self.city_y[rated])
+        totals = np.bincount(city_cells, weights=rates[rated], minlength=cell_count)
+        counts = np.bincount(city_cells, minlength=cell_count)
+        means = np.divide(totals, counts, out=np.zeros(cell_count), where=counts > 0)
+
+        # A cell is on land if its center is. A coastal cell whose center is at sea is kept if it has cities.
+        cell_regions = self.get_regions(centers_x, centers_y, cell_width)
+        sea = cell_regions < 0
+        cell_regions[city_cells[sea[city_cells]]] = city_regions[sea[city_cells]]
+        shown = np.nonzero(cell_regions >= 0)[0]
+
+        # A cell without cities is coloured by the mean rate of its region's cities in the grid, as in the coarse
+        # frame of a progressive render
+        region_count = len(self.region_names)
+        in_region = city_regions >= 0
+        region_totals = np.bincount(city_regions[in_region], weights=rates[rated][in_region], minlength=region_count)
+        region_counts = np.bincount(city_regions[in_region], minlength=region_count)
+        region_means = np.divide(region_totals, region_counts, out=np.zeros(region_count), where=region_counts > 0)
+        empty = shown[counts[shown] == 0]
+        means[empty] = region_means[cell_regions[empty]]
+
+        listed = self.city_store.query((min_x, min_y, max_x, max_y), little_population, mercator=True)
+
+        data = dict(x=[[[ring]] for ring in corners_x[shown].tolist()],
+                    y=[[[ring]] for ring in corners_y[shown].tolist()],
+                    name=self.region_names[cell_regions[shown]].tolist(),
+                    rate=means[shown].tolist())
+        return data, mun_util.get_city_table(self.city_store, rates, listed)
+
+    # The region position of each point. The raster answers for cells at least as large as its pixels; smaller ones
+    # would all get the region of the same few pixels.
+    def get_regions(self, x, y, cell_width):
+        if cell_width >= self.region_raster.pixel_size:
+            return self.region_raster.lookup(x, y)
+
+        regions = np.full(len(x), -1, dtype=np.int64)
+        point_positions, region_positions = self.region_index.tree.query(shapely.points(x, y), predicate='within')
+        regions[point_positions] = region_positions
+        return regions
+
+    # Square cells of width cell_width. Returns the cell centers, the corners of each cell, and a function that maps
+    # points to their cell (or -1 outside of the cells).
+    def get_square_cells(self, cell_width, min_x, min_y, max_x, max_y):
+        first_column, last_column = math.floor(min_x / cell_width), math.floor(max_x / cell_width)
+        first_row, last_row = math.floor(min_y / cell_width), math.floor(max_y / cell_width)
+        column_count = last_column - first_column + 1
+        row_count = last_row - first_row + 1
+
+        columns, rows = np.meshgrid(np.arange(first_column, last_column + 1), np.arange(first_row, last_row + 1),
+                                    indexing='ij')
+        left = (columns.ravel() * cell_width)[:, None]
+        bottom = (rows.ravel() * cell_width)[:, None]
+        corners_x = left + np.array([0, cell_width, cell_width, 0])
+        corners_y = bottom + np.array([0, 0, cell_width, cell_width])
+
+        def bin_points(x, y):
+            column = np.floor(x / cell_width).astype(np.int64) - first_column
+            row = np.floor(y / cell_width).astype(np.int64) - first_row
+            inside = (column >= 0) & (column < column_count) & (row >= 0) & (row < row_count)
+            return np.where(inside, column * row_count + row, -1)
+
+        return left[:, 0] + 0.5 * cell_width, bottom[:, 0] + 0.5 * cell_width, corners_x, corners_y, bin_points
+
+    # Pointy-topped hexagons of width cell_width, in axial coordinates (q, r): the center of (q, r) is at
+    # x = width * (q + r / 2), y = 1.5 * size * r, where size (the distance from the center to a corner) is
+    # width / sqrt(3). Each row r holds the same number of hexagons, starting at first_q(r).
+    def get_hex_cells(self, cell_width, min_x, min_y, max_x, max_y):
+        size = cell_width / math.sqrt(3)
+        row_height = 1.5 * size
+        first_r = math.floor(min_y / row_height) - 1
+        last_r = math.ceil(max_y / row_height) + 1
+        hexes_per_row = math.ceil((max_x - min_x) / cell_width) + 3
+        row_count = last_r - first_r + 1
+
+        def get_first_q(r):
+            return np.floor(min_x / cell_width - 0.5 * r).astype(np.int64) - 1
+
+        r = np.repeat(np.arange(first_r, last_r + 1), hexes_per_row)
+        q = get_first_q(r) + np.tile(np.arange(hexes_per_row), row_count)
+        centers_x = cell_width * (q + 0.5 * r)
+        centers_y = row_height * r
+        corners_x = centers_x[:, None] + size * np.cos(HEX_CORNER_ANGLES)
+        corners_y = centers_y[:, None] + size * np.sin(HEX_CORNER_ANGLES)
+
+        def bin_points(x, y):
+            # Fractional axial coordinates, rounded to the nearest hexagon in cube coordinates (q + r + s = 0)
+            fractional_q = (math.sqrt(3) / 3 * x - y / 3) / size
+            fractional_r = (2 / 3 * y) / size
+            fractional_s = -fractional_q - fractional_r
+            rounded_q = np.round(fractional_q)
+            rounded_r = np.round(fractional_r)
+            rounded_s = np.round(fractional_s)
+            q_error = np.abs(rounded_q - fractional_q)
+            r_error = np.abs(rounded_r - fractional_r)
+            s_error = np.abs(rounded_s - fractional_s)
+            fix_q = (q_error > r_error) & (q_error > s_error)
+            fix_r = ~fix_q & (r_error > s_error)
+            rounded_q = np.where(fix_q, -rounded_r - rounded_s, rounded_q).astype(np.int64)
+            rounded_r = np.where(fix_r, -rounded_q - rounded_s, rounded_r).astype(np.int64)
+
+            row = rounded_r - first_r
+            column = rounded_q - get_first_q(rounded_r)
+            inside = (row >= 0) & (row < row_count) & (column >= 0) & (column < hexes_per_row)
+            return np.where(inside, row * hexes_per_row + column, -1)
+
+        return centers_x, centers_y, corners_x, corners_y, bin_points
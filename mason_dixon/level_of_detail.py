@@ -0,0 +1,69 @@
+import numpy as np
+
+from collections import deque
+from .tessellation import LEVELS_OF_DETAIL
+
+# Picks the level of detail of each tessellation render (see LEVELS_OF_DETAIL in tessellation.py), so that renders
+# stay within a latency target. Rendering a frame costs a little per cell (clipping and averaging, about the same
+# at every level) plus, for each tile that is not cached yet, its tessellation. That is modelled in work units: a
+# tile costs TILE_UNITS[level] (cutting the regions, splitting the remainders into cells) plus one unit per city
+# that gets a box in it. Dense regions (e.g. Europe) have many more box cities per tile than sparse ones.
+#
+# The controller predicts the cost of the frame at each level from the finest down, with the seconds per unit and
+# per clip that it measured on the previous renders (moving averages), and picks the finest level that fits. A frame
+# whose tiles are cached costs little at any level, so it is always shown in full detail.
+
+# Measured relative to the cost of one box city
+TILE_UNITS = (30, 14, 7, 2)
+
+
+class LevelOfDetailController:
+    def __init__(self, tessellator, target=0.5, smoothing=0.2, seconds_per_unit=0.0016, window=500):
+        self.tessellator = tessellator
+        self.target = target
+        self.smoothing = smoothing
+        self.seconds_per_unit = seconds_per_unit
+        self.clip_seconds = 0.0
+        self.renders = [0] * len(LEVELS_OF_DETAIL)
+        self.over_target = 0
+        self.latencies = deque(maxlen=window)
+
+    # The work of the tiles of a frame that are not cached yet
+    def get_work(self, keys):
+        return sum(TILE_UNITS[key[-1]] + len(self.tessellator.get_box_cities(*key))
+                   for key in keys if not self.tessellator.has_tile(key))
+
+    def predict(self, units):
+        return self.clip_seconds + units * self.seconds_per_unit
+
+    # Returns the level and the predicted work units of the frame. If no level fits, the coarsest one is used.
+    def choose(self, upper_left_merc, lower_right_merc, box_factor, city_box_proportion):
+        for level in range(len(LEVELS_OF_DETAIL)):
+            keys = self.tessellator.get_tile_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion,
+                                                  level)
+            units = self.get_work(keys)
+            if self.predict(units) <= self.target:
+                break
+        return level, units
+
+    # Called after each render with the level, the predicted work units and the stage timings of the render
+    def observe(self, level, units, timings):
+        self.renders[level] += 1
+        elapsed = timings.get('total', 0.0)
+        self.latencies.append(elapsed)
+        if elapsed > self.target:
+            self.over_target += 1
+
+        if units > 0 and timings.get('tiles', 0.0) > 0:
+            self.seconds_per_unit += self.smoothing * (timings['tiles'] / units - self.seconds_per_unit)
+        clip_seconds = timings.get('clip', 0.0) + timings.get('table', 0.0)
+        self.clip_seconds += self.smoothing * (clip_seconds - self.clip_seconds)
+
+    def stats(self):
+        stats = {'target': self.target, 'renders_per_level': list(self.renders), 'over_target': self.over_target,
+                 'seconds_per_unit': self.seconds_per_unit, 'clip_seconds': self.clip_seconds}
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies)
+            stats['latency_p50'] = float(np.percentile(latencies, 50))
+            stats['latency_p95'] = float(np.percentile(latencies, 95))
+        return stats
@@ -1,7 +1,10 @@
 import os
 import pickle
+import threading
 
 from shapely.geometry import Polygon
+from shapely.ops import unary_union
+from .box_cache import get_bracket
 from .geometric import wrap_polygon, conditionally_split_multipolygon, unroll_multipolygon
 from . import municipal_data_utility as mun_util
 
@@ -113,13 +116,54 @@ def get_boxes_around_cities_mp(outer_frame_geometry, box_factor, city_box_height
     return longitudes, latitudes, names, rates
 
 
+# A version of the previous function that takes the boxes from a CityBoxCache. A cached box is already clipped to the
+# city's home region, so it only needs to be clipped to the frame, and carved out of the boxes of the previous cities
+# (which are small). The remainder is the region minus all of the boxes, in one difference.
+def get_cached_boxes_around_cities_mp(outer_frame_geometry, box_factor, box_cache, width_bracket, height_bracket,
+                                      city_box_proportion, city_array, region_index, region_geometry_multipolygon,
+                                      name, rate_rule, min_pop_for_boxes):
+    max_size = outer_frame_geometry.area / box_factor
+
+    cities_in_region = city_array[city_array['geometry'].within(region_geometry_multipolygon)]
+    cities_in_region = cities_in_region[cities_in_region['pop_max'] >= min_pop_for_boxes]
+
+    boxes = []
+    for city_index, city_geometry in zip(cities_in_region['index'], cities_in_region['geometry']):
+        box = box_cache.get_box_in_frame(city_index, city_geometry, region_index, width_bracket, height_bracket,
+                                         city_box_proportion, outer_frame_geometry)
+        for previous_box in boxes:
+            if box.intersects(previous_box):
+                box = wrap_polygon(box.difference(previous_box))
+        boxes.append(box)
+
+    if len(boxes) > 0:
+        remainder = wrap_polygon(region_geometry_multipolygon.difference(unary_union(boxes)))
+    else:
+        remainder = region_geometry_multipolygon
+    remainder = conditionally_split_multipolygon(remainder, max_size)
+
+    def rr(multipoly):
+        return rate_rule(multipoly, city_array)
+
+    longitudes = [unroll_multipolygon(multipolygon, 0) for multipolygon in boxes]
+    longitudes.extend([unroll_multipolygon(multipolygon, 0) for multipolygon in remainder])
+    latitudes = [unroll_multipolygon(multipolygon, 1) for multipolygon in boxes]
+    latitudes.extend([unroll_multipolygon(multipolygon, 1) for multipolygon in remainder])
+    names = [name for _ in boxes]
+    names.extend([name for _ in remainder])
+    rates = [rr(multipolygon) for multipolygon in boxes]
+    rates.extend([rr(multipolygon) for multipolygon in remainder])
+
+    return longitudes, latitudes, names, rates
+
+
 # TODO: Debug. The prototype was in WGS84, but this is completely in Mercator
 # This is called during a periodic callback when an update is needed (different from the prototype)
-# so city_array is no longer pre-filtered.
-def render_full_map(upper_left_merc, lower_right_merc, box_factor, city_array, region_table, rate_rule,
-                    city_box_proportion, use_cache):  # , min_population=500000):
+# so the cities of the frame are read from the city store here.
+def render_full_map(upper_left_merc, lower_right_merc, box_factor, city_store, city_rates, region_table, rate_rule,
+                    city_box_proportion, use_cache, box_cache=None, region_index=None):  # , min_population=500000):
     # The Mercator values need to be returned for certain functions in bokeh.
-    cache_file_loc = os.path.join('geographic_data', 'cache', 'saved_map_data.pickle')
+    cache_file_loc = os.path.join('geographic_data', 'cache', 'saved_map_data_v2.pickle')
     if use_cache and os.path.exists(cache_file_loc):
         with open(cache_file_loc, 'rb') as handle:
             cached = pickle.load(handle)
@@ -133,14 +177,26 @@ def render_full_map(upper_left_merc, lower_right_merc, box_factor, city_array, r
     city_box_height = abs(city_box_proportion * (upper_left_merc.y - lower_right_merc.y))
     city_box_width = abs(city_box_proportion * (upper_left_merc.x - lower_right_merc.x))
 
+    # With a box cache, the boxes are sized for the zoom bracket of the frame (see box_cache.py)
+    if box_cache is not None:
+        width_bracket = get_bracket(abs(upper_left_merc.x - lower_right_merc.x))
+        height_bracket = get_bracket(abs(upper_left_merc.y - lower_right_merc.y))
+
     # TODO: Could optimize this with caching
     # TODO: Remove commented code once tested
     frame_geometry_merc = Polygon(zip(lon_point_list_merc, lat_point_list_merc))
-    roi = region_table[region_table['mercator'].intersects(frame_geometry_merc)]
-    roi['mercator'] = roi.apply(lambda x: wrap_polygon(x['mercator'].intersection(frame_geometry_merc)), axis=1)
-
-    filtered_array = mun_util.get_cities_within_geometry(frame_geometry_merc, city_array, little_population, ['display_string', 'rate'])
-    filtered_array['formatted'] = filtered_array.apply(lambda x: ("%.2f" % x['rate']), axis=1)
+    if region_index is not None:
+        region_labels, clipped_regions = region_index.clip_to_frame(frame_geometry_merc)
+        roi = region_table.loc[region_labels, ['SOVEREIGNT']].copy()
+        roi['mercator'] = clipped_regions
+    else:
+        roi = region_table[region_table['mercator'].intersects(frame_geometry_merc)].copy()
+        roi['mercator'] = roi.apply(lambda x: wrap_polygon(x['mercator'].intersection(frame_geometry_merc)), axis=1)
+
+    # Only the cities in the frame are read from the city store (see mapped_cities.py)
+    listed = mun_util.get_cities_in_frame(city_store, (upper_left_merc.x, upper_left_merc.y),
+                                          (lower_right_merc.x, lower_right_merc.y), little_population, mercator=True)
+    filtered_array = city_store.get_frame(listed, city_rates)
 
     # TODO: Make labels cities, not countries
     longitudes = []
@@ -150,9 +206,16 @@ def render_full_map(upper_left_merc, lower_right_merc, box_factor, city_array, r
 
     # TODO: Factor this out
     for index, row in roi.iterrows():
-        row_lons, row_lats, row_names, row_rates = \
-            get_boxes_around_cities_mp(frame_geometry_merc, box_factor, city_box_height, city_box_width, filtered_array,
-                                       row['mercator'], row['SOVEREIGNT'], rate_rule, big_population)
+        if box_cache is not None:
+            row_lons, row_lats, row_names, row_rates = \
+                get_cached_boxes_around_cities_mp(frame_geometry_merc, box_factor, box_cache, width_bracket,
+                                                  height_bracket, city_box_proportion, filtered_array, index,
+                                                  row['mercator'], row['SOVEREIGNT'], rate_rule, big_population)
+        else:
+            row_lons, row_lats, row_names, row_rates = \
+                get_boxes_around_cities_mp(frame_geometry_merc, box_factor, city_box_height, city_box_width,
+                                           filtered_array, row['mercator'], row['SOVEREIGNT'], rate_rule,
+                                           big_population)
 
         longitudes.extend(row_lons)
         latitudes.extend(row_lats)
@@ -160,13 +223,17 @@ def render_full_map(upper_left_merc, lower_right_merc, box_factor, city_array, r
         rates.extend(row_rates)
 
     data = dict(x=longitudes, y=latitudes, name=labels, rate=rates)
-    columns = ['display_string', 'formatted']
+    columns = ['display_string', 'rate', 'pop_max']
 
     if use_cache:
         cache = dict()
         cache['data'] = data
         cache['city_data'] = filtered_array[columns]
-        with open(cache_file_loc, 'wb') as handle:
+        # Other render threads and workers may be reading the file, so it is replaced in one step (with a temporary
+        # file of this thread's own)
+        temporary_loc = cache_file_loc + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(temporary_loc, 'wb') as handle:
             pickle.dump(cache, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_loc, cache_file_loc)
 
     return data, filtered_array[columns]
@@ -0,0 +1,225 @@
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+import shapely
+from shapely.geometry import Point
+
+from .coordinate_utility import display_wgs_string, get_transformer
+
+# The cities, as memory-mapped column files in one directory: one binary file per column (in WGS84 and Web Mercator
+# coordinates, the population, the category, the starting rate, the position of the region that contains the city
+# (or -1), and the names as UTF-8 with their offsets), plus a spatial index. The files are mapped read-only, so every
+# process (the Tornado workers, the Bokeh workers and their render processes) shares one copy of them through the
+# page cache, and a query only pages in what it reads. This scales to gazetteers of millions of places, which a
+# GeoDataFrame of shapely Points per process does not.
+#
+# The spatial index is a grid of cell_degrees cells over longitude and latitude. Its own copies of the coordinates and
+# populations are sorted by cell (row by row), and by descending population within a cell, with, for each of the
+# POPULATION_LEVELS, the number of cities of each cell above it. A query takes the prefix of each cell it overlaps
+# that is above its population threshold, so it reads about as many cities as it returns, from a few contiguous runs.
+#
+# The cities keep the numbering (positions) of the data they were built from.
+
+CITY_STORE_VERSION = 2
+
+# Population thresholds of the index: 0, then from 1000 up, by factors of the square root of 2
+POPULATION_LEVELS = [0.0] + [1000 * 2 ** (k / 2) for k in range(28)]
+
+COLUMN_TYPES = {
+    'lon': np.float64, 'lat': np.float64, 'x': np.float64, 'y': np.float64, 'population': np.int64,
+    'category': np.int8, 'rate': np.float64, 'region': np.int32, 'name_offsets': np.int64, 'names': np.uint8,
+    'grid_offsets': np.int64, 'grid_counts': np.int64, 'grid_cities': np.int64, 'grid_lon': np.float64,
+    'grid_lat': np.float64, 'grid_x': np.float64, 'grid_y': np.float64, 'grid_population': np.int64
+}
+
+# The cities' regions are looked up this many cities at a time, to bound the memory of their Points
+REGION_CHUNK_SIZE = 100000
+
+# Web Mercator x of longitude 180 (the inverse projection wraps beyond it)
+MERCATOR_EXTENT = 20037508.342789244
+
+
+def _write_column(directory, name, values):
+    np.ascontiguousarray(values, dtype=COLUMN_TYPES[name]).tofile(os.path.join(directory, name + '.bin'))
+
+
+# Writes a city store for the columns given (one value per city, by position) into directory, replacing the one that
+# is there. The store is built in a temporary directory first, so that a process never opens a half-written one.
+# Each city's region is its position in region_geometries (in Web Mercator coordinates, e.g. a RegionIndex's).
+def build_city_store(directory, lons, lats, populations, categories, names, rates, region_geometries, source_key=None,
+                     cell_degrees=1.0):
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    populations = np.asarray(populations, dtype=np.int64)
+    xs, ys = get_transformer(4326, 3857).transform(lons, lats)
+    region_tree = shapely.STRtree(region_geometries)
+    regions = np.full(len(lons), -1, dtype=np.int64)
+    for start in range(0, len(lons), REGION_CHUNK_SIZE):
+        end = min(len(lons), start + REGION_CHUNK_SIZE)
+        city_positions, region_positions = region_tree.query(shapely.points(xs[start:end], ys[start:end]),
+                                                             predicate='within')
+        regions[start + city_positions] = region_positions
+
+    columns = int(round(360 / cell_degrees))
+    rows = int(round(180 / cell_degrees))
+    cells = (np.clip(np.floor((lats + 90) / cell_degrees), 0, rows - 1).astype(np.int64) * columns +
+             np.clip(np.floor((lons + 180) / cell_degrees), 0, columns - 1).astype(np.int64))
+    order = np.lexsort((-populations, cells))
+    grid_offsets = np.zeros(rows * columns + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=rows * columns), out=grid_offsets[1:])
+    grid_counts = np.stack([np.bincount(cells[populations >= level], minlength=rows * columns)
+                            for level in POPULATION_LEVELS])
+
+    encoded_names = [str(name).encode('utf-8') for name in names]
+    name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+
+    temporary = directory + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, values in (('lon', lons), ('lat', lats), ('x', xs), ('y', ys), ('population', populations),
+                         ('category', categories), ('rate', rates), ('region', regions),
+                         ('name_offsets', name_offsets),
+                         ('names', np.frombuffer(b''.join(encoded_names), dtype=np.uint8)),
+                         ('grid_offsets', grid_offsets), ('grid_counts', grid_counts), ('grid_cities', order),
+                         ('grid_lon', lons[order]), ('grid_lat', lats[order]), ('grid_x', xs[order]),
+                         ('grid_y', ys[order]), ('grid_population', populations[order])):
+        _write_column(temporary, name, values)
+
+    metadata = {'version': CITY_STORE_VERSION, 'count': len(lons), 'cell_degrees': cell_degrees,
+                'columns': columns, 'rows': rows, 'levels': POPULATION_LEVELS, 'source_key': source_key}
+    with open(os.path.join(temporary, 'metadata.json'), 'w') as handle:
+        json.dump(metadata, handle)
+
+    previous = directory + '.' + str(os.getpid()) + '.old'
+    if os.path.exists(directory):
+        os.rename(directory, previous)
+    os.rename(temporary, directory)
+    # Processes that still have the previous files mapped keep them until they let go
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+class MappedCityStore:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'metadata.json'), 'r') as handle:
+            self.metadata = json.load(handle)
+        self.count = self.metadata['count']
+        self.cell_degrees = self.metadata['cell_degrees']
+        self.columns = self.metadata['columns']
+        self.rows = self.metadata['rows']
+        self.levels = np.array(self.metadata['levels'])
+
+        self.lon = self._map('lon')
+        self.lat = self._map('lat')
+        self.x = self._map('x')
+        self.y = self._map('y')
+        self.population = self._map('population')
+        self.category = self._map('category')
+        self.rate = self._map('rate')
+        self.region = self._map('region')
+        self.name_offsets = self._map('name_offsets')
+        self.names = self._map('names')
+
+        self.grid_offsets = self._map('grid_offsets')
+        self.grid_counts = self._map('grid_counts').reshape(len(self.levels), self.rows * self.columns)
+        self.grid_cities = self._map('grid_cities')
+        self.grid_lon = self._map('grid_lon')
+        self.grid_lat = self._map('grid_lat')
+        self.grid_x = self._map('grid_x')
+        self.grid_y = self._map('grid_y')
+        self.grid_population = self._map('grid_population')
+
+    # Returns None if there is no store in directory, or if it was built by another version or from other data
+    @classmethod
+    def open(cls, directory, source_key=None):
+        try:
+            store = cls(directory)
+        except (FileNotFoundError, ValueError):
+            return None
+        if store.metadata.get('version') != CITY_STORE_VERSION or store.metadata.get('source_key') != source_key:
+            return None
+        return store
+
+    # A store is pickled (e.g. with a session's rates, to a render process) as its directory, and mapped again there
+    def __reduce__(self):
+        return open_mapped_city_store, (self.directory,)
+
+    def _map(self, name):
+        file_loc = os.path.join(self.directory, name + '.bin')
+        # An empty file cannot be mapped
+        if os.path.getsize(file_loc) == 0:
+            return np.zeros(0, dtype=COLUMN_TYPES[name])
+        return np.memmap(file_loc, dtype=COLUMN_TYPES[name], mode='r')
+
+    def __len__(self):
+        return self.count
+
+    def _cell_range(self, low, high, origin, cell_count):
+        # A margin for the rounding of the projection, since the cities are filtered exactly afterwards
+        first = math.floor((np.clip(low, -origin, origin) + origin) / self.cell_degrees - 1e-9)
+        last = math.floor((np.clip(high, -origin, origin) + origin) / self.cell_degrees + 1e-9)
+        return np.arange(max(0, first), min(cell_count - 1, last) + 1)
+
+    # The positions (in ascending order) of the cities inside of bounds (min_x, min_y, max_x, max_y), edges included,
+    # with at least min_population inhabitants. The bounds are in WGS84 coordinates, or in Web Mercator if mercator
+    # is set.
+    def query(self, bounds, min_population=0, mercator=False):
+        min_x, min_y, max_x, max_y = bounds
+        if mercator:
+            (min_lon, max_lon), (min_lat, max_lat) = get_transformer(3857, 4326).transform(
+                np.clip([min_x, max_x], -MERCATOR_EXTENT, MERCATOR_EXTENT), [min_y, max_y])
+        else:
+            min_lon, min_lat, max_lon, max_lat = bounds
+        columns = self._cell_range(min_lon, max_lon, 180, self.columns)
+        rows = self._cell_range(min_lat, max_lat, 90, self.rows)
+        cells = (rows[:, None] * self.columns + columns[None, :]).ravel()
+
+        # The prefix of each cell that is above the level under min_population
+        level = max(0, np.searchsorted(self.levels, min_population, side='right') - 1)
+        starts = self.grid_offsets[cells]
+        counts = self.grid_counts[level, cells]
+        ends = np.cumsum(counts)
+        grid_positions = np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1] if len(ends) > 0 else 0)
+
+        xs = (self.grid_x if mercator else self.grid_lon)[grid_positions]
+        ys = (self.grid_y if mercator else self.grid_lat)[grid_positions]
+        inside = ((xs >= min_x) & (xs <= max_x) & (ys >= min_y) & (ys <= max_y) &
+                  (self.grid_population[grid_positions] >= min_population))
+        return np.sort(self.grid_cities[grid_positions[inside]])
+
+    def get_names(self, positions):
+        return [bytes(self.names[self.name_offsets[position]:self.name_offsets[position + 1]]).decode('utf-8')
+                for position in positions]
+
+    # E.g. "Paris (48.87°N, 2.33°E)"
+    def get_display_strings(self, positions):
+        return [name + " " + display_wgs_string(Point(lon, lat))
+                for name, lon, lat in zip(self.get_names(positions), self.lon[positions], self.lat[positions])]
+
+    # A GeoDataFrame of the cities at the positions (in Web Mercator, indexed by position), with the given rates
+    # (by position, for all of the cities) or the starting ones, for the functions that work on frames of cities
+    def get_frame(self, positions, rates=None):
+        import geopandas as gpd
+
+        positions = np.asarray(positions, dtype=np.int64)
+        rates = self.rate if rates is None else rates
+        return gpd.GeoDataFrame({'index': positions, 'name': self.get_names(positions),
+                                 'pop_max': self.population[positions],
+                                 'display_string': self.get_display_strings(positions),
+                                 'rate': np.asarray(rates[positions], dtype=float)},
+                                geometry=shapely.points(self.x[positions], self.y[positions]), index=positions)
+
+
+# The stores mapped by this process, by directory, so that unpickling a store maps it once
+_mapped_stores = dict()
+
+
+def open_mapped_city_store(directory):
+    store = _mapped_stores.get(directory)
+    if store is None:
+        store = _mapped_stores[directory] = MappedCityStore(directory)
+    return store
@@ -50,6 +50,15 @@ def map_mercator_window_to_population(upper_left, lower_right):
     return map_wgs_window_to_population(ul, lr)
 
 
+# The positions of the cities of a MappedCityStore inside of a frame (in WGS84 coordinates, or in Web Mercator if
+# mercator is set) with at least pop_threshold inhabitants, from the store's spatial index
+def get_cities_in_frame(city_store, upper_left, lower_right, pop_threshold, mercator=False):
+    min_x, max_x = sorted((upper_left[0], lower_right[0]))
+    min_y, max_y = sorted((upper_left[1], lower_right[1]))
+    return city_store.query((min_x, min_y, max_x, max_y), pop_threshold, mercator)
+
+
+# For frames of cities (e.g. the ones of a frame, from MappedCityStore.get_frame)
 def get_cities_within_geometry(geometry, city_array, pop_threshold, additional_columns=()):
     cities_in_region = city_array[city_array['geometry'].within(geometry)]
     res = cities_in_region[cities_in_region['pop_max'] >= pop_threshold]
@@ -65,3 +74,13 @@ def rate_rule(multipolygon, city_array):
         return 0
     else:
         return rates.mean()
+
+
+# The listed cities of a frame, for the city table (which formats and pages them, see city_table.py)
+def get_city_table(city_store, rates, listed):
+    # pandas is only needed by the Bokeh workers, so the Tornado server does not import it
+    import pandas as pd
+    return pd.DataFrame({'display_string': city_store.get_display_strings(listed),
+                         'rate': rates[listed],
+                         'pop_max': city_store.population[listed]},
+                        index=listed)
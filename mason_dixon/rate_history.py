@@ -0,0 +1,207 @@
+import time
+import numpy as np
+
+from .session_city_store import CityOverlay
+
+# A history of the rates that the sessions of a process receive, so that a map can be rendered for any past time
+# (see the time slider in bokeh_app.py) without refetching anything from the rate source.
+#
+# Each recorded city has a ring buffer of samples (time, rate, version) per tier, as columns of arrays with one row
+# per city. Rows are only allocated for the cities that have been recorded (in the order they came, with a sorted
+# index to find them), so the memory is set by the number of cities that the sessions looked at and by the slots, not
+# by the size of the city store. A tier is (slots, seconds): the first tier keeps the latest changes as they came,
+# and each of the others keeps one sample per bucket of that many seconds, with the time of the bucket's first change
+# and the rate (and version) of its last one. A sample evicted from a tier moves down to the next one, so older data
+# is kept at a coarser resolution, and the samples evicted from the last tier are dropped.
+#
+# A city's rate at a time is the one of its latest sample at or before it. Since the versions of a city grow with
+# time (see rate_feed.py), that is its sample of highest version among those, which is found for every city at once
+# with one argmax per chunk of cities. The versions come along with the rates, so a render for a past time can still
+# reuse the cell aggregates of the cities that did not change (see CellAggregates in tessellation.py).
+
+DEFAULT_TIERS = ((8, 0), (8, 60), (8, 3600))
+
+# The lookups are made this many cities at a time, to bound the memory of their temporary arrays
+LOOKUP_CHUNK_SIZE = 65536
+
+
+class RateHistory:
+    def __init__(self, tiers=DEFAULT_TIERS, clock=time.time, capacity=1024):
+        self.tiers = [(int(slots), float(seconds)) for slots, seconds in tiers]
+        self.offsets = np.cumsum([0] + [slots for slots, _ in self.tiers])
+        self.clock = clock
+        # The times are stored in seconds from the epoch of the history
+        self.epoch = clock()
+
+        slot_count = self.offsets[-1]
+        self.times = np.zeros((capacity, slot_count), dtype=np.float32)
+        self.rates = np.zeros((capacity, slot_count), dtype=float)
+        # A version of 0 is an empty slot
+        self.versions = np.zeros((capacity, slot_count), dtype=np.int64)
+        # The next slot of each row in each tier
+        self.heads = np.zeros((capacity, len(self.tiers)), dtype=np.int32)
+        self.latest_versions = np.zeros(capacity, dtype=np.int64)
+        # Whether a row's oldest samples were dropped (otherwise, its rate was the starting one before its samples)
+        self.dropped = np.zeros(capacity, dtype=bool)
+        # The city of each row, and the rows by city
+        self.row_cities = np.zeros(capacity, dtype=np.int64)
+        self.row_count = 0
+        self._sorted_cities = np.zeros(0, dtype=np.int64)
+        self._sorted_rows = np.zeros(0, dtype=np.int64)
+        self.recorded = 0
+
+    def __len__(self):
+        return self.row_count
+
+    # The row of each city, or -1 for the cities without one
+    def _find_rows(self, indices):
+        rows = np.full(len(indices), -1, dtype=np.int64)
+        if len(self._sorted_cities) > 0:
+            slots = np.minimum(np.searchsorted(self._sorted_cities, indices), len(self._sorted_cities) - 1)
+            found = self._sorted_cities[slots] == indices
+            rows[found] = self._sorted_rows[slots[found]]
+        return rows
+
+    # Allocates rows for the cities (which have none), growing the arrays by doubling them
+    def _add_rows(self, indices):
+        needed = self.row_count + len(indices)
+        if needed > len(self.row_cities):
+            capacity = max(needed, 2 * len(self.row_cities))
+            for name in ('times', 'rates', 'versions', 'heads', 'latest_versions', 'dropped', 'row_cities'):
+                array = getattr(self, name)
+                grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+                grown[:self.row_count] = array[:self.row_count]
+                setattr(self, name, grown)
+
+        rows = np.arange(self.row_count, needed, dtype=np.int64)
+        self.row_cities[rows] = indices
+        self.row_count = needed
+        slots = np.searchsorted(self._sorted_cities, indices)
+        self._sorted_cities = np.insert(self._sorted_cities, slots, indices)
+        self._sorted_rows = np.insert(self._sorted_rows, slots, rows)
+        return rows
+
+    # Records the rates of the cities (if their versions are newer than the ones recorded), at the current time
+    def record(self, indices, rates, versions):
+        indices = np.asarray(indices, dtype=np.int64)
+        rates = np.asarray(rates, dtype=float)
+        versions = np.asarray(versions, dtype=np.int64)
+
+        # The last occurrence of each city, if it is newer
+        unique_indices, last = np.unique(indices[::-1], return_index=True)
+        keep = len(indices) - 1 - last
+        rows = self._find_rows(unique_indices)
+        latest = np.where(rows >= 0, self.latest_versions[np.maximum(rows, 0)], 0)
+        newer = versions[keep] > latest
+        keep, rows = keep[newer], rows[newer]
+        if len(keep) == 0:
+            return 0
+
+        missing = rows < 0
+        rows[missing] = self._add_rows(indices[keep][missing])
+        self.latest_versions[rows] = versions[keep]
+        times = np.full(len(rows), self.clock() - self.epoch, dtype=np.float32)
+        self._push(0, rows, times, rates[keep], versions[keep])
+        self.recorded += len(rows)
+        return len(rows)
+
+    def _push(self, tier, rows, times, rates, versions):
+        if len(rows) == 0:
+            return
+        slots, seconds = self.tiers[tier]
+        offset = self.offsets[tier]
+
+        # A sample in the same bucket as the newest one of its city replaces its rate and version, but keeps its time,
+        # so that the bucket still covers the time of its first change
+        if seconds > 0:
+            newest = offset + (self.heads[rows, tier] - 1) % slots
+            same_bucket = ((self.versions[rows, newest] > 0) &
+                           (np.floor(self.times[rows, newest] / seconds) == np.floor(times / seconds)))
+            replaced = rows[same_bucket]
+            self.rates[replaced, newest[same_bucket]] = rates[same_bucket]
+            self.versions[replaced, newest[same_bucket]] = versions[same_bucket]
+            pushed = ~same_bucket
+            rows, times, rates, versions = rows[pushed], times[pushed], rates[pushed], versions[pushed]
+
+        slot = offset + self.heads[rows, tier]
+        evicted = self.versions[rows, slot] > 0
+        evicted_rows = rows[evicted]
+        evicted_slots = slot[evicted]
+        evicted_samples = (self.times[evicted_rows, evicted_slots], self.rates[evicted_rows, evicted_slots],
+                           self.versions[evicted_rows, evicted_slots])
+
+        self.times[rows, slot] = times
+        self.rates[rows, slot] = rates
+        self.versions[rows, slot] = versions
+        self.heads[rows, tier] = (self.heads[rows, tier] + 1) % slots
+
+        if tier + 1 < len(self.tiers):
+            self._push(tier + 1, evicted_rows, *evicted_samples)
+        else:
+            self.dropped[evicted_rows] = True
+
+    # The cities (in ascending order) that had a recorded rate at timestamp (in seconds since the Unix epoch), with
+    # those rates and their versions. The other cities have their starting rates, with a version of 0. A city whose
+    # older samples were dropped has its oldest sample before it.
+    def rates_at(self, timestamp):
+        moment = np.float32(timestamp - self.epoch)
+        found_rows, found_rates, found_versions = [], [], []
+        for start in range(0, self.row_count, LOOKUP_CHUNK_SIZE):
+            end = min(self.row_count, start + LOOKUP_CHUNK_SIZE)
+            chunk_versions = self.versions[start:end]
+            stored = chunk_versions > 0
+            candidates = np.where(stored & (self.times[start:end] <= moment), chunk_versions, 0)
+            slots = candidates.argmax(axis=1)
+
+            # The oldest sample, for the cities that have nothing before the moment but had samples dropped
+            missing = candidates[np.arange(end - start), slots] == 0
+            oldest = np.where(stored, chunk_versions, np.iinfo(np.int64).max).argmin(axis=1)
+            fallback = missing & self.dropped[start:end]
+            slots[fallback] = oldest[fallback]
+
+            found = np.nonzero(~missing | fallback)[0]
+            found_rows.append(start + found)
+            found_rates.append(self.rates[start + found, slots[found]])
+            found_versions.append(chunk_versions[found, slots[found]])
+
+        if len(found_rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=float), np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(found_rows)
+        order = np.argsort(self.row_cities[rows])
+        return self.row_cities[rows][order], np.concatenate(found_rates)[order], np.concatenate(found_versions)[order]
+
+    # The time (in seconds since the Unix epoch) of the oldest sample, or of the creation of the history
+    def start_time(self):
+        stored = self.versions[:self.row_count] > 0
+        if not stored.any():
+            return self.epoch
+        return self.epoch + float(self.times[:self.row_count][stored].min())
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.times, self.rates, self.versions, self.heads, self.latest_versions,
+                                              self.dropped, self.row_cities, self._sorted_cities, self._sorted_rows))
+
+    def stats(self):
+        return {'cities': self.row_count, 'samples': int((self.versions[:self.row_count] > 0).sum()),
+                'recorded': self.recorded, 'dropped_cities': int(self.dropped[:self.row_count].sum()),
+                'nbytes': self.nbytes()}
+
+
+# The rates of a SessionCityStore at a past time, in its place for the render queue (which only takes snapshots)
+class HistoricalCityRates:
+    def __init__(self, rate_history, city_store, timestamp):
+        self.rate_history = rate_history
+        self.city_store = city_store
+        self.timestamp = timestamp
+
+    def snapshot(self):
+        indices, rates, versions = self.rate_history.rates_at(self.timestamp)
+        city_store = self.city_store.city_store
+        return CityOverlay(city_store, 'rate', indices, rates), CityOverlay(city_store, None, indices, versions)
+
+
+def create_rate_history(cfg):
+    tiers = cfg.get("rate_history_tiers", DEFAULT_TIERS)
+    if not tiers:
+        return None
+    return RateHistory(tiers)
@@ -0,0 +1,44 @@
+import numpy as np
+import shapely
+
+from .geometric import wrap_polygon
+
+
+# A spatial index over the regions (in one coordinate system), for clipping them to a rectangular frame. Only the
+# regions whose envelope meets the frame are tested, with prepared geometries. A region that contains the whole
+# frame, or lies entirely inside of it, is clipped without computing an intersection, so at street-level zooms
+# inside of a single country, clipping costs close to nothing.
+class RegionIndex:
+    def __init__(self, region_geometries):
+        self.labels = np.asarray(region_geometries.index)
+        self.geometries = np.asarray(region_geometries.values, dtype=object)
+        self.bounds = shapely.bounds(self.geometries)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    # Returns the labels of the regions that meet the frame, and their parts inside of the frame (as MultiPolygons)
+    def clip_to_frame(self, frame_geometry):
+        positions = np.sort(self.tree.query(frame_geometry))
+        frame_min_x, frame_min_y, frame_max_x, frame_max_y = frame_geometry.bounds
+
+        labels = []
+        clipped = []
+        for position in positions:
+            region = self.geometries[position]
+            min_x, min_y, max_x, max_y = self.bounds[position]
+
+            if frame_min_x <= min_x and frame_min_y <= min_y and max_x <= frame_max_x and max_y <= frame_max_y:
+                # The frame is a rectangle, so containing the region's envelope means containing the region
+                part = region
+            elif region.contains(frame_geometry):
+                part = wrap_polygon(frame_geometry)
+            elif region.intersects(frame_geometry):
+                part = wrap_polygon(region.intersection(frame_geometry))
+            else:
+                # Only the envelopes meet
+                continue
+
+            labels.append(self.labels[position])
+            clipped.append(part)
+
+        return labels, clipped
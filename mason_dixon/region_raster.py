@@ -0,0 +1,42 @@
+import numpy as np
+import shapely
+
+# The extent of the WebMercator plane (the projection of latitudes up to about 85 degrees)
+MERCATOR_EXTENT = 20037508.342789244
+
+
+# A raster of the regions over the WebMercator plane: each pixel holds the position (in region_geometries) of the
+# region that contains its center, or -1 for the sea. It answers "which region is this point in" for any number of
+# points at once with a single array lookup, which is what the grid engine (see grid_binning.py) needs to mask its
+# cells to land. The pixels are about 40000 km / resolution wide, so near coasts and borders, the answer is only
+# as precise as that.
+class RegionRaster:
+    def __init__(self, region_geometries, resolution=2048):
+        self.labels = np.asarray(region_geometries.index)
+        self.resolution = resolution
+        self.pixel_size = 2 * MERCATOR_EXTENT / resolution
+        self.positions = np.full((resolution, resolution), -1, dtype=np.int16)
+
+        geometries = np.asarray(region_geometries.values, dtype=object)
+        shapely.prepare(geometries)
+        for position, (geometry, bounds) in enumerate(zip(geometries, shapely.bounds(geometries))):
+            if geometry is None or geometry.is_empty:
+                continue
+            min_column, min_row = self.get_pixels(bounds[0], bounds[1])
+            max_column, max_row = self.get_pixels(bounds[2], bounds[3])
+            columns, rows = np.meshgrid(np.arange(min_column, max_column + 1), np.arange(min_row, max_row + 1))
+            inside = shapely.contains_xy(geometry, *self.get_pixel_centers(columns, rows))
+            self.positions[rows[inside], columns[inside]] = position
+
+    def get_pixels(self, x, y):
+        columns = np.clip(np.floor((np.asarray(x) + MERCATOR_EXTENT) / self.pixel_size), 0, self.resolution - 1)
+        rows = np.clip(np.floor((np.asarray(y) + MERCATOR_EXTENT) / self.pixel_size), 0, self.resolution - 1)
+        return columns.astype(np.int64), rows.astype(np.int64)
+
+    def get_pixel_centers(self, columns, rows):
+        return (columns + 0.5) * self.pixel_size - MERCATOR_EXTENT, (rows + 0.5) * self.pixel_size - MERCATOR_EXTENT
+
+    # The region position of each point, or -1
+    def lookup(self, x, y):
+        columns, rows = self.get_pixels(x, y)
+        return self.positions[rows, columns].astype(np.int64)
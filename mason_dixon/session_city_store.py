@@ -0,0 +1,95 @@
+import numpy as np
+
+
+# The values of one column for every city, as the city store's column (or zeros, without one) overridden for the
+# cities at the positions 'indices' (sorted) by 'values'. Indexing it with positions gives their values, like indexing
+# an array of all of the cities would, so the renderers take it in place of one. Its memory only depends on the
+# number of cities overridden, and it refers to the city store (which is pickled as its directory, see
+# mapped_cities.py) rather than copying the column.
+class CityOverlay:
+    def __init__(self, city_store, column, indices, values):
+        self.city_store = city_store
+        self.column = column
+        self.indices = indices
+        self.values = values
+
+    def __len__(self):
+        return len(self.city_store)
+
+    def __getitem__(self, positions):
+        positions = np.asarray(positions)
+        if positions.dtype == bool:
+            positions = np.nonzero(positions)[0]
+        flat = positions.ravel().astype(np.int64, copy=False)
+
+        if self.column is None:
+            result = np.zeros(len(flat), dtype=self.values.dtype)
+        else:
+            result = np.array(getattr(self.city_store, self.column)[flat], dtype=self.values.dtype)
+        if len(self.indices) > 0:
+            slots = np.minimum(np.searchsorted(self.indices, flat), len(self.indices) - 1)
+            found = self.indices[slots] == flat
+            result[found] = self.values[slots[found]]
+        return result.reshape(positions.shape)
+
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+
+# The per-session part of the city data. The geometry and all of the other static columns are shared (read-only)
+# by every process, in the city store (see mapped_cities.py), so a session only owns the rates it fetched and their
+# versions (see rate_feed.py), for those cities only. The other cities have the city store's starting rate, with a
+# version of 0. (The city store numbers the cities by position, so a city's 'index' is also its position.)
+#
+# The arrays are replaced rather than changed in place, so that a snapshot only takes references to them.
+class SessionCityStore:
+    def __init__(self, city_store):
+        self.city_store = city_store
+        self.indices = np.zeros(0, dtype=np.int64)
+        self._rates = np.zeros(0, dtype=float)
+        self._versions = np.zeros(0, dtype=np.int64)
+
+    # The rates and versions of every city
+    @property
+    def rates(self):
+        return CityOverlay(self.city_store, 'rate', self.indices, self._rates)
+
+    @property
+    def updates(self):
+        return CityOverlay(self.city_store, None, self.indices, self._versions)
+
+    # Only the cities whose update is newer than what the session has are changed (their number is returned), so the
+    # cost depends on the number of cities in the update and that the session holds, not on the size of the store.
+    def apply_updates(self, indices, rates, update_counters):
+        indices = np.asarray(indices, dtype=np.int64)
+        newer = np.asarray(update_counters) > self.updates[indices]
+        if not newer.any():
+            return 0
+
+        # The last update of each city, if a message has several
+        changed, last = np.unique(indices[newer][::-1], return_index=True)
+        changed_rates = np.asarray(rates, dtype=float)[newer][::-1][last]
+        changed_versions = np.asarray(update_counters, dtype=np.int64)[newer][::-1][last]
+
+        slots = np.searchsorted(self.indices, changed)
+        known = slots < len(self.indices)
+        known[known] = self.indices[slots[known]] == changed[known]
+
+        rates_copy = self._rates.copy()
+        versions_copy = self._versions.copy()
+        rates_copy[slots[known]] = changed_rates[known]
+        versions_copy[slots[known]] = changed_versions[known]
+
+        added = ~known
+        self.indices = np.insert(self.indices, slots[added], changed[added])
+        self._rates = np.insert(rates_copy, slots[added], changed_rates[added])
+        self._versions = np.insert(versions_copy, slots[added], changed_versions[added])
+        return len(changed)
+
+    # The session's rates and versions as they are now, e.g. to render from another thread or process while updates
+    # keep arriving
+    def snapshot(self):
+        return self.rates, self.updates
+
+    def nbytes(self):
+        return self.indices.nbytes + self._rates.nbytes + self._versions.nbytes
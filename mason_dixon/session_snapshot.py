@@ -0,0 +1,103 @@
+import logging
+import os
+import pickle
+import re
+import time
+import zlib
+
+# Snapshots of Bokeh sessions, so that a browser that reloads its tab (or loses its connection) gets its map back
+# without a cold start: the viewport, the session's rate overlay (only the cities whose rates it fetched, with their
+# versions) and the last rendered frame and city table. A snapshot is keyed by the browser's snapshot cookie (see
+# main.py), and saved as a compressed pickle in one directory, shared by the Bokeh workers of a host. The least
+# recently saved snapshots are evicted beyond max_bytes.
+
+SNAPSHOT_VERSION = 1
+
+# Keys come from a cookie, so only uuids are accepted as file names
+KEY_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+def is_valid_key(key):
+    return key is not None and KEY_PATTERN.match(key) is not None
+
+
+class SessionSnapshot:
+    # rates and updates are the overlays of a SessionCityStore's snapshot
+    def __init__(self, upper_left_merc, lower_right_merc, rates, updates, rect_data, table_data):
+        self.upper_left_merc = upper_left_merc
+        self.lower_right_merc = lower_right_merc
+        self.indices = updates.indices
+        self.rates = rates.values
+        self.updates = updates.values
+        self.rect_data = rect_data
+        self.table_data = table_data
+        self.time = time.time()
+
+    # Applies the rate overlay to a SessionCityStore
+    def restore_rates(self, city_store):
+        city_store.apply_updates(self.indices, self.rates, self.updates)
+
+
+class SessionSnapshotStore:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.saved = 0
+        self.restored = 0
+        self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _file_loc(self, key):
+        return os.path.join(self.directory, key + '.snapshot')
+
+    # Called off the IO loop (pickling a frame takes a few milliseconds)
+    def save(self, key, snapshot):
+        if not is_valid_key(key):
+            return
+        file_loc = self._file_loc(key)
+        temporary_loc = file_loc + '.' + str(os.getpid()) + '.tmp'
+        data = zlib.compress(pickle.dumps((SNAPSHOT_VERSION, snapshot), protocol=pickle.HIGHEST_PROTOCOL), 1)
+        with open(temporary_loc, 'wb') as handle:
+            handle.write(data)
+        os.replace(temporary_loc, file_loc)
+        self.saved += 1
+
+    # Returns None if there is no (usable) snapshot for the key
+    def load(self, key):
+        if not is_valid_key(key):
+            return None
+        try:
+            with open(self._file_loc(key), 'rb') as handle:
+                version, snapshot = pickle.loads(zlib.decompress(handle.read()))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Could not load the session snapshot " + key + ": " + str(e))
+            return None
+
+        if version != SNAPSHOT_VERSION:
+            return None
+        self.restored += 1
+        return snapshot
+
+    # Deletes the least recently saved snapshots until they fit in max_bytes
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.snapshot'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evicted += 1
+
+    def stats(self):
+        return {'saved': self.saved, 'restored': self.restored, 'evicted': self.evicted}
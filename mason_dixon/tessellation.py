@@ -0,0 +1,405 @@
+import math
+import threading
+import time
+import weakref
+import numpy as np
+import shapely
+
+from collections import OrderedDict
+from shapely.geometry import Point
+from shapely.ops import unary_union
+from .box_cache import get_bracket, get_bracket_extent
+from .geometric import wrap_polygon, conditionally_split_multipolygon, unroll_multipolygon
+from . import municipal_data_utility as mun_util
+
+
+# Tile-aligned tessellation. For each zoom bracket (see box_cache.py), the plane is cut into a grid of tiles of the
+# bracket's extent, and each tile is tessellated on its own: city boxes and split remainders, per region, exactly as
+# render_full_map does for a frame. A tile's tessellation does not depend on the rates, so it is cached and shared by
+# every session of the process, and a frame is rendered by clipping the cells of the (at most four) tiles it
+# overlaps and averaging the rates of each cell's cities.
+#
+# Since tiles do not move when the view pans, the tiles around the view can be computed ahead of time (see
+# RenderQueue's prefetching). And since a tile is computed region by region, a frame can also be rendered
+# progressively: the regions themselves first, coloured by their mean rate, then their cells as they are computed.
+#
+# A tile can be tessellated at several levels of detail (see level_of_detail.py), from the finest (what box_factor
+# and city_box_proportion ask for) down. Each level is (split factor, box population factor, simplification): the
+# split factor scales box_factor (fewer, larger split cells), the box population factor raises the population above
+# which a city gets its own box, and the simplification is a tolerance for the region outlines, as a fraction of the
+# tile's width. The level is part of the tile's key.
+LEVELS_OF_DETAIL = (
+    (1.0, 1.0, 0.0),
+    (0.5, 2.0, 0.0005),
+    (0.25, 4.0, 0.002),
+    (0.125, 8.0, 0.005),
+)
+
+
+class TileTessellation:
+    def __init__(self, geometries, names, member_cells, member_cities, little_population):
+        self.geometries = geometries
+        self.names = names
+        # One entry per (cell, city) pair, for the cities that count towards the cell's rate
+        self.member_cells = member_cells
+        self.member_cities = member_cities
+        self.little_population = little_population
+
+
+def merge_tile_parts(parts):
+    if len(parts) == 0:
+        return TileTessellation([], [], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0)
+
+    geometries = []
+    names = []
+    member_cells = []
+    for part in parts:
+        member_cells.append(part.member_cells + len(geometries))
+        geometries.extend(part.geometries)
+        names.extend(part.names)
+    return TileTessellation(geometries, names, np.concatenate(member_cells),
+                            np.concatenate([part.member_cities for part in parts]), parts[0].little_population)
+
+
+def get_tile_bounds(width_bracket, height_bracket, i, j):
+    tile_width = get_bracket_extent(width_bracket)
+    tile_height = get_bracket_extent(height_bracket)
+    return i * tile_width, j * tile_height, (i + 1) * tile_width, (j + 1) * tile_height
+
+
+# The thresholds only depend on the width of the tile, so they are the same for all of the tiles of a bracket
+def get_population_thresholds(width_bracket, height_bracket, i, j):
+    min_x, min_y, max_x, max_y = get_tile_bounds(width_bracket, height_bracket, i, j)
+    return mun_util.map_mercator_window_to_population(Point(min_x, max_y), Point(max_x, min_y))
+
+
+# Whether each of the positions is one of sorted_positions (e.g. the result of a MappedCityStore query)
+def isin_sorted(positions, sorted_positions):
+    if len(sorted_positions) == 0:
+        return np.zeros(len(positions), dtype=bool)
+    found = np.minimum(np.searchsorted(sorted_positions, positions), len(sorted_positions) - 1)
+    return sorted_positions[found] == positions
+
+
+# One session's rate totals and counts per cell, memoized per tile along with the update counters of the tile's member
+# cities (a version vector). When a chunk of city updates comes in, only the cells that contain an updated city are
+# summed again. A cell is identified by its tile (or tile part) and its position in it; the entries go away with the
+# tiles, when they are evicted from the tile cache.
+class CellAggregates:
+    def __init__(self):
+        self._entries = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.recomputed = 0
+
+    def get_totals(self, tile, rates, updates):
+        versions = updates[tile.member_cities]
+        with self._lock:
+            entry = self._entries.get(tile)
+
+        cell_count = len(tile.geometries)
+        if entry is None:
+            totals = np.bincount(tile.member_cells, weights=rates[tile.member_cities], minlength=cell_count)
+            counts = np.bincount(tile.member_cells, minlength=cell_count)
+            recomputed = cell_count
+        else:
+            previous_versions, totals, counts = entry
+            changed = versions != previous_versions
+            if not changed.any():
+                with self._lock:
+                    self.reused += cell_count
+                return totals, counts
+
+            cells = np.unique(tile.member_cells[changed])
+            members = np.isin(tile.member_cells, cells)
+            totals = totals.copy()
+            totals[cells] = np.bincount(tile.member_cells[members], weights=rates[tile.member_cities[members]],
+                                        minlength=cell_count)[cells]
+            recomputed = len(cells)
+
+        # The counters are shared by the render and prefetch threads too
+        with self._lock:
+            self._entries[tile] = (versions, totals, counts)
+            self.recomputed += recomputed
+            self.reused += cell_count - recomputed
+        return totals, counts
+
+
+# The cities are read from a MappedCityStore (see mapped_cities.py), through its spatial index. Their Points are only
+# made for the cities that a tile needs.
+class Tessellator:
+    def __init__(self, region_dataframe, city_store, region_index, box_cache, max_tiles=2000):
+        self.region_names = region_dataframe['SOVEREIGNT']
+        self.region_geometries = region_dataframe['mercator']
+        self.region_index = region_index
+        self.box_cache = box_cache
+
+        self.city_store = city_store
+        self.city_x = city_store.x
+        self.city_y = city_store.y
+
+        # The city store's region column holds positions in the region index
+        self.region_positions = {label: position for position, label in enumerate(region_index.labels)}
+
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # The key of every tile that a frame overlaps. Parameters that change the tessellation are part of the key.
+    def get_tile_keys(self, upper_left_merc, lower_right_merc, box_factor, city_box_proportion, level=0):
+        min_x, max_x = sorted((upper_left_merc.x, lower_right_merc.x))
+        min_y, max_y = sorted((upper_left_merc.y, lower_right_merc.y))
+        width_bracket = get_bracket(max_x - min_x)
+        height_bracket = get_bracket(max_y - min_y)
+        tile_width = get_bracket_extent(width_bracket)
+        tile_height = get_bracket_extent(height_bracket)
+
+        return [(width_bracket, height_bracket, i, j, box_factor, city_box_proportion, level)
+                for i in range(math.floor(min_x / tile_width), math.floor(max_x / tile_width) + 1)
+                for j in range(math.floor(min_y / tile_height), math.floor(max_y / tile_height) + 1)]
+
+    def has_tile(self, key):
+        with self._lock:
+            return key in self._tiles
+
+    def get_tile(self, key):
+        parts = list(self.iter_tile(key))
+        if len(parts) == 1:
+            return parts[0]
+        # The cached tile, rather than another merge of its parts, so that it is the same object on the next render
+        with self._lock:
+            tile = self._tiles.get(key)
+        return tile if tile is not None else merge_tile_parts(parts)
+
+    # Yields the tile in parts: all at once if it is cached, region by region (as they are computed) otherwise.
+    # The tile is only cached if it is iterated to the end.
+    def iter_tile(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+        if tile is not None:
+            yield tile
+            return
+
+        # Computed outside of the lock. Two threads may compute the same tile, which is harmless.
+        parts = []
+        for part in self.iter_tile_regions(*key):
+            parts.append(part)
+            yield part
+        tile = merge_tile_parts(parts)
+
+        with self._lock:
+            self.misses += 1
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    # The cities that get a box in a tile. A city just outside of the tile can have its box reach into it.
+    def get_box_cities(self, width_bracket, height_bracket, i, j, box_factor, city_box_proportion, level=0):
+        min_x, min_y, max_x, max_y = get_tile_bounds(width_bracket, height_bracket, i, j)
+        big_population = get_population_thresholds(width_bracket, height_bracket, i, j)[1] * LEVELS_OF_DETAIL[level][1]
+        half_width = 0.5 * city_box_proportion * (max_x - min_x)
+        half_height = 0.5 * city_box_proportion * (max_y - min_y)
+        return self.city_store.query((min_x - half_width, min_y - half_height, max_x + half_width,
+                                      max_y + half_height), big_population, mercator=True)
+
+    # One TileTessellation per region of the tile
+    def iter_tile_regions(self, width_bracket, height_bracket, i, j, box_factor, city_box_proportion, level=0):
+        min_x, min_y, max_x, max_y = get_tile_bounds(width_bracket, height_bracket, i, j)
+        tile_geometry = shapely.box(min_x, min_y, max_x, max_y)
+
+        split_factor, _, simplification = LEVELS_OF_DETAIL[level]
+        little_population = get_population_thresholds(width_bracket, height_bracket, i, j)[0]
+        max_size = tile_geometry.area / (box_factor * split_factor)
+        box_cities = self.get_box_cities(width_bracket, height_bracket, i, j, box_factor, city_box_proportion, level)
+
+        # The cities that count towards the rates of the cells
+        rated_cities = self.city_store.query((min_x, min_y, max_x, max_y), little_population, mercator=True)
+        box_points = shapely.points(self.city_x[box_cities], self.city_y[box_cities])
+
+        region_labels, clipped_regions = self.region_index.clip_to_frame(tile_geometry)
+        for region_label, region_part in zip(region_labels, clipped_regions):
+            if simplification > 0:
+                region_part = wrap_polygon(region_part.simplify(simplification * (max_x - min_x)))
+                if region_part.is_empty:
+                    continue
+            region_geometry = self.region_geometries[region_label]
+            name = self.region_names[region_label]
+            in_region = shapely.contains(region_geometry, box_points)
+
+            boxes = []
+            for city_index, city_point in zip(box_cities[in_region], box_points[in_region]):
+                box = self.box_cache.get_box_in_frame(city_index, city_point, region_label,
+                                                      width_bracket, height_bracket, city_box_proportion,
+                                                      tile_geometry)
+                for previous_box in boxes:
+                    if box.intersects(previous_box):
+                        box = wrap_polygon(box.difference(previous_box))
+                if not box.is_empty:
+                    boxes.append(box)
+
+            if len(boxes) > 0:
+                remainder = wrap_polygon(region_part.difference(unary_union(boxes)))
+            else:
+                remainder = region_part
+
+            cells = boxes + [cell for cell in conditionally_split_multipolygon(remainder, max_size)
+                             if not cell.is_empty]
+            if len(cells) == 0:
+                continue
+
+            part_min_x, part_min_y, part_max_x, part_max_y = region_part.bounds
+            candidates = rated_cities[(self.city_x[rated_cities] >= part_min_x) &
+                                      (self.city_x[rated_cities] <= part_max_x) &
+                                      (self.city_y[rated_cities] >= part_min_y) &
+                                      (self.city_y[rated_cities] <= part_max_y)]
+            city_positions, member_cells = shapely.STRtree(cells).query(
+                shapely.points(self.city_x[candidates], self.city_y[candidates]), predicate='within')
+
+            yield TileTessellation(cells, [name] * len(cells), member_cells, candidates[city_positions],
+                                   little_population)
+
+    # The cells of a (part of a) tile inside of the frame, with the mean rate of their cities inside of the frame
+    # (frame_cities, the positions of the frame's cities that count towards the rates, in ascending order). With a
+    # session's CellAggregates, the per-cell sums come from there, less the cities outside of the frame (which only
+    # the cells across the frame's edge have).
+    def clip_cells_to_frame(self, tile, rates, frame_cities, frame_geometry, updates=None, aggregates=None):
+        min_x, min_y, max_x, max_y = frame_geometry.bounds
+        cell_count = len(tile.geometries)
+        if aggregates is None:
+            members = isin_sorted(tile.member_cities, frame_cities)
+            totals = np.bincount(tile.member_cells[members], weights=rates[tile.member_cities[members]],
+                                 minlength=cell_count)
+            counts = np.bincount(tile.member_cells[members], minlength=cell_count)
+        else:
+            totals, counts = aggregates.get_totals(tile, rates, updates)
+            outside = ~isin_sorted(tile.member_cities, frame_cities)
+            if outside.any():
+                totals = totals - np.bincount(tile.member_cells[outside],
+                                              weights=rates[tile.member_cities[outside]], minlength=cell_count)
+                counts = counts - np.bincount(tile.member_cells[outside], minlength=cell_count)
+        means = np.divide(totals, counts, out=np.zeros(cell_count), where=counts > 0)
+
+        longitudes = []
+        latitudes = []
+        labels = []
+        cell_rates = []
+        for cell, name, rate in zip(tile.geometries, tile.names, means):
+            cell_min_x, cell_min_y, cell_max_x, cell_max_y = cell.bounds
+            if min_x <= cell_min_x and min_y <= cell_min_y and cell_max_x <= max_x and cell_max_y <= max_y:
+                clipped = cell
+            elif cell_max_x < min_x or cell_min_x > max_x or cell_max_y < min_y or cell_min_y > max_y:
+                continue
+            else:
+                clipped = wrap_polygon(cell.intersection(frame_geometry))
+                if clipped.is_empty:
+                    continue
+
+            longitudes.append(unroll_multipolygon(clipped, 0))
+            latitudes.append(unroll_multipolygon(clipped, 1))
+            labels.append(name)
+            cell_rates.append(rate)
+
+        return dict(x=longitudes, y=latitudes, name=labels, rate=cell_rates)
+
+    def get_city_data(self, rates, frame_cities):
+        return mun_util.get_city_table(self.city_store, rates, frame_cities)
+
+    # Renders a frame for one session's rates, in the format of render_full_map. A cell's rate is the mean rate of
+    # its cities (as in municipal_data_utility.rate_rule), counting only the cities inside of the frame. 'updates'
+    # and 'aggregates' (the session's update counters and CellAggregates) are optional. If a 'timings' dict is
+    # given, the seconds spent on each stage ('tiles', 'clip' and 'table') are added to it.
+    def render_frame(self, rates, upper_left_merc, lower_right_merc, box_factor, city_box_proportion, updates=None,
+                     aggregates=None, level=0, timings=None):
+        stage_timer = StageTimer(timings)
+        keys = self.get_tile_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion, level)
+        frame_geometry, frame_cities = self.get_frame(upper_left_merc, lower_right_merc,
+                                                      get_population_thresholds(*keys[0][:4])[0])
+
+        data = dict(x=[], y=[], name=[], rate=[])
+        for key in keys:
+            tile = self.get_tile(key)
+            stage_timer.mark('tiles')
+            cells = self.clip_cells_to_frame(tile, rates, frame_cities, frame_geometry, updates, aggregates)
+            for column, values in cells.items():
+                data[column].extend(values)
+            stage_timer.mark('clip')
+
+        city_data = self.get_city_data(rates, frame_cities)
+        stage_timer.mark('table')
+        return data, city_data
+
+    # The regions inside of the frame, each with the mean rate of its cities inside of the frame. Cheap enough
+    # (one clip per region, through the region index) to be shown while the cells are computed.
+    def render_coarse_frame(self, rates, upper_left_merc, lower_right_merc, box_factor, city_box_proportion):
+        key = self.get_tile_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion)[0]
+        frame_geometry, rated = self.get_frame(upper_left_merc, lower_right_merc,
+                                               get_population_thresholds(*key[:4])[0])
+
+        city_regions = np.asarray(self.city_store.region[rated], dtype=np.int64)
+        in_region = city_regions >= 0
+        region_count = len(self.region_index.labels)
+        totals = np.bincount(city_regions[in_region], weights=rates[rated[in_region]], minlength=region_count)
+        counts = np.bincount(city_regions[in_region], minlength=region_count)
+        means = np.divide(totals, counts, out=np.zeros(region_count), where=counts > 0)
+
+        region_labels, clipped_regions = self.region_index.clip_to_frame(frame_geometry)
+        return dict(x=[unroll_multipolygon(region, 0) for region in clipped_regions],
+                    y=[unroll_multipolygon(region, 1) for region in clipped_regions],
+                    name=[self.region_names[label] for label in region_labels],
+                    rate=[means[self.region_positions[label]] for label in region_labels])
+
+    # Progressive rendering: emit('coarse', data) with the coarse frame first, then emit('cells', data) for the cells
+    # of each region of each tile, as they become available. Returns the city table at the end, or None if
+    # cancelled() became true on the way.
+    def render_frame_progressively(self, rates, upper_left_merc, lower_right_merc, box_factor, city_box_proportion,
+                                   emit, cancelled, updates=None, aggregates=None, level=0, timings=None):
+        stage_timer = StageTimer(timings)
+        keys = self.get_tile_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion, level)
+        frame_geometry, frame_cities = self.get_frame(upper_left_merc, lower_right_merc,
+                                                      get_population_thresholds(*keys[0][:4])[0])
+
+        emit('coarse', self.render_coarse_frame(rates, upper_left_merc, lower_right_merc, box_factor,
+                                                city_box_proportion))
+        stage_timer.mark('clip')
+        for key in keys:
+            for part in self.iter_tile(key):
+                stage_timer.mark('tiles')
+                if cancelled():
+                    return None
+                emit('cells', self.clip_cells_to_frame(part, rates, frame_cities, frame_geometry, updates,
+                                                       aggregates))
+                stage_timer.mark('clip')
+
+        city_data = self.get_city_data(rates, frame_cities)
+        stage_timer.mark('table')
+        return city_data
+
+    # The frame, and the positions of its cities with at least little_population inhabitants (the ones that count
+    # towards the rates of the cells of its tiles, and that are listed in the city table), in ascending order
+    def get_frame(self, upper_left_merc, lower_right_merc, little_population):
+        min_x, max_x = sorted((upper_left_merc.x, lower_right_merc.x))
+        min_y, max_y = sorted((upper_left_merc.y, lower_right_merc.y))
+        frame_cities = self.city_store.query((min_x, min_y, max_x, max_y), little_population, mercator=True)
+        return shapely.box(min_x, min_y, max_x, max_y), frame_cities
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+# Adds the time since the previous mark to a stage of 'timings' (if there is one)
+class StageTimer:
+    def __init__(self, timings):
+        self.timings = timings
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        if self.timings is None:
+            return
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self._last
+        self._last = now
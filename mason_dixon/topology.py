@@ -0,0 +1,288 @@
+import itertools
+
+import numpy as np
+
+# Topology encoding of map data (the x/y/name/rate columns of the renderers), in the style of TopoJSON. Neighbouring
+# cells (and regions) share their borders, and every shared border is in the x and y columns of both of them as
+# float64 lists. Encoded, the outlines are cut into arcs where they meet, each arc is stored once (a ring that runs
+# along it the other way round refers to it reversed), and the points are quantized to a grid over the frame and
+# delta-encoded as small integers. The browser decodes it (TOPOLOGY_DECODER_JS) into the source of the glyphs.
+#
+# A payload is a dict of:
+# - transform: [x0, y0, kx, ky], a quantized point (qx, qy) is at (x0 + qx * kx, y0 + qy * ky)
+# - arc_x, arc_y: the quantized points of the arcs, each arc's first point as is, the rest as differences to the
+#   point before, and arc_offsets: where each arc starts in them (with the end of the last one)
+# - ring_arcs: the arcs of each ring, an arc i as i, or as ~i if it is reversed, and ring_offsets: where each ring
+#   starts in ring_arcs. Consecutive arcs of a ring share their end and start points.
+# - polygon_offsets: where the rings of each polygon start (the exterior, then the holes), and cell_offsets: where
+#   the polygons of each cell start
+# - name, rate: as in the map data
+
+TOPOLOGY_COLUMNS = ('transform', 'arc_x', 'arc_y', 'arc_offsets', 'ring_arcs', 'ring_offsets', 'polygon_offsets',
+                    'cell_offsets', 'name', 'rate')
+
+
+def is_topology(data):
+    return 'arc_offsets' in data
+
+
+def empty_topology():
+    return {column: [] for column in TOPOLOGY_COLUMNS}
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+# Integers are sent in 16 bits where they fit
+def _narrow(values):
+    values = np.asarray(values, dtype=np.int64)
+    if np.abs(values).max(initial=0) < 2 ** 15:
+        return values.astype(np.int16)
+    return values.astype(np.int32)
+
+
+# bounds (min_x, min_y, max_x, max_y) sets the grid of the quantization, e.g. the frame, so that the batches of a
+# progressive render share it (and their borders meet). By default, it is the extent of the data.
+def encode_topology(data, bounds=None, quantization=10000):
+    polygon_counts = []
+    ring_counts = []
+    ring_lengths = []
+    rings_x = []
+    rings_y = []
+    for cell_x, cell_y in zip(data['x'], data['y']):
+        polygon_counts.append(len(cell_x))
+        for polygon_x, polygon_y in zip(cell_x, cell_y):
+            ring_counts.append(len(polygon_x))
+            for ring_x, ring_y in zip(polygon_x, polygon_y):
+                ring_lengths.append(len(ring_x))
+                rings_x.append(ring_x)
+                rings_y.append(ring_y)
+
+    point_count = sum(ring_lengths)
+    xs = np.fromiter(itertools.chain.from_iterable(rings_x), dtype=float, count=point_count)
+    ys = np.fromiter(itertools.chain.from_iterable(rings_y), dtype=float, count=point_count)
+
+    if bounds is None:
+        bounds = (xs.min(), ys.min(), xs.max(), ys.max()) if point_count > 0 else (0.0, 0.0, 1.0, 1.0)
+    min_x, min_y, max_x, max_y = bounds
+    kx = (max_x - min_x) / (quantization - 1) or 1.0
+    ky = (max_y - min_y) / (quantization - 1) or 1.0
+    qx = np.rint((xs - min_x) / kx).astype(np.int64)
+    qy = np.rint((ys - min_y) / ky).astype(np.int64)
+    keys = (qx << 32) + (qy & 0xffffffff)
+
+    # Points that fall on the previous point of their ring (after quantization) are dropped, and so is the point
+    # that closes a ring, so that the rings are cycles
+    ring_lengths = np.array(ring_lengths, dtype=np.int64)
+    ring_ids = np.repeat(np.arange(len(ring_lengths)), ring_lengths)
+    starts = _offsets(ring_lengths)[:-1]
+    keep = np.ones(point_count, dtype=bool)
+    keep[1:] = keys[1:] != keys[:-1]
+    keep[starts[ring_lengths > 0]] = True
+    ends = starts + ring_lengths - 1
+    closed = (ring_lengths > 1) & (keys[ends] == keys[starts])
+    keep[ends[closed]] = False
+
+    qx, qy, keys, ring_ids = qx[keep], qy[keep], keys[keep], ring_ids[keep]
+    ring_lengths = np.bincount(ring_ids, minlength=len(ring_lengths))
+    starts = _offsets(ring_lengths)[:-1]
+
+    # A junction is a point with different neighbours in different rings (or in different places of one ring).
+    # Rings are cut into arcs at their junctions.
+    lengths = np.maximum(ring_lengths[ring_ids], 1)
+    positions = np.arange(len(keys)) - starts[ring_ids]
+    previous_keys = keys[starts[ring_ids] + (positions - 1) % lengths]
+    next_keys = keys[starts[ring_ids] + (positions + 1) % lengths]
+    neighbourhoods = np.unique(np.stack([keys, np.minimum(previous_keys, next_keys),
+                                         np.maximum(previous_keys, next_keys)], axis=1), axis=0)
+    point_keys, neighbourhood_counts = np.unique(neighbourhoods[:, 0], return_counts=True)
+    is_junction = np.isin(keys, point_keys[neighbourhood_counts > 1])
+
+    arc_ids = dict()
+    arc_points = []
+    ring_arcs = []
+    ring_arc_counts = []
+    for start, length in zip(starts.tolist(), ring_lengths.tolist()):
+        ring = np.arange(start, start + length)
+        junctions = np.flatnonzero(is_junction[start:start + length])
+        if length == 0:
+            ring_arc_counts.append(0)
+            continue
+        if len(junctions) == 0:
+            # A ring that meets no other one is a single closed arc, which starts at its lowest point (so that it is
+            # shared with a ring that runs along the same points, e.g. a hole and the island that fills it)
+            ring = np.roll(ring, -int(np.argmin(keys[ring])))
+            cuts = [0, length]
+        else:
+            ring = np.roll(ring, -int(junctions[0]))
+            cuts = (junctions - junctions[0]).tolist() + [length]
+        ring = np.append(ring, ring[0])
+
+        for cut_start, cut_end in zip(cuts[:-1], cuts[1:]):
+            arc = ring[cut_start:cut_end + 1]
+            arc_keys = keys[arc]
+            forward = arc_keys.tobytes()
+            if forward in arc_ids:
+                ring_arcs.append(arc_ids[forward])
+                continue
+            backward = arc_keys[::-1].tobytes()
+            if backward in arc_ids:
+                ring_arcs.append(~arc_ids[backward])
+                continue
+            arc_ids[forward] = len(arc_points)
+            ring_arcs.append(len(arc_points))
+            arc_points.append(arc)
+        ring_arc_counts.append(len(cuts) - 1)
+
+    arc_offsets = _offsets([len(arc) for arc in arc_points])
+    points = np.concatenate(arc_points) if len(arc_points) > 0 else np.array([], dtype=np.int64)
+    arc_x = np.diff(qx[points], prepend=0)
+    arc_y = np.diff(qy[points], prepend=0)
+    arc_x[arc_offsets[:-1]] = qx[points[arc_offsets[:-1]]]
+    arc_y[arc_offsets[:-1]] = qy[points[arc_offsets[:-1]]]
+
+    return dict(transform=np.array([min_x, min_y, kx, ky]), arc_x=_narrow(arc_x), arc_y=_narrow(arc_y),
+                arc_offsets=_narrow(arc_offsets), ring_arcs=_narrow(ring_arcs),
+                ring_offsets=_narrow(_offsets(ring_arc_counts)), polygon_offsets=_narrow(_offsets(ring_counts)),
+                cell_offsets=_narrow(_offsets(polygon_counts)), name=list(data['name']),
+                rate=np.asarray(data['rate'], dtype=float))
+
+
+# The map data of a payload (with closed rings), as TOPOLOGY_DECODER_JS decodes it
+def decode_topology(payload):
+    x0, y0, kx, ky = payload['transform']
+    arc_offsets = payload['arc_offsets']
+    arc_x = np.cumsum(payload['arc_x'].astype(np.int64))
+    arc_y = np.cumsum(payload['arc_y'].astype(np.int64))
+    # The cumulative sums run over all of the arcs, so each arc is rebased on the sum before its first point
+    starts = arc_offsets[:-1]
+    lengths = np.diff(arc_offsets)
+    base_x = np.repeat(arc_x[starts] - payload['arc_x'][starts], lengths)
+    base_y = np.repeat(arc_y[starts] - payload['arc_y'][starts], lengths)
+    xs = x0 + (arc_x - base_x) * kx
+    ys = y0 + (arc_y - base_y) * ky
+
+    def get_ring(ring):
+        ring_x = []
+        ring_y = []
+        for arc in payload['ring_arcs'][payload['ring_offsets'][ring]:payload['ring_offsets'][ring + 1]].tolist():
+            start, end = arc_offsets[~arc if arc < 0 else arc], arc_offsets[(~arc if arc < 0 else arc) + 1]
+            step = -1 if arc < 0 else 1
+            # Consecutive arcs share a point
+            skip = 1 if len(ring_x) > 0 else 0
+            ring_x.extend(xs[start:end][::step][skip:].tolist())
+            ring_y.extend(ys[start:end][::step][skip:].tolist())
+        if len(ring_x) > 0 and (ring_x[0] != ring_x[-1] or ring_y[0] != ring_y[-1]):
+            ring_x.append(ring_x[0])
+            ring_y.append(ring_y[0])
+        return ring_x, ring_y
+
+    polygon_offsets = payload['polygon_offsets']
+    cell_offsets = payload['cell_offsets']
+    data = dict(x=[], y=[], name=list(payload['name']), rate=list(payload['rate']))
+    for cell in range(len(cell_offsets) - 1):
+        cell_x = []
+        cell_y = []
+        for polygon in range(cell_offsets[cell], cell_offsets[cell + 1]):
+            rings = [get_ring(ring) for ring in range(polygon_offsets[polygon], polygon_offsets[polygon + 1])]
+            cell_x.append([ring_x for ring_x, _ in rings])
+            cell_y.append([ring_y for _, ring_y in rings])
+        data['x'].append(cell_x)
+        data['y'].append(cell_y)
+    return data
+
+
+# The map data of a list of payloads (e.g. the batches of a progressive render), concatenated
+def decode_topologies(payloads):
+    data = dict(x=[], y=[], name=[], rate=[])
+    for payload in payloads:
+        for column, values in decode_topology(payload).items():
+            data[column].extend(values)
+    return data
+
+
+# A CustomJS for the change of a ColumnDataSource of payloads (one per row, with the TOPOLOGY_COLUMNS), with the
+# args target (the ColumnDataSource of the glyphs) and mode: 'replace' decodes all of the rows into target, 'append'
+# (for the 'streaming' of the payloads) only decodes the rows that were streamed in since the last call. target is
+# only changed in the browser (sync: false), so the decoded points are not sent back to the server.
+TOPOLOGY_DECODER_JS = """
+function decode(data, row, out) {
+    const [x0, y0, kx, ky] = data.transform[row]
+    const arc_x = data.arc_x[row], arc_y = data.arc_y[row], arc_offsets = data.arc_offsets[row]
+    const ring_arcs = data.ring_arcs[row], ring_offsets = data.ring_offsets[row]
+    const polygon_offsets = data.polygon_offsets[row], cell_offsets = data.cell_offsets[row]
+
+    const xs = new Float64Array(arc_x.length), ys = new Float64Array(arc_y.length)
+    for (let arc = 0; arc < arc_offsets.length - 1; arc++) {
+        let qx = 0, qy = 0
+        for (let i = arc_offsets[arc]; i < arc_offsets[arc + 1]; i++) {
+            qx += arc_x[i]
+            qy += arc_y[i]
+            xs[i] = x0 + qx * kx
+            ys[i] = y0 + qy * ky
+        }
+    }
+
+    function ring_points(ring) {
+        const ring_x = [], ring_y = []
+        for (let k = ring_offsets[ring]; k < ring_offsets[ring + 1]; k++) {
+            const arc = ring_arcs[k]
+            const index = arc < 0 ? ~arc : arc
+            const start = arc_offsets[index], end = arc_offsets[index + 1]
+            const skip = ring_x.length > 0 ? 1 : 0
+            if (arc < 0) {
+                for (let i = end - 1 - skip; i >= start; i--) {
+                    ring_x.push(xs[i])
+                    ring_y.push(ys[i])
+                }
+            } else {
+                for (let i = start + skip; i < end; i++) {
+                    ring_x.push(xs[i])
+                    ring_y.push(ys[i])
+                }
+            }
+        }
+        const last = ring_x.length - 1
+        if (last > 0 && (ring_x[0] != ring_x[last] || ring_y[0] != ring_y[last])) {
+            ring_x.push(ring_x[0])
+            ring_y.push(ring_y[0])
+        }
+        return [ring_x, ring_y]
+    }
+
+    for (let cell = 0; cell < cell_offsets.length - 1; cell++) {
+        const cell_x = [], cell_y = []
+        for (let polygon = cell_offsets[cell]; polygon < cell_offsets[cell + 1]; polygon++) {
+            const polygon_x = [], polygon_y = []
+            for (let ring = polygon_offsets[polygon]; ring < polygon_offsets[polygon + 1]; ring++) {
+                const [ring_x, ring_y] = ring_points(ring)
+                polygon_x.push(ring_x)
+                polygon_y.push(ring_y)
+            }
+            cell_x.push(polygon_x)
+            cell_y.push(polygon_y)
+        }
+        out.x.push(cell_x)
+        out.y.push(cell_y)
+    }
+    for (let i = 0; i < data.name[row].length; i++) {
+        out.name.push(data.name[row][i])
+        out.rate.push(data.rate[row][i])
+    }
+}
+
+const rows = cb_obj.get_length() || 0
+const first = mode == 'append' ? (cb_obj._decoded_rows || 0) : 0
+const out = {x: [], y: [], name: [], rate: []}
+for (let row = first; row < rows; row++)
+    decode(cb_obj.data, row, out)
+cb_obj._decoded_rows = rows
+
+if (mode == 'append')
+    target.stream(out, null, {sync: false})
+else
+    target.setv({data: out}, {sync: false})
+"""
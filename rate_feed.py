@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+import numpy as np
+
+# The rates as the rate source publishes them. Rather than being refetched wholesale whenever a session asks for
+# fresh data, a city's rate carries a version, which the source bumps (publish) when the rate changes upstream. A
+# session only refetches the cities whose version is newer than the one it holds, and only sends those on to its
+# Bokeh session.
+#
+# The feed also caches the latest rate of every city, so that a change is fetched from the source once, whichever
+# sessions need it.
+#
+# With a change_log (the session store, see session_store.py), the published changes are kept there, so that every
+# Tornado worker sees the same versions, whichever of them a change was published on. Each worker keeps a copy of the
+# versions, and brings it up to date (sync) with the changes published since it last did, before it uses them.
+# on_change(indices, values) is called with the cities whose versions changed and the values published with them
+# (the stubbed rate source's new rates, see main.py), if there were any.
+#
+# The versions of a feed start from its epoch (the time it was created, in milliseconds), in their high bits, so they
+# are newer than any version of an earlier feed. The rates that sessions, their snapshots and the Bokeh workers kept
+# from before a restart are then refetched like any other stale rate, and a version never stands for two rates.
+
+# The low bits of a version count the changes of a city's rate within an epoch
+EPOCH_SHIFT = 20
+
+
+# The values of one column for every city: 'default', except for the cities that were set, whose indices (sorted) and
+# values are kept in arrays, like a SessionCityStore's (see session_city_store.py). Its memory only depends on the
+# number of cities set, and it is indexed with an array of positions like an array of all of the cities would be.
+class SparseColumn:
+    def __init__(self, default, dtype):
+        self.default = default
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0, dtype=dtype)
+
+    def __getitem__(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        result = np.full(positions.shape, self.default, dtype=self.values.dtype)
+        if len(self.indices) > 0:
+            slots = np.minimum(np.searchsorted(self.indices, positions), len(self.indices) - 1)
+            found = self.indices[slots] == positions
+            result[found] = self.values[slots[found]]
+        return result
+
+    # The positions must be distinct
+    def __setitem__(self, positions, values):
+        positions = np.atleast_1d(np.asarray(positions, dtype=np.int64))
+        values = np.broadcast_to(np.asarray(values, dtype=self.values.dtype), positions.shape)
+        order = np.argsort(positions)
+        positions = positions[order]
+        values = values[order]
+
+        slots = np.searchsorted(self.indices, positions)
+        known = slots < len(self.indices)
+        known[known] = self.indices[slots[known]] == positions[known]
+        self.values[slots[known]] = values[known]
+
+        added = ~known
+        self.indices = np.insert(self.indices, slots[added], positions[added])
+        self.values = np.insert(self.values, slots[added], values[added])
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class RateChangeFeed:
+    def __init__(self, city_count, change_log=None, on_change=None):
+        self.city_count = city_count
+        self.epoch = int(time.time() * 1000)
+        self.base_version = (self.epoch << EPOCH_SHIFT) + 1
+        # Every city starts with a rate of the base version upstream, which no session has fetched yet. Only the
+        # cities whose rates changed, or were fetched, take up memory.
+        self.versions = SparseColumn(self.base_version, np.int64)
+        self.cached_rates = SparseColumn(0.0, float)
+        self.cached_versions = SparseColumn(0, np.int64)
+        self.change_log = change_log
+        self.on_change = on_change
+        # The last change of the change log applied to self.versions
+        self.sequence = 0
+        self._pending = dict()
+        self.published = 0
+        self.upstream_calls = 0
+
+    # Called with the indices of the cities whose rates changed upstream (and optionally, a value for each of them,
+    # passed on to on_change)
+    def publish(self, indices, values=None):
+        indices, unique = np.unique(np.asarray(indices, dtype=np.int64), return_index=True)
+        values = None if values is None else np.asarray(values, dtype=float)[unique]
+        if self.change_log is not None:
+            self.change_log.publish_rate_changes(indices.tolist(), None if values is None else values.tolist())
+            self.sync()
+        else:
+            self.versions[indices] = self.versions[indices] + 1
+            if self.on_change is not None and values is not None:
+                self.on_change(indices, values)
+        self.published += len(indices)
+        logging.info("Rate changes published for " + str(len(indices)) + " cities")
+
+    # Applies the changes published (by any worker) since the last sync
+    def sync(self):
+        if self.change_log is None:
+            return
+        sequence, changes = self.change_log.get_rate_changes(self.sequence)
+        self.sequence = sequence
+        if len(changes) == 0:
+            return
+
+        indices = np.fromiter(changes.keys(), dtype=np.int64, count=len(changes))
+        versions = self.base_version + np.fromiter((count for count, _ in changes.values()), dtype=np.int64,
+                                                   count=len(changes))
+        values = np.array([np.nan if value is None else value for _, value in changes.values()], dtype=float)
+        newer = versions > self.versions[indices]
+        self.versions[indices[newer]] = versions[newer]
+
+        with_values = newer & ~np.isnan(values)
+        if self.on_change is not None and with_values.any():
+            self.on_change(indices[with_values], values[with_values])
+
+    # The latest versions of the cities
+    def get_versions(self, indices):
+        self.sync()
+        return self.versions[np.asarray(indices, dtype=np.int64)]
+
+    # Returns the rates and versions of the cities, fetching the ones that the cache does not have at their latest
+    # version with rate_fn (a city being fetched already is not fetched twice)
+    async def get_rates(self, indices, rate_fn):
+        indices = np.asarray(indices, dtype=np.int64)
+        stale = np.unique(indices[self.cached_versions[indices] < self.get_versions(indices)])
+        if len(stale) > 0:
+            pending = [index in self._pending for index in stale.tolist()]
+            waits = set(self._pending[index] for index, is_pending in zip(stale.tolist(), pending) if is_pending)
+            fetched = stale[~np.array(pending, dtype=bool)]
+            if len(fetched) > 0:
+                done = asyncio.get_running_loop().create_future()
+                for index in fetched.tolist():
+                    self._pending[index] = done
+                waits.add(asyncio.ensure_future(self._fetch(fetched, rate_fn, done)))
+            await asyncio.gather(*waits)
+        return self.cached_rates[indices], self.cached_versions[indices]
+
+    # The rates of a batch of cities are stored at once, since every store copies the cache's arrays. 'done' is set
+    # once they are, for the callers waiting for any of them.
+    async def _fetch(self, indices, rate_fn, done):
+        # A change published while the calls are running leaves a city stale, to be fetched again
+        versions = self.versions[indices]
+        self.upstream_calls += len(indices)
+        try:
+            rates = await asyncio.gather(*[rate_fn({'index': index, 'rate': rate}) for index, rate in
+                                           zip(indices.tolist(), self.cached_rates[indices].tolist())])
+            newer = versions > self.cached_versions[indices]
+            self.cached_rates[indices[newer]] = np.asarray(rates, dtype=float)[newer]
+            self.cached_versions[indices[newer]] = versions[newer]
+        finally:
+            for index in indices.tolist():
+                del self._pending[index]
+            # The callers waiting for these cities go on with whatever the cache has, if the calls failed
+            done.set_result(None)
+
+    def stats(self):
+        return {'epoch': self.epoch, 'published': self.published, 'upstream_calls': self.upstream_calls,
+                'pending': len(self._pending), 'sequence': self.sequence, 'changed': len(self.versions),
+                'cached': len(self.cached_versions)}
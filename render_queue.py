@@ -0,0 +1,383 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from shapely.geometry import Point
+
+import mason_dixon.municipal_data_utility as mun_util
+from mason_dixon.box_cache import BRACKET_BASE, CityBoxCache
+from mason_dixon.data_provider import load_data_provider
+from mason_dixon.grid_binning import GRID_ENGINES, GridBinner
+from mason_dixon.level_of_detail import LevelOfDetailController
+from mason_dixon.map_data_creator import render_full_map
+from mason_dixon.tessellation import CellAggregates, Tessellator
+from mason_dixon.topology import encode_topology
+from sampling_profiler import profiler
+
+# Map rendering is CPU-bound, so it runs on a dedicated executor instead of the IO loop that the sessions of a Bokeh
+# worker share (and that carries their websockets and polls). With 'thread', the executor is a thread pool (the
+# shapely 2 operations release the GIL); with 'process', it is a pool of forked processes that share the geodata
+# of the Bokeh worker, so only the session's rate arrays are sent over.
+
+
+class RenderSuperseded(Exception):
+    pass
+
+
+# The caches that renders share. With a tessellator, renders are tile-aligned (see tessellation.py); without one (a
+# tessellation_cache_size or box_cache_size of 0), each frame is tessellated on its own by render_full_map. The grid
+# engines (see grid_binning.py) need neither.
+class RenderContext:
+    def __init__(self, data_provider, box_cache_size=100000, tessellation_cache_size=2000, grid_cells_across=40):
+        self.data_provider = data_provider
+        self.grid_binner = GridBinner(data_provider.region_dataframe, data_provider.city_store,
+                                      data_provider.region_index, data_provider.region_raster, grid_cells_across)
+        self.box_cache = None
+        self.tessellator = None
+        if box_cache_size > 0:
+            self.box_cache = CityBoxCache(data_provider.region_dataframe['mercator'], box_cache_size)
+            if tessellation_cache_size > 0:
+                self.tessellator = Tessellator(data_provider.region_dataframe, data_provider.city_store,
+                                               data_provider.region_index, self.box_cache, tessellation_cache_size)
+
+
+# engine is 'tessellation', or one of the GRID_ENGINES. The pickled map cache (use_cache) belongs to render_full_map,
+# so the first tessellated render of a session still goes there.
+def render_session_map(context, rates, updates, upper_left_merc, lower_right_merc, box_factor, city_box_proportion,
+                       use_cache, engine='tessellation', aggregates=None, level=0, timings=None):
+    if engine in GRID_ENGINES:
+        return context.grid_binner.render_frame(engine, rates, upper_left_merc, lower_right_merc)
+    if context.tessellator is not None and not use_cache:
+        return context.tessellator.render_frame(rates, upper_left_merc, lower_right_merc, box_factor,
+                                                city_box_proportion, updates, aggregates, level, timings)
+
+    data_provider = context.data_provider
+    return render_full_map(upper_left_merc, lower_right_merc, box_factor, data_provider.city_store, rates,
+                           data_provider.region_dataframe, mun_util.rate_rule, city_box_proportion, use_cache,
+                           context.box_cache, data_provider.region_index)
+
+
+def get_frame_bounds(upper_left_merc, lower_right_merc):
+    return (min(upper_left_merc.x, lower_right_merc.x), min(upper_left_merc.y, lower_right_merc.y),
+            max(upper_left_merc.x, lower_right_merc.x), max(upper_left_merc.y, lower_right_merc.y))
+
+
+# render_session_map, with the map data topology-encoded (see topology.py) on a grid over the frame, unless
+# quantization is 0
+def render_map_data(quantization, context, rates, updates, upper_left_merc, lower_right_merc, *args):
+    rect_data, table_data = render_session_map(context, rates, updates, upper_left_merc, lower_right_merc, *args)
+    if quantization > 0:
+        rect_data = encode_topology(rect_data, get_frame_bounds(upper_left_merc, lower_right_merc), quantization)
+    return rect_data, table_data
+
+
+# Runs fn(*args), and records its duration as the 'total' of timings
+# The render is followed by the sampling profiler if a profile of the session's renders is running
+def run_timed(timings, session_key, fn, *args):
+    start = time.perf_counter()
+    token = profiler.begin('render', session_key)
+    try:
+        return fn(*args)
+    finally:
+        profiler.end(token)
+        timings['total'] = time.perf_counter() - start
+
+
+# The CPU time that computing a tile took in this thread
+def prefetch_tile(tessellator, key):
+    start = time.thread_time()
+    tessellator.get_tile(key)
+    return time.thread_time() - start
+
+
+_process_context = None
+
+
+# Forked processes inherit the context; this only creates one if the pool's processes were started some other way
+def _initialize_render_process(use_snapshot, box_cache_size, tessellation_cache_size, grid_cells_across):
+    global _process_context
+    if _process_context is None:
+        data_provider = load_data_provider(lambda coords: np.random.uniform(500, 2000), use_snapshot)
+        _process_context = RenderContext(data_provider, box_cache_size, tessellation_cache_size, grid_cells_across)
+
+
+def _render_in_process(quantization, *args):
+    return render_map_data(quantization, _process_context, *args)
+
+
+# At most max_pending renders can be queued or running at once. Beyond that, submitting waits for a free slot
+# (back-pressure), so that rendering can never flood the executor and starve the IO loop. While a render waits,
+# a newer render of the same session supersedes it, and it is dropped without running.
+# The caches are shared by the sessions of the process (with 'process', each render process fills its own copy).
+#
+# With the thread executor and a tessellator, a session's idle time is used to prefetch: after a render, the tiles of
+# the eight neighbouring frames and of the next zoom level in and out are computed on a single background thread,
+# so that the next pan or zoom mostly hits the cache. A prefetch only starts a tile while no render is waiting or
+# running, stops when the session renders again, and spends at most prefetch_budget seconds of CPU time per render.
+#
+# With the thread executor, a tessellator and a latency_target (in seconds), the level of detail of each tessellation
+# render is picked to fit the target (see level_of_detail.py). Neighbouring tiles are prefetched at the same level,
+# after the full detail tiles of the frame itself.
+#
+# With a topology_quantization, the map data (and each part of a progressive render) is topology-encoded on the
+# executor, on a grid of topology_quantization steps across the frame (see topology.py).
+#
+# With the thread executor, renders can be profiled on demand (see sampling_profiler.py). The render processes of the
+# process executor are not reached by the profiler.
+class RenderQueue:
+    def __init__(self, data_provider, executor_type='thread', workers=4, max_pending=8, use_snapshot=True,
+                 box_cache_size=100000, tessellation_cache_size=2000, prefetch=True, prefetch_budget=2.0,
+                 progressive=True, grid_cells_across=40, latency_target=0, topology_quantization=0):
+        self.context = RenderContext(data_provider, box_cache_size, tessellation_cache_size, grid_cells_across)
+        self.executor_type = executor_type
+        self.topology_quantization = topology_quantization
+        if executor_type == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        elif executor_type == 'process':
+            global _process_context
+            _process_context = self.context
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=_initialize_render_process,
+                                                initargs=(use_snapshot, box_cache_size, tessellation_cache_size,
+                                                          grid_cells_across))
+            # The pool forks all of its processes on the first submit. That is done now, since the queue is created
+            # before the Bokeh worker starts any thread (a thread's locks would stay held in a process forked while it
+            # runs), so that the render processes inherit the context rather than load their own.
+            self.executor.submit(os.getpid)
+        else:
+            raise ValueError("Unknown render executor: " + str(executor_type))
+
+        self._slots = asyncio.Semaphore(max_pending)
+        self._generations = dict()
+        self._active_renders = 0
+        # Each session's CellAggregates (see tessellation.py), for the renders that run in this process
+        self._aggregates = dict()
+
+        # Tiles prefetched in this process would be of no use to the render processes, and partial results can only
+        # be handed over from a thread
+        self.prefetch = prefetch and executor_type == 'thread' and self.context.tessellator is not None
+        self.progressive = progressive and executor_type == 'thread' and self.context.tessellator is not None
+        self.prefetch_budget = prefetch_budget
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._prefetch_tasks = set()
+
+        self.level_of_detail = None
+        if latency_target > 0 and executor_type == 'thread' and self.context.tessellator is not None:
+            self.level_of_detail = LevelOfDetailController(self.context.tessellator, latency_target)
+
+    # Raises RenderSuperseded if a newer render was submitted for the same session while this one was waiting
+    async def render(self, session_key, city_store, upper_left_merc, lower_right_merc, box_factor,
+                     city_box_proportion, use_cache=False, engine='tessellation'):
+        def submit(loop, rates, updates, cancelled, level, timings):
+            args = (rates, updates, upper_left_merc, lower_right_merc, box_factor, city_box_proportion, use_cache,
+                    engine)
+            if self.executor_type == 'process':
+                return loop.run_in_executor(self.executor, _render_in_process, self.topology_quantization, *args)
+            return loop.run_in_executor(self.executor, run_timed, timings, session_key, render_map_data,
+                                        self.topology_quantization, self.context, *args,
+                                        self.get_aggregates(session_key), level, timings)
+
+        # Grid renders need no tiles, and the first render of a session goes to the map cache
+        tiled = engine not in GRID_ENGINES
+        return await self._render(session_key, city_store, upper_left_merc, lower_right_merc, box_factor,
+                                  city_box_proportion, submit, prefetch=tiled, adaptive=tiled and not use_cache)
+
+    # Progressive rendering (see Tessellator.render_frame_progressively), only available if self.progressive is set.
+    # on_data(kind, data) is called on the IO loop with the coarse frame, then with each batch of cells (unless a newer
+    # render of the session was submitted by then). Returns the city table. Raises RenderSuperseded if a newer render
+    # of the session was submitted before this one finished.
+    async def render_progressively(self, session_key, city_store, upper_left_merc, lower_right_merc, box_factor,
+                                   city_box_proportion, on_data):
+        def submit(loop, rates, updates, cancelled, level, timings):
+            # Called on the render thread
+            def emit(kind, data):
+                if self.topology_quantization > 0:
+                    data = encode_topology(data, get_frame_bounds(upper_left_merc, lower_right_merc),
+                                           self.topology_quantization)
+                loop.call_soon_threadsafe(deliver, kind, data)
+
+            # Called on the IO loop, where a batch emitted before a newer render was submitted may arrive after it
+            def deliver(kind, data):
+                if not cancelled():
+                    on_data(kind, data)
+
+            return loop.run_in_executor(self.executor, run_timed, timings, session_key,
+                                        self.context.tessellator.render_frame_progressively, rates, upper_left_merc,
+                                        lower_right_merc, box_factor, city_box_proportion, emit, cancelled, updates,
+                                        self.get_aggregates(session_key), level, timings)
+
+        city_data = await self._render(session_key, city_store, upper_left_merc, lower_right_merc, box_factor,
+                                       city_box_proportion, submit, adaptive=True)
+        if city_data is None:
+            raise RenderSuperseded()
+        return city_data
+
+    async def _render(self, session_key, city_store, upper_left_merc, lower_right_merc, box_factor,
+                      city_box_proportion, submit, prefetch=True, adaptive=False):
+        generation = self._generations.get(session_key, 0) + 1
+        self._generations[session_key] = generation
+
+        def cancelled():
+            return self._generations.get(session_key) != generation
+
+        self._active_renders += 1
+        try:
+            async with self._slots:
+                if cancelled():
+                    logging.debug("Dropping superseded render for " + session_key)
+                    raise RenderSuperseded()
+
+                # The level of detail is picked once the render can start, with the tiles cached by then
+                level, units = 0, 0
+                adaptive = adaptive and self.level_of_detail is not None
+                if adaptive:
+                    level, units = self.level_of_detail.choose(upper_left_merc, lower_right_merc, box_factor,
+                                                               city_box_proportion)
+
+                # Rates that arrived while waiting for the slot are included
+                rates, updates = city_store.snapshot()
+                timings = dict()
+                result = await submit(asyncio.get_running_loop(), rates, updates, cancelled, level, timings)
+        finally:
+            self._active_renders -= 1
+
+        if adaptive and not cancelled():
+            self.level_of_detail.observe(level, units, timings)
+            logging.debug("Rendered " + session_key + " at level of detail " + str(level) + " (" + str(units) +
+                          " work units) in " + format(timings.get('total', 0.0), '.3f') + "s")
+
+        if self.prefetch and prefetch:
+            task = asyncio.get_running_loop().create_task(
+                self._prefetch_around(session_key, generation, upper_left_merc, lower_right_merc, box_factor,
+                                      city_box_proportion, level))
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+
+        return result
+
+    def get_prefetch_keys(self, upper_left_merc, lower_right_merc, box_factor, city_box_proportion, level=0):
+        tessellator = self.context.tessellator
+        width = lower_right_merc.x - upper_left_merc.x
+        height = lower_right_merc.y - upper_left_merc.y
+
+        frames = [(Point(upper_left_merc.x + dx * width, upper_left_merc.y + dy * height),
+                   Point(lower_right_merc.x + dx * width, lower_right_merc.y + dy * height))
+                  for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx, dy) != (0, 0)]
+
+        center_x = 0.5 * (upper_left_merc.x + lower_right_merc.x)
+        center_y = 0.5 * (upper_left_merc.y + lower_right_merc.y)
+        for factor in (1 / BRACKET_BASE, BRACKET_BASE):
+            frames.append((Point(center_x - 0.5 * factor * width, center_y - 0.5 * factor * height),
+                           Point(center_x + 0.5 * factor * width, center_y + 0.5 * factor * height)))
+
+        # A frame rendered at a coarser level of detail gets its full detail tiles first, for the next time it is seen
+        keys = dict()
+        if level > 0:
+            for key in tessellator.get_tile_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion):
+                keys[key] = True
+        for frame_upper_left, frame_lower_right in frames:
+            for key in tessellator.get_tile_keys(frame_upper_left, frame_lower_right, box_factor,
+                                                 city_box_proportion, level):
+                keys[key] = True
+        return list(keys)
+
+    async def _prefetch_around(self, session_key, generation, upper_left_merc, lower_right_merc, box_factor,
+                               city_box_proportion, level=0):
+        tessellator = self.context.tessellator
+        loop = asyncio.get_running_loop()
+
+        def cancelled():
+            return self._generations.get(session_key) != generation
+
+        spent = 0.0
+        prefetched = 0
+        for key in self.get_prefetch_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion, level):
+            if tessellator.has_tile(key):
+                continue
+            while self._active_renders > 0 and not cancelled():
+                await asyncio.sleep(0.05)
+            if cancelled() or spent >= self.prefetch_budget:
+                break
+            spent += await loop.run_in_executor(self._prefetch_executor, prefetch_tile, tessellator, key)
+            prefetched += 1
+
+        logging.debug("Prefetched " + str(prefetched) + " tiles for " + session_key + " in " + str(spent) + "s")
+
+    # Computes the missing tiles of the frames (e.g. the hot viewports, see warmup.py) on the prefetch thread, only
+    # while no render is waiting or running, for at most budget seconds of CPU time. Returns the number of tiles.
+    async def warm_up(self, frames, box_factor, city_box_proportion, budget=30.0):
+        tessellator = self.context.tessellator
+        if self.executor_type != 'thread' or tessellator is None:
+            return 0
+        loop = asyncio.get_running_loop()
+
+        spent = 0.0
+        warmed = 0
+        for upper_left_merc, lower_right_merc in frames:
+            if upper_left_merc.x == lower_right_merc.x or upper_left_merc.y == lower_right_merc.y:
+                continue
+            for key in tessellator.get_tile_keys(upper_left_merc, lower_right_merc, box_factor, city_box_proportion):
+                if tessellator.has_tile(key):
+                    continue
+                while self._active_renders > 0:
+                    await asyncio.sleep(0.05)
+                if spent >= budget:
+                    return warmed
+                spent += await loop.run_in_executor(self._prefetch_executor, prefetch_tile, tessellator, key)
+                warmed += 1
+        return warmed
+
+    def get_aggregates(self, session_key):
+        if self.context.tessellator is None:
+            return None
+        if session_key not in self._aggregates:
+            self._aggregates[session_key] = CellAggregates()
+        return self._aggregates[session_key]
+
+    def forget(self, session_key):
+        self._generations.pop(session_key, None)
+        self._aggregates.pop(session_key, None)
+
+    # For the /stats endpoint of a Bokeh worker. With the process executor, the caches are the render processes' own,
+    # so only the ones of this process (used by nothing) would be reported.
+    def stats(self):
+        stats = {
+            'executor': self.executor_type,
+            'active_renders': self._active_renders,
+            'sessions': len(self._generations),
+            'prefetch_tasks': len(self._prefetch_tasks)
+        }
+        if self.executor_type == 'thread':
+            box_cache = self.context.box_cache
+            if box_cache is not None:
+                stats['box_cache'] = {'entries': len(box_cache), 'hits': box_cache.hits, 'misses': box_cache.misses}
+            tessellator = self.context.tessellator
+            if tessellator is not None:
+                stats['tile_cache'] = {'entries': len(tessellator), 'hits': tessellator.hits,
+                                       'misses': tessellator.misses}
+                stats['cell_aggregates'] = {'reused': sum(aggregates.reused for aggregates in self._aggregates.values()),
+                                            'recomputed': sum(aggregates.recomputed
+                                                              for aggregates in self._aggregates.values())}
+            if self.level_of_detail is not None:
+                stats['level_of_detail'] = self.level_of_detail.stats()
+        return stats
+
+
+def create_render_queue(cfg, data_provider):
+    return RenderQueue(data_provider,
+                       executor_type=cfg.get("render_executor", "thread"),
+                       workers=cfg.get("render_workers", 4),
+                       max_pending=cfg.get("render_queue_size", 8),
+                       use_snapshot=cfg.get("startup_snapshot", False),
+                       box_cache_size=cfg.get("box_cache_size", 100000),
+                       tessellation_cache_size=cfg.get("tessellation_cache_size", 2000),
+                       prefetch=cfg.get("prefetch", True),
+                       prefetch_budget=cfg.get("prefetch_budget", 2.0),
+                       progressive=cfg.get("progressive_rendering", True),
+                       grid_cells_across=cfg.get("grid_cells_across", 40),
+                       latency_target=cfg.get("render_latency_target", 0),
+                       topology_quantization=cfg.get("topology_quantization", 0))
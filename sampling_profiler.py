@@ -0,0 +1,226 @@
+import asyncio
+import hmac
+import logging
+import sys
+import threading
+import time
+import tornado.web
+
+from collections import Counter
+
+# An on-demand sampling profiler for the live server, to find out why a particular viewport is slow. It is off by
+# default: an instrumented call (see begin) then costs one attribute check. An admin request starts a run for one
+# kind of call ('render' in a Bokeh worker, 'city_updates' in the Tornado server), optionally for a single session,
+# and the run follows the next 'calls' calls of that kind that start, for at most 'seconds' seconds.
+#
+# While a followed call runs, a background thread samples the stack of its thread every 'interval' seconds. A sample
+# only counts if the call's own frame is on the stack, so that the other coroutines running on the same IO loop (or a
+# call that is waiting) are left out. The samples are counted per stack, in the folded format of flamegraph.pl (and
+# speedscope): one line per stack, with its frames from the outermost in, separated by semicolons, then its count.
+# Memory is bounded by max_stacks distinct stacks (the samples beyond them are counted as '[other]'), and by
+# MAX_DEPTH frames per stack.
+#
+# The sampling thread needs the GIL, so a call that runs pure Python code is sampled at most every switch interval
+# (5 ms by default) rather than every 'interval'.
+
+PROFILE_KINDS = ('render', 'city_updates')
+
+MAX_DEPTH = 128
+
+
+class ProfileRun:
+    def __init__(self, kind, session_uid=None, calls=1, seconds=10.0, interval=0.005, max_stacks=10000):
+        self.kind = kind
+        self.session_uid = session_uid
+        self.calls = calls
+        self.seconds = seconds
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.deadline = time.monotonic() + seconds
+        self.started_calls = 0
+        self.finished_calls = 0
+        self.samples = 0
+        self.stacks = Counter()
+        # The frames of the calls being followed, by thread
+        self.active = dict()
+        self.done = threading.Event()
+
+    def is_finished(self):
+        return (self.done.is_set() or time.monotonic() >= self.deadline or
+                (self.started_calls >= self.calls and self.finished_calls >= self.started_calls))
+
+    def add_sample(self, frame, followed):
+        stack = []
+        counted = False
+        while frame is not None and len(stack) < MAX_DEPTH:
+            counted = counted or frame in followed
+            code = frame.f_code
+            stack.append(code.co_filename.rsplit('/', 1)[-1] + ':' + code.co_name + ':' + str(frame.f_lineno))
+            frame = frame.f_back
+        if not counted:
+            return
+
+        key = ';'.join(reversed(stack))
+        if key not in self.stacks and len(self.stacks) >= self.max_stacks:
+            key = '[other]'
+        self.stacks[key] += 1
+        self.samples += 1
+
+    def folded(self):
+        return ''.join(stack + ' ' + str(count) + '\n' for stack, count in self.stacks.most_common())
+
+    def summary(self):
+        return {'kind': self.kind, 'session': self.session_uid, 'calls': self.finished_calls,
+                'samples': self.samples, 'stacks': len(self.stacks)}
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.run = None
+        self._lock = threading.Lock()
+
+    # Called at the start of an instrumented call, in its own frame (which must stay on the stack until end). Returns
+    # a token for end, or None if the call is not followed.
+    def begin(self, kind, session_uid=None):
+        run = self.run
+        if run is None:
+            return None
+        with self._lock:
+            if (run is not self.run or run.kind != kind or run.started_calls >= run.calls or
+                    (run.session_uid is not None and run.session_uid != session_uid)):
+                return None
+            run.started_calls += 1
+            thread_id = threading.get_ident()
+            frame = sys._getframe(1)
+            run.active.setdefault(thread_id, set()).add(frame)
+            return run, thread_id, frame
+
+    def end(self, token):
+        if token is None:
+            return
+        run, thread_id, frame = token
+        with self._lock:
+            frames = run.active.get(thread_id)
+            if frames is not None:
+                frames.discard(frame)
+                if len(frames) == 0:
+                    del run.active[thread_id]
+            run.finished_calls += 1
+
+    # Raises RuntimeError if a run is already in progress
+    def start(self, run):
+        with self._lock:
+            if self.run is not None:
+                raise RuntimeError("A profile is already running")
+            self.run = run
+        logging.info("Profiling the next " + str(run.calls) + " " + run.kind + " calls" +
+                     ("" if run.session_uid is None else " of session " + run.session_uid) +
+                     " for at most " + str(run.seconds) + "s")
+        threading.Thread(target=self._sample, args=(run,), name='profiler', daemon=True).start()
+
+    def _sample(self, run):
+        try:
+            while not run.is_finished():
+                with self._lock:
+                    active = {thread_id: set(frames) for thread_id, frames in run.active.items()}
+                if len(active) > 0:
+                    current_frames = sys._current_frames()
+                    for thread_id, followed in active.items():
+                        if thread_id in current_frames:
+                            run.add_sample(current_frames[thread_id], followed)
+                time.sleep(run.interval)
+        finally:
+            with self._lock:
+                self.run = None
+            run.done.set()
+            logging.info("Profile finished: " + str(run.summary()))
+
+    # Waits for the run to finish (off the IO loop) and returns it
+    async def profile(self, run):
+        self.start(run)
+        await asyncio.get_running_loop().run_in_executor(None, run.done.wait)
+        return run
+
+
+# The profiler of this process
+profiler = SamplingProfiler()
+
+
+# The token is only taken from the X-Admin-Token header, since the query of a request ends up in the access logs
+def is_admin(handler, admin_token):
+    token = handler.request.headers.get('X-Admin-Token', '')
+    return bool(admin_token) and hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+# Reads a run's parameters from a request, capped by the configuration
+def get_profile_run(handler, cfg):
+    kind = handler.get_argument('kind')
+    if kind not in PROFILE_KINDS:
+        raise tornado.web.HTTPError(400, "Unknown kind: " + kind)
+    try:
+        calls = max(1, int(handler.get_argument('calls', '1')))
+        seconds = min(float(handler.get_argument('seconds', '10')), cfg.get("profiler_max_seconds", 60))
+        interval = max(float(handler.get_argument('interval', '5')), 1) / 1000
+    except ValueError:
+        raise tornado.web.HTTPError(400, "Invalid profile parameters")
+    return ProfileRun(kind, handler.get_argument('session', None), calls, max(0.0, seconds), interval,
+                      cfg.get("profiler_max_stacks", 10000))
+
+
+# Adds up the counts of the same stacks in several folded profiles
+def merge_folded(profiles):
+    stacks = Counter()
+    for profile in profiles:
+        for line in profile.splitlines():
+            stack, _, count = line.rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+    return ''.join(stack + ' ' + str(count) + '\n' for stack, count in stacks.most_common())
+
+
+# Profiles the calls of this process (see get_profile_run for the arguments) and returns the folded stacks. Only
+# served with the admin token of the configuration (and not at all without one). The kinds of calls that are made in
+# other processes are profiled there: get_remote_paths(session_uid) returns the host:port of the processes to
+# forward the request to (at their /profile), and their profiles are merged.
+class ProfileHandler(tornado.web.RequestHandler):
+    def initialize(self, cfg, get_remote_paths=None, remote_kinds=()):
+        self.cfg = cfg
+        self.get_remote_paths = get_remote_paths
+        self.remote_kinds = remote_kinds
+
+    def data_received(self, chunk):
+        pass
+
+    async def get(self):
+        if not is_admin(self, self.cfg.get("admin_token")):
+            raise tornado.web.HTTPError(404)
+        run = get_profile_run(self, self.cfg)
+        if run.kind in self.remote_kinds:
+            self.set_header("Content-Type", 'text/plain')
+            self.write(await self.profile_remotely(run))
+            return
+
+        try:
+            await profiler.profile(run)
+        except RuntimeError as e:
+            raise tornado.web.HTTPError(409, str(e))
+
+        for key, value in run.summary().items():
+            self.set_header('X-Profile-' + key.capitalize(), str(value))
+        self.set_header("Content-Type", 'text/plain')
+        self.write(run.folded())
+
+    async def profile_remotely(self, run):
+        from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+        paths = self.get_remote_paths(run.session_uid)
+        if len(paths) == 0:
+            raise tornado.web.HTTPError(404, "Unknown session")
+        headers = {'X-Admin-Token': self.cfg["admin_token"]}
+        requests = [HTTPRequest("http://" + path + "/profile?" + self.request.query, headers=headers,
+                                request_timeout=run.seconds + 30) for path in paths]
+        try:
+            responses = await asyncio.gather(*[AsyncHTTPClient().fetch(request) for request in requests])
+        except HTTPClientError as e:
+            raise tornado.web.HTTPError(e.code, "Profiling failed on a worker: " + str(e))
+        return merge_folded(response.body.decode() for response in responses)
@@ -1,13 +1,12 @@
 import logging
 import pickle
 
-import asyncio
-from shapely.geometry import Polygon, Point
+import numpy as np
 from mason_dixon import municipal_data_utility as mun_util, coordinate_utility
 
 
-def get_cached_indices_for_frame(city_cache, lon_wgs, lat_wgs, aspect_ratio, zoom):
-    # city_array and region_array have their geometry values in WGS84 coordinates to use the Travel APIs
+def get_cached_indices_for_frame(city_store, lon_wgs, lat_wgs, aspect_ratio, zoom):
+    # The queries use WGS84 coordinates, like the Travel APIs
     # zoom needs to determine the critical population values
     frame_size = (zoom, zoom / aspect_ratio)
 
@@ -15,53 +14,80 @@ def get_cached_indices_for_frame(city_cache, lon_wgs, lat_wgs, aspect_ratio, zoo
     upper_left_wgs = (lon_wgs - frame_size[0], lat_wgs + frame_size[1])
     lower_right_wgs = (lon_wgs + (2 * frame_size[0]), upper_left_wgs[1] - (2 * frame_size[1]))
 
-    lon_point_list = [upper_left_wgs[0], lower_right_wgs[0], lower_right_wgs[0], upper_left_wgs[0]]
-    lat_point_list = [upper_left_wgs[1], upper_left_wgs[1], lower_right_wgs[1], lower_right_wgs[1]]
-    frame_geometry = Polygon(zip(lon_point_list, lat_point_list))
-
     little_population, big_population = mun_util.map_zoom_to_population(zoom)
-    indices = [x for x in city_cache if city_cache[x]['geometry'].within(frame_geometry) and city_cache[x]['population'] >= little_population]
-    return indices
+    return list(mun_util.get_cities_in_frame(city_store, upper_left_wgs, lower_right_wgs, little_population))
 
 
-def get_new_city_cache_wgs(city_data):
-    data = zip(city_data['rate'], city_data['index'], city_data['geometry'], city_data['pop_max'])
+# The session store only holds the cities that have been fetched for a session, with the version of their rate (see
+# rate_feed.py). The others still have the starting value from the city store, with a version of 0.
+def get_session_city_rates(session_store, session_uid, city_store, indices):
+    cached = session_store.get_city_rates(session_uid, indices)
     return {
-        index: {
-            'index': index,
-            'rate': rate,
-            'geometry': geom,
-            'population': pop,
-            'update_counter': 0
-        } for rate, index, geom, pop in data
+        index: cached[index] if index in cached else (float(city_store.rate[index]), 0) for index in indices
     }
 
 
-def get_city_info(city):
-    res = dict()
-    res['update_counter'] = city['update_counter']
-    res['rate'] = city['rate']
-    res['index'] = city['index']
-    return res
-
-
-async def request_city_data_from_database(city_cache, indices, rate_fn, update_counter):
-    # city_array and region_array have their geometry values in WGS84 coordinates to use the Travel APIs
-    # zoom needs to determine the critical population values
-    cities = {x: city_cache[x] for x in city_cache if x in indices}
-
-    tasks = [get_city_rate(cities[index], update_counter, rate_fn) for index in cities]
-    rates = await asyncio.gather(*tasks)
-
-    for city in rates:
-        city_cache[city['index']]['rate'] = city['rate']
-        city_cache[city['index']]['update_counter'] = update_counter
-
-
-async def get_city_rate(city, update_counter, rate_fn):
-    if city['update_counter'] >= update_counter:
-        return {'index': city['index'], 'rate': city['rate']}
-
-    rate = await rate_fn(city)
-    return {'index': city['index'], 'rate': rate}
-
+# The order in which the cities of a request are sent: the ones inside of the frame (if the request has one) before
+# the others, and larger populations first
+def prioritize_city_indices(city_store, indices, upper_left_wgs=None, lower_right_wgs=None):
+    indices = np.asarray(indices, dtype=np.int64)
+    populations = city_store.population[indices]
+
+    if upper_left_wgs is None or lower_right_wgs is None:
+        return list(indices[np.argsort(-populations, kind='stable')])
+
+    min_lon, max_lon = sorted((upper_left_wgs[0], lower_right_wgs[0]))
+    min_lat, max_lat = sorted((upper_left_wgs[1], lower_right_wgs[1]))
+    lons = city_store.lon[indices]
+    lats = city_store.lat[indices]
+    outside = ~((lons >= min_lon) & (lons <= max_lon) & (lats >= min_lat) & (lats <= max_lat))
+    return list(indices[np.lexsort((-populations, outside))])
+
+
+# The number of cities per message, adapted to how long the chunks take to look up and write (AIMD: the size grows
+# by a step while chunks are within target_latency, and is halved as soon as one is not)
+class AdaptiveChunkSize:
+    def __init__(self, initial, minimum, maximum, target_latency):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.step = max(1, initial // 4)
+
+    def record(self, chunk_length, elapsed):
+        if elapsed > self.target_latency:
+            self.size = max(self.minimum, self.size // 2)
+        elif chunk_length >= self.size:
+            # A partial (last) chunk says nothing about a larger size
+            self.size = min(self.maximum, self.size + self.step)
+
+
+# Sent (pickled) to the Bokeh workers, so it has to live in a module that they can import. The cities are columnar
+# (one array per field), so that the Bokeh session can merge them with SessionCityStore.apply_updates.
+# remaining is the number of the request's cities still to be sent after this chunk
+class CityUpdateMessage:
+    def __init__(self, indices, city_rates, request_id, remaining=0):
+        logging.debug('Request_id = ' + str(request_id))
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.rates = np.array([city_rates[i][0] for i in indices], dtype=float)
+        self.versions = np.array([city_rates[i][1] for i in indices], dtype=np.int64)
+        self.request_id = request_id
+        self.remaining = remaining
+
+
+# Returns {index: (rate, version)} for all of the requested cities, after refreshing the ones that the session holds
+# at an older version than the rate feed's
+async def request_city_data_from_database(session_store, session_uid, city_store, indices, rate_feed, rate_fn):
+    cities = get_session_city_rates(session_store, session_uid, city_store, indices)
+
+    latest_versions = rate_feed.get_versions(list(cities)).tolist()
+    stale = [index for (index, (rate, version)), latest_version in zip(cities.items(), latest_versions)
+             if version < latest_version]
+    if len(stale) == 0:
+        return cities
+
+    rates, versions = await rate_feed.get_rates(stale, rate_fn)
+    fetched = {index: (rate, version) for index, rate, version in zip(stale, rates.tolist(), versions.tolist())}
+    session_store.set_city_rates(session_uid, fetched)
+    cities.update(fetched)
+    return cities
@@ -0,0 +1,75 @@
+import json
+import os
+import resource
+import time
+import numpy as np
+import tornado.ioloop
+import tornado.web
+
+from collections import deque
+
+# Runtime statistics of a server process (the Tornado server or a Bokeh worker), served as JSON at /stats. They are
+# read by load_test.py, but are just as useful with curl.
+
+
+# How late the IO loop runs a callback that it was asked to run every 'interval' seconds. A busy loop (e.g. a render
+# or a blocking call on it) shows up as lag.
+class LoopLagMonitor:
+    def __init__(self, interval=0.1, window=600):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self._expected = None
+
+    def start(self):
+        self._expected = time.perf_counter() + self.interval
+        tornado.ioloop.IOLoop.current().call_later(self.interval, self._tick)
+
+    def _tick(self):
+        now = time.perf_counter()
+        self.samples.append(max(0.0, now - self._expected))
+        self._expected = now + self.interval
+        tornado.ioloop.IOLoop.current().call_later(self.interval, self._tick)
+
+    # Over the last 'window' samples
+    def summary(self):
+        if len(self.samples) == 0:
+            return {'samples': 0}
+        samples = np.array(self.samples)
+        return {
+            'samples': len(samples),
+            'mean': float(samples.mean()),
+            'p50': float(np.percentile(samples, 50)),
+            'p99': float(np.percentile(samples, 99)),
+            'max': float(samples.max())
+        }
+
+
+def get_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak rather than current, but better than nothing (kilobytes on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_process_stats(loop_lag_monitor):
+    return {
+        'pid': os.getpid(),
+        'time': time.time(),
+        'rss_bytes': get_rss(),
+        'loop_lag': loop_lag_monitor.summary()
+    }
+
+
+# get_stats() returns a JSON-serializable dictionary
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, get_stats):
+        self.get_stats = get_stats
+
+    def data_received(self, chunk):
+        pass
+
+    def get(self):
+        self.set_header("Content-Type", 'application/json')
+        self.write(json.dumps(self.get_stats()))
@@ -0,0 +1,136 @@
+import logging
+import time
+import urllib.parse
+
+import tornado.ioloop
+import tornado.websocket
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+# Bootstrapping a session used to pull its Bokeh document synchronously from the request handler, which blocked the
+# IO loop (and needed nest_asyncio) until the document existed and its websockets had connected back. Now a Bokeh
+# session is created with a plain async HTTP request to its worker, which builds the document and renders the map
+# on its own time.
+#
+# The Bokeh workers discard a session within about a second if nothing is connected to it, so until the browser
+# connects, a BokehSessionKeeper holds a connection to it. BokehSessionPool keeps a few sessions at the default
+# viewport ready (rendered and kept alive), so that a new visitor claims one instead of waiting for a render.
+
+
+# Creates a Bokeh session of bokeh_app on the worker, with the request arguments that bokeh_app reads (e.g. the guid),
+# and returns its id. The worker creates the session and its document for the request, like it does for a browser.
+async def create_bokeh_session(bokeh_server_path, arguments):
+    from bokeh.util.token import generate_session_id
+
+    session_id = generate_session_id()
+    url = "http://" + bokeh_server_path + "/bokeh_app?" + urllib.parse.urlencode(arguments)
+    await AsyncHTTPClient().fetch(HTTPRequest(url, headers={'Bokeh-Session-Id': session_id}))
+    return session_id
+
+
+# Connects to a Bokeh session the way a browser does (without pulling the document), so that the worker keeps it
+class BokehSessionKeeper:
+    def __init__(self, bokeh_server_path, bokeh_session_id):
+        self.url = "ws://" + bokeh_server_path + "/bokeh_app/ws"
+        self.bokeh_session_id = bokeh_session_id
+        self._connection = None
+        self._closed = False
+
+    async def connect(self):
+        from bokeh.util.token import generate_jwt_token
+
+        connection = await tornado.websocket.websocket_connect(
+            self.url, subprotocols=['bokeh', generate_jwt_token(self.bokeh_session_id)],
+            on_message_callback=lambda message: None)
+        if self._closed:
+            connection.close()
+        else:
+            self._connection = connection
+
+    def close(self):
+        self._closed = True
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Closes the connection after 'delay' seconds (by then, the browser is expected to have connected)
+    def close_later(self, delay):
+        tornado.ioloop.IOLoop.current().call_later(delay, self.close)
+
+
+class PooledSession:
+    def __init__(self, uid, bokeh_server_path, bokeh_session_id, keeper):
+        self.uid = uid
+        self.bokeh_server_path = bokeh_server_path
+        self.bokeh_session_id = bokeh_session_id
+        self.keeper = keeper
+        self.created = time.monotonic()
+
+
+# Keeps 'size' sessions ready. create_session (a coroutine function) creates one and returns its uid, Bokeh worker
+# path and Bokeh session id; close_session(uid) closes one that was never claimed, and deletes its state. A pooled
+# session that is older than max_age seconds is replaced, so that a claimed session is never far behind the rates.
+class BokehSessionPool:
+    def __init__(self, size, create_session, close_session, max_age=300, handoff_seconds=30, check_interval=5):
+        self.size = size
+        self.create_session = create_session
+        self.close_session = close_session
+        self.max_age = max_age
+        self.handoff_seconds = handoff_seconds
+        self.check_interval = check_interval
+        self._ready = []
+        self._filling = 0
+        self.claimed = 0
+        self.missed = 0
+        self.created = 0
+        self.failed = 0
+
+    def start(self):
+        tornado.ioloop.PeriodicCallback(self.maintain, self.check_interval * 1000).start()
+        self.maintain()
+
+    # Returns a ready session (whose keeper lets go of it after handoff_seconds), or None if the pool is empty
+    def claim(self):
+        tornado.ioloop.IOLoop.current().add_callback(self.maintain)
+        if len(self._ready) == 0:
+            self.missed += 1
+            return None
+
+        session = self._ready.pop(0)
+        session.keeper.close_later(self.handoff_seconds)
+        self.claimed += 1
+        return session
+
+    def maintain(self):
+        now = time.monotonic()
+        for session in [session for session in self._ready if now - session.created > self.max_age]:
+            logging.debug("Replacing pooled session " + session.uid)
+            self._ready.remove(session)
+            session.keeper.close()
+            self.close_session(session.uid)
+
+        for _ in range(self.size - len(self._ready) - self._filling):
+            self._filling += 1
+            tornado.ioloop.IOLoop.current().spawn_callback(self._fill)
+
+    async def _fill(self):
+        uid = None
+        try:
+            uid, bokeh_server_path, bokeh_session_id = await self.create_session()
+            keeper = BokehSessionKeeper(bokeh_server_path, bokeh_session_id)
+            await keeper.connect()
+        except Exception as e:
+            # E.g. the Bokeh worker is still starting. The next check tries again.
+            logging.warning("Could not create a pooled session: " + str(e))
+            self.failed += 1
+            if uid is not None:
+                self.close_session(uid)
+            return
+        finally:
+            self._filling -= 1
+
+        self._ready.append(PooledSession(uid, bokeh_server_path, bokeh_session_id, keeper))
+        self.created += 1
+
+    def stats(self):
+        return {'size': self.size, 'ready': len(self._ready), 'filling': self._filling, 'claimed': self.claimed,
+                'missed': self.missed, 'created': self.created, 'failed': self.failed}
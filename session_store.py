@@ -0,0 +1,304 @@
+import json
+import logging
+import os
+import threading
+
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+# All per-session state of the Tornado server lives in a session store, so that any Tornado process can serve any
+# session's traffic. There are three backends, selected with 'session_store' in config.yml:
+#   memory - plain dictionaries in the current process (only valid with a single Tornado worker)
+#   shared - the same dictionaries, hosted by a multiprocessing manager that every worker connects to
+#   redis  - any server speaking the Redis protocol (redis-server, KeyDB, ...), e.g. one running on localhost
+#
+# A session consists of
+#   plotting state - small flags polled by the Bokeh session ('needs_update', 'update_counter', 'session_open', ...)
+#   city rates     - {index: (rate, update_counter)} for the cities that have been fetched for the session.
+#                    Cities that are missing still have their starting value, with an update counter of 0.
+# A session is deleted once it is closed. Reading or writing its plotting state, or writing its rates, then raises
+# KeyError (without recreating it).
+#
+# The store also holds the rate changes (see rate_feed.py), shared by all of the sessions: the number of changes (and
+# the last published value) of every city whose rate changed, and a log of the last MAX_RATE_CHANGE_BATCHES batches
+# of changes, numbered by a sequence. A worker asks for the changes since the last sequence it has seen, and gets the
+# cities of the batches since then, or all of the changed cities if it has fallen further behind than the log goes.
+
+MAX_RATE_CHANGE_BATCHES = 64
+
+
+class InProcessSessionStore:
+    def __init__(self):
+        # The lock matters when this store is hosted by the manager of a SharedSessionStore (one thread per client)
+        self._lock = threading.Lock()
+        self._plotting_states = dict()
+        self._city_rates = dict()
+        # {index: (changes, value)} of the cities whose rates changed, and the last batches of changes
+        self._rate_changes = dict()
+        self._rate_change_log = deque(maxlen=MAX_RATE_CHANGE_BATCHES)
+        self._rate_sequence = 0
+
+    def after_fork(self):
+        pass
+
+    def create_session(self, uid, plotting_state):
+        with self._lock:
+            self._plotting_states[uid] = dict(plotting_state)
+            self._city_rates[uid] = dict()
+
+    def has_session(self, uid):
+        return uid in self._plotting_states
+
+    def delete_session(self, uid):
+        with self._lock:
+            self._plotting_states.pop(uid, None)
+            self._city_rates.pop(uid, None)
+
+    def get_plotting_state(self, uid):
+        with self._lock:
+            return dict(self._plotting_states[uid])
+
+    def update_plotting_state(self, uid, fields):
+        with self._lock:
+            self._plotting_states[uid].update(fields)
+
+    # Returns the new update counter
+    def mark_for_updates(self, uid):
+        with self._lock:
+            state = self._plotting_states[uid]
+            state['update_counter'] += 1
+            state['needs_update'] = True
+            return state['update_counter']
+
+    # Returns the plotting state as it was, then clears the 'needs_update' flag (a poll consumes the update)
+    def consume_plotting_state(self, uid):
+        with self._lock:
+            state = self._plotting_states[uid]
+            res = dict(state)
+            state['needs_update'] = False
+            return res
+
+    def get_city_rates(self, uid, indices):
+        with self._lock:
+            rates = self._city_rates[uid]
+            return {index: rates[index] for index in indices if index in rates}
+
+    def set_city_rates(self, uid, rates):
+        with self._lock:
+            self._city_rates[uid].update(rates)
+
+    # Counts a change of the cities, with their new values (or None). Returns the sequence of the batch.
+    def publish_rate_changes(self, indices, values=None):
+        with self._lock:
+            for position, index in enumerate(indices):
+                changes = self._rate_changes.get(index, (0, None))[0] + 1
+                self._rate_changes[index] = (changes, None if values is None else values[position])
+            self._rate_sequence += 1
+            self._rate_change_log.append((self._rate_sequence, list(indices)))
+            return self._rate_sequence
+
+    # Returns the latest sequence, and {index: (changes, value)} for the cities changed after the sequence since
+    def get_rate_changes(self, since):
+        with self._lock:
+            if since == self._rate_sequence:
+                return since, dict()
+            if len(self._rate_change_log) == 0 or self._rate_change_log[0][0] > since + 1:
+                return self._rate_sequence, dict(self._rate_changes)
+            changed = set()
+            for sequence, indices in self._rate_change_log:
+                if sequence > since:
+                    changed.update(indices)
+            return self._rate_sequence, {index: self._rate_changes[index] for index in changed}
+
+
+class _SessionStoreManager(BaseManager):
+    pass
+
+
+_hosted_store = None
+
+
+def _get_hosted_store():
+    global _hosted_store
+    if _hosted_store is None:
+        _hosted_store = InProcessSessionStore()
+    return _hosted_store
+
+
+_SessionStoreManager.register('get_store', callable=_get_hosted_store)
+
+
+# An InProcessSessionStore living in a separate manager process. The process that creates this store starts the
+# manager, and every process (including forked Tornado workers) talks to it through its own connection.
+class SharedSessionStore:
+    def __init__(self, address=('127.0.0.1', 0), authkey=None):
+        self._authkey = authkey if authkey is not None else os.urandom(32)
+        self._server = _SessionStoreManager(address=address, authkey=self._authkey)
+        self._server.start()
+        self.address = self._server.address
+        logging.info("Shared session store listening on " + str(self.address))
+        self._store = None
+        self.after_fork()
+
+    # Connections can't be shared between processes, so a forked worker needs to open its own
+    def after_fork(self):
+        client = _SessionStoreManager(address=self.address, authkey=self._authkey)
+        client.connect()
+        self._store = client.get_store()
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+
+# Any server that speaks the Redis protocol. Values are JSON encoded, and each session is two hashes. A write to a
+# session that has been deleted would recreate its hash, so it is removed again.
+class RedisSessionStore:
+    def __init__(self, url, key_prefix='mason_dixon'):
+        self.url = url
+        self.key_prefix = key_prefix
+        self._client = None
+        self.after_fork()
+        # The rate changes published before the server (re)started are obsolete, since its rate feed starts over
+        self._client.delete(self._rate_key('changes'), self._rate_key('values'), self._rate_key('log'),
+                            self._rate_key('sequence'))
+
+    def after_fork(self):
+        # redis is an optional dependency, only needed for this backend
+        import redis
+        self._client = redis.Redis.from_url(self.url)
+
+    def _key(self, uid, kind):
+        return f"{self.key_prefix}:{uid}:{kind}"
+
+    @staticmethod
+    def _encode(mapping):
+        return {str(k): json.dumps(v) for k, v in mapping.items()}
+
+    @staticmethod
+    def _decode(mapping):
+        return {k.decode('utf-8'): json.loads(v) for k, v in mapping.items()}
+
+    def create_session(self, uid, plotting_state):
+        pipe = self._client.pipeline()
+        pipe.delete(self._key(uid, 'plotting'), self._key(uid, 'cities'))
+        pipe.hset(self._key(uid, 'plotting'), mapping=self._encode(plotting_state))
+        pipe.execute()
+
+    def has_session(self, uid):
+        return bool(self._client.exists(self._key(uid, 'plotting')))
+
+    def delete_session(self, uid):
+        self._client.delete(self._key(uid, 'plotting'), self._key(uid, 'cities'))
+
+    def get_plotting_state(self, uid):
+        state = self._client.hgetall(self._key(uid, 'plotting'))
+        if not state:
+            raise KeyError(uid)
+        return self._decode(state)
+
+    # Undoes a write that recreated the hash of a deleted session
+    def _check_exists(self, uid, existed, *kinds):
+        if not existed:
+            self._client.delete(*[self._key(uid, kind) for kind in kinds])
+            raise KeyError(uid)
+
+    def update_plotting_state(self, uid, fields):
+        pipe = self._client.pipeline()
+        pipe.exists(self._key(uid, 'plotting'))
+        pipe.hset(self._key(uid, 'plotting'), mapping=self._encode(fields))
+        existed, _ = pipe.execute()
+        self._check_exists(uid, existed, 'plotting')
+
+    def mark_for_updates(self, uid):
+        pipe = self._client.pipeline()
+        pipe.exists(self._key(uid, 'plotting'))
+        pipe.hincrby(self._key(uid, 'plotting'), 'update_counter', 1)
+        pipe.hset(self._key(uid, 'plotting'), 'needs_update', json.dumps(True))
+        existed, counter, _ = pipe.execute()
+        self._check_exists(uid, existed, 'plotting')
+        return counter
+
+    def consume_plotting_state(self, uid):
+        pipe = self._client.pipeline()
+        pipe.hgetall(self._key(uid, 'plotting'))
+        pipe.hset(self._key(uid, 'plotting'), 'needs_update', json.dumps(False))
+        state, _ = pipe.execute()
+        self._check_exists(uid, state, 'plotting')
+        return self._decode(state)
+
+    def get_city_rates(self, uid, indices):
+        indices = list(indices)
+        if len(indices) == 0:
+            return dict()
+        values = self._client.hmget(self._key(uid, 'cities'), [str(index) for index in indices])
+        return {index: tuple(json.loads(value)) for index, value in zip(indices, values) if value is not None}
+
+    def set_city_rates(self, uid, rates):
+        if len(rates) == 0:
+            return
+        mapping = {str(index): json.dumps([float(rate), int(counter)]) for index, (rate, counter) in rates.items()}
+        pipe = self._client.pipeline()
+        pipe.exists(self._key(uid, 'plotting'))
+        pipe.hset(self._key(uid, 'cities'), mapping=mapping)
+        existed, _ = pipe.execute()
+        self._check_exists(uid, existed, 'cities')
+
+    # The rate changes are a hash of change counts, a hash of values, a list of the last batches (as JSON lists of
+    # indices) and the sequence, which are only changed together, in one transaction, so that the last element of the
+    # list is always the batch of the current sequence
+    def _rate_key(self, kind):
+        return f"{self.key_prefix}:rate_changes:{kind}"
+
+    def publish_rate_changes(self, indices, values=None):
+        pipe = self._client.pipeline()
+        for index in indices:
+            pipe.hincrby(self._rate_key('changes'), str(index), 1)
+        if len(indices) > 0:
+            pipe.hset(self._rate_key('values'), mapping={
+                str(index): json.dumps(None if values is None else values[position])
+                for position, index in enumerate(indices)})
+        pipe.rpush(self._rate_key('log'), json.dumps(list(indices)))
+        pipe.ltrim(self._rate_key('log'), -MAX_RATE_CHANGE_BATCHES, -1)
+        pipe.incr(self._rate_key('sequence'))
+        return pipe.execute()[-1]
+
+    def get_rate_changes(self, since):
+        sequence = int(self._client.get(self._rate_key('sequence')) or 0)
+        if sequence == since:
+            return since, dict()
+
+        pipe = self._client.pipeline()
+        pipe.get(self._rate_key('sequence'))
+        pipe.lrange(self._rate_key('log'), -min(max(1, sequence - since), MAX_RATE_CHANGE_BATCHES), -1)
+        sequence, batches = pipe.execute()
+        sequence = int(sequence or 0)
+        # More batches may have been published since the first read
+        if sequence - since > len(batches) or sequence < since:
+            pipe = self._client.pipeline()
+            pipe.hgetall(self._rate_key('changes'))
+            pipe.hgetall(self._rate_key('values'))
+            changes, values = pipe.execute()
+            return sequence, {int(index): (int(count), json.loads(values.get(index, b'null')))
+                              for index, count in changes.items()}
+
+        indices = sorted(set(index for batch in batches[len(batches) - (sequence - since):]
+                             for index in json.loads(batch)))
+        if len(indices) == 0:
+            return sequence, dict()
+        pipe = self._client.pipeline()
+        pipe.hmget(self._rate_key('changes'), [str(index) for index in indices])
+        pipe.hmget(self._rate_key('values'), [str(index) for index in indices])
+        changes, values = pipe.execute()
+        return sequence, {index: (int(count), json.loads(value))
+                          for index, count, value in zip(indices, changes, values) if count is not None}
+
+
+def create_session_store(cfg):
+    backend = cfg.get('session_store', 'memory')
+    if backend == 'memory':
+        return InProcessSessionStore()
+    if backend == 'shared':
+        return SharedSessionStore()
+    if backend == 'redis':
+        return RedisSessionStore(cfg.get('redis_url', 'redis://localhost:6379/0'))
+    raise ValueError("Unknown session store: " + str(backend))
@@ -0,0 +1,31 @@
+import logging
+import time
+
+
+# Records how long each phase of startup takes. Each call to mark() closes the phase that started at the
+# previous mark (or when the timer was created), so it can be sprinkled between module-level statements.
+class StartupTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last_mark = self.start
+        self.phases = []
+
+    def mark(self, phase_name):
+        now = time.perf_counter()
+        self.phases.append((phase_name, now - self.last_mark))
+        self.last_mark = now
+
+    def total(self):
+        return self.last_mark - self.start
+
+    def report(self):
+        lines = ["Startup timing breakdown:"]
+        width = max([len(name) for name, _ in self.phases], default=0)
+        for name, elapsed in self.phases:
+            lines.append(f"  {name.ljust(width)}  {elapsed * 1000:9.1f} ms")
+        lines.append(f"  {'total'.ljust(width)}  {self.total() * 1000:9.1f} ms")
+        return '\n'.join(lines)
+
+    def log_report(self):
+        for line in self.report().split('\n'):
+            logging.info(line)
@@ -0,0 +1,48 @@
+import asyncio
+
+import numpy as np
+
+from rate_feed import RateChangeFeed, SparseColumn
+
+
+def test_sparse_column_matches_dense_array():
+    rng = np.random.default_rng(7)
+    column = SparseColumn(-1, np.int64)
+    dense = np.full(1000, -1, dtype=np.int64)
+
+    for _ in range(30):
+        indices = rng.choice(1000, 50, replace=False)
+        values = rng.integers(0, 100, 50)
+        column[indices] = values
+        dense[indices] = values
+
+    positions = rng.integers(0, 1000, 200)
+    assert np.array_equal(column[positions], dense[positions])
+    assert len(column) == np.count_nonzero(dense >= 0)
+
+
+def test_rates_are_fetched_once_per_version():
+    calls = []
+
+    async def rate_fn(city):
+        calls.append(city['index'])
+        await asyncio.sleep(0)
+        return float(city['index'])
+
+    async def run():
+        feed = RateChangeFeed(1000)
+        # Two sessions asking for the same cities at once
+        (rates, versions), _ = await asyncio.gather(feed.get_rates([3, 5, 7], rate_fn),
+                                                    feed.get_rates([5, 7, 9], rate_fn))
+        assert np.array_equal(rates, [3.0, 5.0, 7.0])
+        assert np.all(versions == feed.base_version)
+        assert sorted(calls) == [3, 5, 7, 9]
+
+        feed.publish([5])
+        assert np.array_equal(feed.get_versions([3, 5]), [feed.base_version, feed.base_version + 1])
+        _, versions = await feed.get_rates([3, 5], rate_fn)
+        assert np.array_equal(versions, [feed.base_version, feed.base_version + 1])
+        assert sorted(calls) == [3, 5, 5, 7, 9]
+        assert feed.stats()['changed'] == 1 and feed.stats()['cached'] == 4
+
+    asyncio.run(run())
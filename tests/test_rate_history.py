@@ -0,0 +1,89 @@
+import numpy as np
+
+from mason_dixon.rate_history import RateHistory
+
+# Replays a stream of changes into a RateHistory with a fake clock, and checks rates_at against the true rates: exact
+# within the first tier, and otherwise never older than the truth, nor newer than the truth at the end of the bucket
+# of the coarsest tier.
+
+CHANGE_SECONDS = 10
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# City 0 changes every CHANGE_SECONDS (its k-th change, at k * CHANGE_SECONDS, has version k and rate 100 + k), and
+# city 1 never changes (so it gets no row)
+def replay(changes, tiers=((8, 0), (8, 60), (8, 3600))):
+    clock = FakeClock()
+    history = RateHistory(tiers, clock, capacity=1)
+    for version in range(1, changes + 1):
+        clock.now = version * CHANGE_SECONDS
+        history.record([0], [100.0 + version], [version])
+    return history
+
+
+# The rates and versions of every city at timestamp, as arrays
+def get_rates_at(history, timestamp, starting_rates):
+    indices, rates, versions = history.rates_at(timestamp)
+    all_rates = np.array(starting_rates, dtype=float)
+    all_versions = np.zeros(len(starting_rates), dtype=np.int64)
+    all_rates[indices] = rates
+    all_versions[indices] = versions
+    return all_rates, all_versions
+
+
+def true_version(timestamp, changes):
+    return min(int(timestamp // CHANGE_SECONDS), changes)
+
+
+def test_rates_at_follows_the_change_stream():
+    changes = 180
+    history = replay(changes)
+    starting_rates = np.array([1.0, 2.0])
+
+    for timestamp in range(0, changes * CHANGE_SECONDS + 1, 5):
+        rates, versions = get_rates_at(history, timestamp, starting_rates)
+        expected = true_version(timestamp, changes)
+        version = int(versions[0])
+
+        if expected == 0:
+            assert version == 0 and rates[0] == 1.0
+            continue
+        assert rates[0] == 100.0 + version
+        assert expected <= version <= true_version((timestamp // 3600 + 1) * 3600, changes)
+        # The last 8 changes are in the first tier
+        if timestamp >= (changes - 7) * CHANGE_SECONDS:
+            assert version == expected
+
+        assert rates[1] == 2.0 and versions[1] == 0
+
+
+def test_rates_at_falls_back_to_the_oldest_retained_sample():
+    changes = 100
+    history = replay(changes, tiers=((2, 0), (2, 60)))
+    rates, versions = get_rates_at(history, 5, np.array([1.0, 2.0]))
+    assert history.dropped[0]
+    assert versions[0] > 0 and rates[0] == 100.0 + versions[0]
+
+
+def test_rows_are_only_allocated_for_recorded_cities():
+    clock = FakeClock()
+    history = RateHistory(clock=clock, capacity=4)
+    rng = np.random.default_rng(3)
+    expected = dict()
+    for step in range(1, 50):
+        clock.now = step
+        indices = rng.choice(1000000, 20, replace=False)
+        history.record(indices, indices + step, np.full(20, step))
+        expected.update((int(index), int(index) + step) for index in indices)
+
+    indices, rates, versions = history.rates_at(clock.now)
+    assert len(history) == len(expected)
+    assert indices.tolist() == sorted(expected)
+    assert rates.tolist() == [expected[index] for index in sorted(expected)]
@@ -0,0 +1,51 @@
+import pickle
+
+import numpy as np
+
+from mason_dixon.session_city_store import SessionCityStore
+
+
+# Stands in for a MappedCityStore, which the overlays read the starting rates from
+class CityStoreStub:
+    def __init__(self, rate):
+        self.rate = rate
+
+    def __len__(self):
+        return len(self.rate)
+
+
+def test_overlay_matches_dense_arrays():
+    rng = np.random.default_rng(5)
+    city_store = CityStoreStub(rng.uniform(500, 2000, 1000))
+    session = SessionCityStore(city_store)
+    rates = np.array(city_store.rate)
+    versions = np.zeros(1000, dtype=np.int64)
+
+    for _ in range(30):
+        indices = rng.choice(1000, 50, replace=False)
+        new_rates = rng.uniform(0, 100, 50)
+        new_versions = rng.integers(1, 20, 50)
+        session.apply_updates(indices, new_rates, new_versions)
+        for index, rate, version in zip(indices, new_rates, new_versions):
+            if version > versions[index]:
+                rates[index] = rate
+                versions[index] = version
+
+    snapshot_rates, snapshot_versions = session.snapshot()
+    positions = rng.integers(0, 1000, 200)
+    assert np.array_equal(snapshot_rates[positions], rates[positions])
+    assert np.array_equal(snapshot_versions[positions], versions[positions])
+    assert np.array_equal(session.rates[versions > 0], rates[versions > 0])
+    assert len(session.indices) == np.count_nonzero(versions)
+
+
+def test_snapshot_is_not_changed_by_later_updates():
+    city_store = CityStoreStub(np.arange(10, dtype=float))
+    session = SessionCityStore(city_store)
+    session.apply_updates(np.array([3]), np.array([30.0]), np.array([1]))
+    rates, versions = session.snapshot()
+    session.apply_updates(np.array([3, 4]), np.array([31.0, 40.0]), np.array([2, 1]))
+
+    assert rates[[3, 4]].tolist() == [30.0, 4.0]
+    assert versions[[3, 4]].tolist() == [1, 0]
+    assert pickle.loads(pickle.dumps(session.rates))[[3, 4]].tolist() == [31.0, 40.0]
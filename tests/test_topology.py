@@ -0,0 +1,101 @@
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+
+from mason_dixon.topology import decode_topologies, decode_topology, encode_topology
+
+# With these bounds and quantization, the grid step is 1, so points on integer coordinates round-trip exactly
+BOUNDS = (0.0, 0.0, 100.0, 100.0)
+QUANTIZATION = 101
+
+
+def ring(*points, closed=True):
+    points = list(points) + ([points[0]] if closed else [])
+    return [x for x, _ in points], [y for _, y in points]
+
+
+def cell(*polygons):
+    return [[ring_x for ring_x, _ in polygon] for polygon in polygons], \
+        [[ring_y for _, ring_y in polygon] for polygon in polygons]
+
+
+def map_data(*cells):
+    return dict(x=[cell_x for cell_x, _ in cells], y=[cell_y for _, cell_y in cells],
+                name=['cell ' + str(i) for i in range(len(cells))], rate=[float(i) for i in range(len(cells))])
+
+
+def to_geometries(data):
+    geometries = []
+    for cell_x, cell_y in zip(data['x'], data['y']):
+        polygons = []
+        for polygon_x, polygon_y in zip(cell_x, cell_y):
+            rings = [list(zip(ring_x, ring_y)) for ring_x, ring_y in zip(polygon_x, polygon_y)]
+            polygons.append(Polygon(rings[0], rings[1:]))
+        geometries.append(MultiPolygon(polygons))
+    return geometries
+
+
+def assert_round_trip(data, bounds=BOUNDS, quantization=QUANTIZATION, tolerance=0.0):
+    decoded = decode_topology(encode_topology(data, bounds, quantization))
+    assert decoded['name'] == data['name']
+    assert decoded['rate'] == data['rate']
+    for original, result in zip(to_geometries(data), to_geometries(decoded)):
+        if tolerance == 0.0:
+            assert result.equals(original)
+        else:
+            assert shapely.hausdorff_distance(result, original) <= tolerance
+
+
+def test_shared_borders_round_trip():
+    left = cell([ring((0, 0), (10, 0), (10, 10), (0, 10))])
+    right = cell([ring((10, 0), (20, 0), (20, 10), (10, 10))])
+    above = cell([ring((0, 10), (10, 10), (20, 10), (20, 20), (0, 20))])
+    data = map_data(left, right, above)
+    assert_round_trip(data)
+
+    # Each border is stored once, as an arc that the rings on both of its sides refer to (one of them reversed)
+    payload = encode_topology(data, BOUNDS, QUANTIZATION)
+    arc_count = len(payload['arc_offsets']) - 1
+    assert len(payload['ring_arcs']) > arc_count
+    assert len(np.unique(np.where(payload['ring_arcs'] < 0, ~payload['ring_arcs'], payload['ring_arcs']))) == arc_count
+    assert (payload['ring_arcs'] < 0).any()
+
+
+def test_holes_and_islands_round_trip():
+    # A cell with a hole, the island that fills the hole, and a cell of two separate polygons
+    holed = cell([ring((0, 0), (30, 0), (30, 30), (0, 30)), ring((10, 10), (10, 20), (20, 20), (20, 10))])
+    island = cell([ring((10, 10), (20, 10), (20, 20), (10, 20))])
+    archipelago = cell([ring((40, 0), (50, 0), (50, 10))], [ring((60, 0), (70, 0), (70, 10), (60, 10))])
+    assert_round_trip(map_data(holed, island, archipelago))
+
+
+def test_open_rings_round_trip():
+    # Rings without the closing point are decoded closed
+    square = cell([ring((0, 0), (10, 0), (10, 10), (0, 10), closed=False)])
+    neighbour = cell([ring((10, 0), (20, 0), (20, 10), (10, 10), closed=False)])
+    assert_round_trip(map_data(square, neighbour))
+
+
+def test_points_off_the_grid_round_trip_within_quantization():
+    rng = np.random.default_rng(3)
+    corners = rng.uniform(0, 1000, (20, 2))
+    cells = [cell([ring((x, y), (x + 13.7, y), (x + 13.7, y + 9.1), (x, y + 9.1))]) for x, y in corners]
+    quantization = 10000
+    step = 1020.0 / (quantization - 1)
+    assert_round_trip(map_data(*cells), (-10.0, -10.0, 1010.0, 1010.0), quantization, tolerance=step)
+
+
+def test_payloads_with_the_same_bounds_meet_exactly():
+    # As the batches of a progressive render, each encoded on its own
+    left = cell([ring((0.0, 0.0), (33.3, 1.7), (35.1, 50.2), (0.0, 50.0))])
+    right = cell([ring((33.3, 1.7), (80.0, 0.0), (80.0, 50.0), (35.1, 50.2))])
+    bounds = (0.0, 0.0, 100.0, 100.0)
+    payloads = [encode_topology(map_data(left), bounds, 1000), encode_topology(map_data(right), bounds, 1000)]
+    decoded_left, decoded_right = to_geometries(decode_topologies(payloads))
+
+    # The ends of the shared border are decoded to the same points in both, so there is no gap or overlap
+    left_points = set(map(tuple, shapely.get_coordinates(decoded_left).tolist()))
+    right_points = set(map(tuple, shapely.get_coordinates(decoded_right).tolist()))
+    assert len(left_points & right_points) == 2
+    assert decoded_left.intersection(decoded_right).area == 0.0
+    assert np.isclose(decoded_left.union(decoded_right).area, decoded_left.area + decoded_right.area)
@@ -0,0 +1,155 @@
+import asyncio
+import glob
+import json
+import logging
+import math
+import os
+import time
+import tornado.ioloop
+
+from collections import Counter
+from shapely.geometry import Point
+
+from mason_dixon import coordinate_utility
+
+# Warm-up of the caches for the views that users ask for most, so that the first users after a deploy do not pay
+# the cold costs of every popular view. The hot viewports are the configured warmup_viewports, plus the
+# warmup_top_viewports most requested ones in the recent logs of the Tornado server (which logs each viewport that a
+# session requests the cities of, see VIEWPORT_LOG_PREFIX). Each process warms its own caches: the Tornado server
+# fetches the rates of the viewports' cities, and the Bokeh workers compute their tiles (see RenderQueue.warm_up).
+# The job runs at startup and every warmup_interval seconds, in the background, and gives way to the live traffic.
+#
+# A viewport is a pair (upper_left_wgs, lower_right_wgs) of (lon, lat) tuples.
+
+VIEWPORT_LOG_PREFIX = "Viewport request: "
+
+# The latitude beyond which Web Mercator is not defined
+MAX_MERCATOR_LATITUDE = 85.05112878
+
+# The log files of the Tornado server (the ones of the Bokeh workers are 'MasonDixon-bokeh-...')
+LOG_FILE_PATTERN = 'MasonDixon-[0-9]*.log'
+
+
+def format_viewport_log(upper_left_wgs, lower_right_wgs):
+    return VIEWPORT_LOG_PREFIX + json.dumps([list(upper_left_wgs), list(lower_right_wgs)])
+
+
+# The viewports logged in the Tornado server's log files of the last max_age_hours, reading at most max_bytes from
+# the end of the files (the newest first)
+def read_logged_viewports(log_dir='logs', max_age_hours=24, max_bytes=16 * 1024 * 1024):
+    oldest = time.time() - max_age_hours * 3600
+    file_locs = [file_loc for file_loc in glob.glob(os.path.join(log_dir, LOG_FILE_PATTERN))
+                 if os.path.getmtime(file_loc) >= oldest]
+
+    viewports = []
+    for file_loc in sorted(file_locs, key=os.path.getmtime, reverse=True):
+        if max_bytes <= 0:
+            break
+        with open(file_loc, 'rb') as handle:
+            handle.seek(0, os.SEEK_END)
+            size = handle.tell()
+            handle.seek(max(0, size - max_bytes))
+            data = handle.read()
+        max_bytes -= len(data)
+
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            position = line.find(VIEWPORT_LOG_PREFIX)
+            if position < 0:
+                continue
+            try:
+                upper_left_wgs, lower_right_wgs = json.loads(line[position + len(VIEWPORT_LOG_PREFIX):])
+            except ValueError:
+                # E.g. the first line read from the middle of a file
+                continue
+            viewports.append((tuple(upper_left_wgs), tuple(lower_right_wgs)))
+    return viewports
+
+
+# Viewports that differ by less than about a quarter of their size (or a quarter of a zoom step) share a key
+def get_viewport_key(viewport):
+    (left, top), (right, bottom) = viewport
+    width = max(abs(right - left), 1e-6)
+    step = width / 4
+    return round(4 * math.log2(width)), round((left + right) / 2 / step), round((top + bottom) / 2 / step)
+
+
+# The configured viewports ([lon, lat, zoom] of their upper left corner, with the configured aspect ratio), then the
+# most requested ones in the logs
+def get_hot_viewports(cfg, log_dir='logs'):
+    aspect_ratio = cfg["aspect_ratio"]
+    viewports = [((lon, lat), (lon + zoom, lat - zoom / aspect_ratio))
+                 for lon, lat, zoom in cfg.get("warmup_viewports", [])]
+
+    top = cfg.get("warmup_top_viewports", 0)
+    if top > 0:
+        counts = Counter()
+        representatives = dict()
+        for viewport in read_logged_viewports(log_dir, cfg.get("warmup_log_hours", 24)):
+            key = get_viewport_key(viewport)
+            counts[key] += 1
+            representatives.setdefault(key, viewport)
+
+        configured = len(viewports)
+        known = set(get_viewport_key(viewport) for viewport in viewports)
+        viewports.extend(representatives[key] for key, _ in counts.most_common(top + len(known))
+                         if key not in known)
+        viewports = viewports[:configured + top]
+    return viewports
+
+
+def viewport_to_mercator(viewport):
+    (left, top), (right, bottom) = viewport
+    top, bottom = (max(-MAX_MERCATOR_LATITUDE, min(MAX_MERCATOR_LATITUDE, lat)) for lat in (top, bottom))
+    return coordinate_utility.point_to_mercator(Point(left, top)), coordinate_utility.point_to_mercator(
+        Point(right, bottom))
+
+
+# Runs warm(viewports) (a coroutine function, which returns the number of items it warmed) for the hot viewports,
+# now and every interval seconds (0 only warms up at startup)
+class WarmUpJob:
+    def __init__(self, cfg, warm, interval=600):
+        self.cfg = cfg
+        self.warm = warm
+        self.interval = interval
+        self._running = False
+        self.runs = 0
+        self.viewports = 0
+        self.warmed = 0
+        self.last_seconds = 0.0
+
+    def start(self):
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+        if self.interval > 0:
+            tornado.ioloop.PeriodicCallback(self.run, self.interval * 1000).start()
+
+    async def run(self):
+        if self._running:
+            return
+        self._running = True
+        start = time.perf_counter()
+        try:
+            # Reading the logs is kept off the IO loop
+            viewports = await asyncio.get_running_loop().run_in_executor(None, get_hot_viewports, self.cfg)
+            warmed = await self.warm(viewports)
+        except Exception as e:
+            logging.warning("Warm-up failed: " + str(e))
+            return
+        finally:
+            self._running = False
+
+        self.runs += 1
+        self.viewports = len(viewports)
+        self.warmed += warmed
+        self.last_seconds = time.perf_counter() - start
+        logging.info("Warmed up " + str(warmed) + " items for " + str(len(viewports)) + " hot viewports in " +
+                     format(self.last_seconds, '.1f') + "s")
+
+    def stats(self):
+        return {'runs': self.runs, 'viewports': self.viewports, 'warmed': self.warmed,
+                'last_seconds': self.last_seconds, 'running': self._running}
+
+
+def create_warmup_job(cfg, warm):
+    if not cfg.get("warmup_viewports") and cfg.get("warmup_top_viewports", 0) <= 0:
+        return None
+    return WarmUpJob(cfg, warm, cfg.get("warmup_interval", 600))